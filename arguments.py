@@ -77,6 +77,8 @@ def parse_args():
 		help='Maximum number of sites from which to derive normalization values.')
 	parser.add_argument('--sample_name', default='NA12878',
 		help='The sample name from which to gather genotype information from the negative VCF.')
+	parser.add_argument('--cohort_file', default=None,
+		help='Tab separated file with a sample name, BAM and optionally truth VCF and BED on each line, for writing tensors of a cohort from a joint called negative VCF.')
 
 
 	# Training and optimization related arguments
@@ -98,6 +100,22 @@ def parse_args():
 		help='Maximum number of model parameters used for hyperparameter optimization, etc.')
 
 
+	# Training input pipeline arguments
+	parser.add_argument('--prefetch_workers', default=0, type=int,
+		help='Number of background threads or processes reading minibatches ahead of training, 0 reads them on the training thread.')
+	parser.add_argument('--prefetch_mode', default='thread', choices=['thread', 'process'],
+		help='Whether prefetching workers are threads or processes.')
+	parser.add_argument('--prefetch_queue_size', default=8, type=int,
+		help='Maximum number of prefetched minibatches waiting to be trained on.')
+	parser.add_argument('--batch_buffers', default=6, type=int,
+		help='Number of preallocated minibatches each training generator fills in turn, at most this many minus 2 wait in the Keras queue.')
+	parser.add_argument('--batch_dtype', default='float32', choices=['float16', 'float32', 'float64'],
+		help='Data type of the minibatch arrays training generators fill.')
+	parser.add_argument('--epoch_cache_dir', default=None,
+		help='Directory on fast local disk where each split of the dataset is decompressed once into memory mapped arrays which later epochs and runs read from.')
+	parser.add_argument('--indexed_batches', default=False, action='store_true',
+		help='Load minibatches by index as a keras Sequence, so prefetch workers are a Keras worker pool and each epoch covers the training set once.')
+
 	# Dataset generation related arguments
 	parser.add_argument('--downsample_snps', default=1.0, type=float,
 		help='Rate of SNP examples that are kept must be in [0.0, 1.0].')	
@@ -111,6 +129,8 @@ def parse_args():
 		help='Rate of reference genotype examples that are kept must be in [0.0, 1.0].')		
 	parser.add_argument('--downsample_homozygous', default=0.001, type=float,
 		help='Rate of homozygous genotypes that are kept must be in [0.0, 1.0].')	
+	parser.add_argument('--target_counts', nargs='+', default=[],
+		help='Number of examples of each label to write, e.g. 200000 for every label or SNP=200000 NOT_SNP=100000. Sets the downsampling rates from a planning pass over the VCFs.')
 	parser.add_argument('--start_pos', default=0, type=int,
 		help='Genomic position start for parallel tensor writing.')
 	parser.add_argument('--end_pos', default=0, type=int,
@@ -128,6 +148,32 @@ def parse_args():
 	parser.add_argument('--test_contigs', nargs='+', default=['20', '21', 'chr20', 'chr21'],
 		help='Contigs to reserve for testing data in addition to those reserved by test_ratio.')	
 	parser.add_argument('--chrom', help='Chromosome to load for parallel tensor writing.')
+	parser.add_argument('--bed_bitsets', default=False, action='store_true',
+		help='Rasterize the bed file channels of DNA tensors into a bitset per contig rather than searching the intervals of each window, faster for genome wide runs.')
+	parser.add_argument('--write_workers', default=1, type=int,
+		help='Number of processes for parallel tensor writing, genomic intervals are scattered over the process pool.')
+	parser.add_argument('--write_interval_size', default=10000000, type=int,
+		help='Size in base pairs of the genomic intervals each tensor writing process works on.')
+	parser.add_argument('--manifest_checkpoint', default=0, type=int,
+		help='If positive, tensor writers keep a manifest in data_dir/manifests/ and checkpoint it after this many examples, rerun the same command to resume.')
+	parser.add_argument('--async_writer', default='none', choices=['none', 'thread', 'process'],
+		help='Write tensors to disk in a background thread or process so encoding is not blocked by file system latency.')
+	parser.add_argument('--writer_queue_size', default=64, type=int,
+		help='Maximum number of examples waiting to be written by the background writer.')
+	parser.add_argument('--tensor_storage', default='files', choices=['files', 'shards'],
+		help='How to store written tensors: one hd5 file per example, or shards packing many examples into each hd5 file.')
+	parser.add_argument('--tensors_per_shard', default=4096, type=int,
+		help='Maximum number of examples in each shard when tensor_storage is shards.')
+	parser.add_argument('--compression', default=None, choices=['none', 'lzf', 'gzip'],
+		help='Compression filter for written tensors. By default write_tensors uses gzip, some other writers no compression.')
+	parser.add_argument('--compression_level', default=4, type=int, choices=range(10),
+		help='Level of gzip compression from 0 (fastest) to 9 (smallest files).')
+	parser.add_argument('--shuffle_filter', default=False, action='store_true',
+		help='Shuffle the bytes of written tensors before compressing them, this often makes floating point tensors smaller.')
+	parser.add_argument('--chunk_shape', default=None, nargs='+', type=int,
+		help='Chunk shape for written tensors with this many dimensions (e.g. --chunk_shape 16 128 15). Others are chunked automatically.')
+	parser.add_argument('--chunk_examples', default=1, type=int,
+		help='Number of examples in each chunk of a shard when tensor_storage is shards.')
 
 
 	# Input files and directories: vcfs, bams, beds, hd5, fasta
@@ -146,6 +192,8 @@ def parse_args():
 		help='Path to a VCF that has annotations (typically from Haplotype Caller).')
 	parser.add_argument('--negative_vcf', default=defines.negative_vcf,
 		help='Haplotype Caller or VQSR generated VCF with raw annotation values [and quality scores].')
+	parser.add_argument('--negative_vcf_2', default=None,
+		help='Second VCF of the same calls whose QUAL and FILTER fields are copied onto args.negative_vcf by combine_vcfs.')
 	parser.add_argument('--ignore_vcf', default=None,
 		help='Optional VCF of sites to ignore when doing evaluations.')
 	parser.add_argument('--include_vcf', default=None,
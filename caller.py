@@ -8,7 +8,6 @@ from __future__ import absolute_import
 # Imports
 import os
 import sys
-import vcf
 import h5py
 import time
 import pysam
@@ -19,7 +18,6 @@ import arguments
 import numpy as np
 import training_data as td
 import inference as inf
-from Bio import Seq, SeqIO
 from collections import Counter, defaultdict
 
 
@@ -41,22 +39,21 @@ def infer_tensor(args):
 	vcf_writer = pysam.VariantFile(args.output_vcf, 'w', header=vcf_reader.header)
 	print('got vcfs.')
 	
-	tensor_paths = [args.data_dir+tp for tp in sorted(os.listdir(args.data_dir))]
+	tensor_paths = sorted(td.examples_in_directory(args.data_dir), key=str)
 	print('found tensors: ', len(tensor_paths))
 	tensor_batch = np.zeros((args.batch_size,)+defines.tensor_shape_from_args(args))
 	gpos_batch = []
 
 	for tp in tensor_paths:
-		with h5py.File(tp, 'r') as hf:
-			tensor_batch[stats['cur_tensor']] = np.array(hf.get(args.tensor_map))
-			gpos_batch.append(td.position_string_from_tensor_name(tp).split('_'))
-			stats['cur_tensor'] += 1
-			if stats['cur_tensor'] == args.batch_size:
-				## Evaluate the model
-				predictions = model.predict(tensor_batch) # predictions is a numpy arra	
-				predictions_to_variants(args, predictions, gpos_batch, tensor_batch, vcf_writer)
-				stats['cur_tensor'] = 0
-				gpos_batch = []
+		tensor_batch[stats['cur_tensor']] = td.load_example_tensor(tp, args.tensor_map, tensor_batch.shape[1:])
+		gpos_batch.append(td.position_string_from_example(tp).split('_'))
+		stats['cur_tensor'] += 1
+		if stats['cur_tensor'] == args.batch_size:
+			## Evaluate the model
+			predictions = model.predict(tensor_batch) # predictions is a numpy arra	
+			predictions_to_variants(args, predictions, gpos_batch, tensor_batch, vcf_writer)
+			stats['cur_tensor'] = 0
+			gpos_batch = []
 
 
 def infer_vcf(args):
@@ -67,10 +64,10 @@ def infer_vcf(args):
 	vcf_writer = pysam.VariantFile(args.output_vcf, 'w', header=vcf_reader.header)
 	print('got vcfs.')
 
-	reference = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
+	reference = td.IndexedReference(args.reference_fasta)
 	print('Loaded reference FASTA:', args.reference_fasta)
 
-	samfile = pysam.AlignmentFile(args.bam_file, "rb")	
+	samfile = td.ReadWindowCache(args.bam_file)
 	print('got sam.')	
 
 	if args.chrom:
@@ -86,22 +83,21 @@ def infer_vcf(args):
 	print(len(intervals), 'intervals to iterate over, contigs:', intervals.keys())
 	start_time = time.time()
 	for k in intervals:
-		contig = reference[k]
 		args.chrom = k
 		for start,stop in zip(intervals[k][0], intervals[k][1]):
 			cur_pos = start
 			for cur_pos in range(start, stop, args.window_size):		
-				record = contig[cur_pos: cur_pos+args.window_size]
-				t = td.make_calling_tensor(args, samfile, record, cur_pos, stats)
+				reference_seq = reference.fetch(k, cur_pos, cur_pos+args.window_size)
+				t = td.make_calling_tensor(args, samfile, reference_seq, cur_pos, stats)
 				
 				if not t is None:
 					tensor_batch[stats['cur_tensor']] = t	
-					gpos_batch.append((k, cur_pos, record))
+					gpos_batch.append((k, cur_pos, reference_seq))
 					stats['cur_tensor'] += 1
 
 				if stats['cur_tensor'] == args.batch_size:
 					predictions = model.predict(tensor_batch) # predictions is a numpy arra
-					predictions_to_variants(args, predictions, gpos_batch, tensor_batch, vcf_writer, contig)
+					predictions_to_variants(args, predictions, gpos_batch, tensor_batch, vcf_writer, reference)
 					tensor_batch = np.zeros((args.batch_size,)+defines.tensor_shape_from_args(args))
 					stats['cur_tensor'] = 0
 					stats['batches_processed'] += 1
@@ -118,7 +114,7 @@ def infer_vcf(args):
 		print(s, 'has:', stats[s])	
 
 
-def predictions_to_variants(args, predictions, gpos_batch, tensor_batch, vcf_writer, contig=None):
+def predictions_to_variants(args, predictions, gpos_batch, tensor_batch, vcf_writer, reference=None):
 	index2labels = {v:k for k,v in defines.calling_labels.items()}
 	indel_start = -1
 	ref_offset = 0
@@ -132,8 +128,8 @@ def predictions_to_variants(args, predictions, gpos_batch, tensor_batch, vcf_wri
 
 			ref_start = int(gpos[1])-ref_offset
 			# Does NOT properly handle multiallelics
-			if contig is not None:
-				ref_allele = str(contig[ref_start+j])
+			if reference is not None:
+				ref_allele = reference.fetch(gpos[0], ref_start+j, ref_start+j+1)
 				if ref_allele == 'N':
 					continue
 			else:
@@ -157,7 +153,7 @@ def predictions_to_variants(args, predictions, gpos_batch, tensor_batch, vcf_wri
 									  alleles=[ref_allele, alt],
 									  qual=predictions[i][j][guess[j]])
 			elif index2labels[guess[j]] == 'HET_DELETION' and variant_edge(index2labels, guess, j):
-				d = str(contig[ref_start+indel_start-1:ref_start+indel_start+(j-indel_start)+2].seq)
+				d = reference.fetch(gpos[0], ref_start+indel_start-1, ref_start+indel_start+(j-indel_start)+2)
 				if len(d) < 2 or d[0] == 'N':
 					continue
 				v = vcf_writer.new_record(contig=gpos[0], 
@@ -167,7 +163,7 @@ def predictions_to_variants(args, predictions, gpos_batch, tensor_batch, vcf_wri
 									  qual=predictions[i][j][guess[j]])
 				indel_start = -1
 			elif index2labels[guess[j]] == 'HOM_DELETION' and variant_edge(index2labels, guess, j):
-				d = str(contig[ref_start+indel_start-1:ref_start+indel_start+(j-indel_start)+2].seq)
+				d = reference.fetch(gpos[0], ref_start+indel_start-1, ref_start+indel_start+(j-indel_start)+2)
 				if len(d) < 2 or d[0] == 'N':
 					continue
 				v = vcf_writer.new_record(contig=gpos[0], 
@@ -177,8 +173,8 @@ def predictions_to_variants(args, predictions, gpos_batch, tensor_batch, vcf_wri
 									  qual=predictions[i][j][guess[j]])
 				indel_start = -1
 			elif index2labels[guess[j]] == 'HOM_INSERTION' and variant_edge(index2labels, guess, j):
-				if contig:
-					ref = str(contig[(ref_start+indel_start)-1])
+				if reference is not None:
+					ref = reference.fetch(gpos[0], ref_start+indel_start-1, ref_start+indel_start)
 					if ref == 'N':
 						continue
 				else:
@@ -194,8 +190,8 @@ def predictions_to_variants(args, predictions, gpos_batch, tensor_batch, vcf_wri
 				ref_offset += j-indel_start
 				indel_start = -1
 			elif index2labels[guess[j]] == 'HET_INSERTION' and variant_edge(index2labels, guess, j):
-				if contig:
-					ref = str(contig[(ref_start+indel_start)-1])
+				if reference is not None:
+					ref = reference.fetch(gpos[0], ref_start+indel_start-1, ref_start+indel_start)
 					if ref == 'N':
 						continue
 				else:
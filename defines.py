@@ -117,35 +117,45 @@ def annotations_from_args(args):
 	return None
 
 
+# Tensor maps whose channels are a subset, by channel name, of a wider tensor map.
+# Writers store only the wider tensor and loaders slice out the channels.
+derived_tensor_maps = {'reads_only':'read_tensor', 'reads_reference':'read_tensor'}
+
+
 def get_tensor_channel_map_from_args(args):
 	'''Return tensor mapping dict given args.tensor_map'''
-	if not args.tensor_map:
+	return get_tensor_channel_map_by_name(args.tensor_map)
+
+
+def get_tensor_channel_map_by_name(tensor_map):
+	'''Return tensor mapping dict given the name of a tensor map'''
+	if not tensor_map:
 		return None
 
-	if 'read_tensor' == args.tensor_map:
+	if 'read_tensor' == tensor_map:
 		return get_tensor_channel_map_rt()
-	elif 'paired_reads' == args.tensor_map:
+	elif 'paired_reads' == tensor_map:
 		return get_tensor_channel_map_rt()
-	elif 'reads_only' == args.tensor_map:
+	elif 'reads_only' == tensor_map:
 		return get_tensor_channel_map_reads_only()			
-	elif 'reads_reference' == args.tensor_map:
+	elif 'reads_reference' == tensor_map:
 		return get_tensor_channel_map_rr()	
-	elif '2d_2bit' == args.tensor_map:
+	elif '2d_2bit' == tensor_map:
 		return get_tensor_channel_map_2bit()
-	elif '1d_calling'== args.tensor_map:
+	elif '1d_calling'== tensor_map:
 		return get_tensor_channel_map_reference_reads()
-	elif '2d' == args.tensor_map or '2d_annotations' == args.tensor_map or '2d_mapping_quality' == args.tensor_map:
+	elif '2d' == tensor_map or '2d_annotations' == tensor_map or '2d_mapping_quality' == tensor_map:
 		return get_tensor_channel_map_mq()
-	elif 'reference' == args.tensor_map or '1d_dna' == args.tensor_map or '1d_annotations' == args.tensor_map:
+	elif 'reference' == tensor_map or '1d_dna' == tensor_map or '1d_annotations' == tensor_map:
 		return get_tensor_channel_map_1d_dna()
-	elif 'bqsr' == args.tensor_map:
+	elif 'bqsr' == tensor_map:
 		return bqsr_tensor_channel_map()
-	elif 'annotations' == args.tensor_map:
+	elif 'annotations' == tensor_map:
 		return annotations
-	elif 'deep_variant' == args.tensor_map:
+	elif 'deep_variant' == tensor_map:
 		return deep_variant_channel_map()
 	else:
-		raise ValueError('Unknown tensor mapping mode:', args.tensor_map)
+		raise ValueError('Unknown tensor mapping mode:', tensor_map)
 
 
 def get_tensor_channel_map_1d_dna():
@@ -249,7 +249,7 @@ class HyperparameterOptimizer(object):
 					return self.max_loss 
 
 				model = models.train_model_from_generators(args, model, generate_train, generate_valid, args.output_dir + args.id + '.hd5')
-				loss_and_metrics = model.evaluate_generator(generate_test, steps=args.patience)
+				loss_and_metrics = model.evaluate_generator(generate_test, steps=args.patience, max_queue_size=td.batch_queue_size(args))
 				stats['count'] += 1
 				print('Current architecture: ', self.string_from_arch_dict(x))
 				print('Loss ', loss_and_metrics[0], '\nCount:', stats['count'], 'iterations', args.iterations, 'Model size', model.count_params())
@@ -326,7 +326,7 @@ class HyperparameterOptimizer(object):
 					return self.max_loss
 
 				model = models.train_model_from_generators(args, model, generate_train, generate_valid, args.output_dir + args.id + '.hd5')
-				loss_and_metrics = model.evaluate_generator(generate_test, steps=args.patience)
+				loss_and_metrics = model.evaluate_generator(generate_test, steps=args.patience, max_queue_size=td.batch_queue_size(args))
 				stats['count'] += 1
 				print('Current architecture: ', self.string_from_arch_dict(x))
 				print('Loss:', loss_and_metrics[0], '\nCount:', stats['count'], 'iterations', args.iterations, 'Model size', model.count_params())
@@ -397,7 +397,7 @@ class HyperparameterOptimizer(object):
 					return self.max_loss
 
 				model = models.train_model_from_generators(args, model, generate_train, generate_valid, args.output_dir + args.id + '.hd5')
-				loss_and_metrics = model.evaluate_generator(generate_test, steps=args.patience)
+				loss_and_metrics = model.evaluate_generator(generate_test, steps=args.patience, max_queue_size=td.batch_queue_size(args))
 				stats['count'] += 1
 				print('Current architecture: ', self.string_from_arch_dict(x))
 				print('Loss:', loss_and_metrics[0], '\nCount:', stats['count'], 'iterations', args.iterations, 'Model size', model.count_params())
@@ -471,7 +471,7 @@ class HyperparameterOptimizer(object):
 					return self.max_loss
 
 				model = models.train_model_from_generators(args, model, generate_train, generate_valid, args.output_dir + args.id + '.hd5')
-				loss_and_metrics = model.evaluate_generator(generate_test, steps=args.patience)
+				loss_and_metrics = model.evaluate_generator(generate_test, steps=args.patience, max_queue_size=td.batch_queue_size(args))
 				stats['count'] += 1
 				print('Current architecture: ', self.string_from_arch_dict(x))
 				print('Loss:', loss_and_metrics[0], '\nCount:', stats['count'], 'iterations', args.iterations, 'Model size', model.count_params())
@@ -536,7 +536,7 @@ class HyperparameterOptimizer(object):
 					return self.max_loss
 
 				model = models.train_model_from_generators(args, model, generate_train, generate_valid, args.output_dir + args.id + '.hd5')
-				loss_and_metrics = model.evaluate_generator(generate_test, steps=args.patience)
+				loss_and_metrics = model.evaluate_generator(generate_test, steps=args.patience, max_queue_size=td.batch_queue_size(args))
 				stats['count'] += 1
 				print('Current architecture: ', self.string_from_arch_dict(x))
 				print('Loss:', loss_and_metrics[0], '\nCount:', stats['count'], 'iterations', args.iterations, 'Model size', model.count_params())
@@ -15,7 +15,6 @@ from __future__ import absolute_import
 # Imports
 import os
 import sys
-import vcf
 import h5py
 import time
 import pysam
@@ -25,7 +24,6 @@ import operator
 import arguments
 import numpy as np
 import training_data as td
-from Bio import Seq, SeqIO
 from collections import Counter, defaultdict
 
 
@@ -38,7 +36,6 @@ def annotate_vcf_with_inference(args):
 	cnns = {}
 	stats = Counter()
 	vcf_reader = pysam.VariantFile(args.negative_vcf, 'rb')
-	pyvcf_vcf_reader = vcf.Reader(open(args.negative_vcf, 'rb'))
 	input_tensors = {}
 
 	for a in args.architectures:	
@@ -54,10 +51,10 @@ def annotate_vcf_with_inference(args):
 	vcf_writer = pysam.VariantFile(args.output_vcf, 'w', header=vcf_reader.header)
 	print('got vcfs. input tensor shape mapping:', input_tensors)
 
-	reference = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
+	reference = td.IndexedReference(args.reference_fasta)
 	print('got ref.')
 
-	samfile = pysam.AlignmentFile(args.bam_file, "rb")	
+	samfile = td.ReadWindowCache(args.bam_file)
 	print('got sam.')
 
 	positions = []
@@ -79,23 +76,19 @@ def annotate_vcf_with_inference(args):
 	for variant in variants:
 		idx_offset, ref_start, ref_end = get_variant_window(args, variant)
 		args.chrom = variant.contig # In case chrom isn't set on command line we need it to fetch reads.
-		contig = reference[variant.contig]	
-		record = contig[ ref_start : ref_end ]
-		v = pysam_variant_in_pyvcf(variant, pyvcf_vcf_reader)
+		reference_seq = reference.fetch(variant.contig, ref_start, ref_end)
+		v = td.VariantRecord(variant)
 		for tm in batch:
 			batch_key = tm+'_in_batch'
 			if tm in defines.annotations:
-				args.annotation_set = tm
-				annotation_data = td.get_annotation_data(args, v, stats)
-				batch[tm][stats[batch_key]] = annotation_data
-				stats[batch_key] += 1
+				stats[batch_key] += 1 # Annotations are filled for the whole batch by annotate_batch()
 
 			if 'read' in tm:
 				args.tensor_map = tm
 				if "read_tensor" == args.tensor_map:
-					read_tensor = td.make_reference_and_reads_tensor(args, v, samfile, record.seq, ref_start, stats)
+					read_tensor = td.make_reference_and_reads_tensor(args, v, samfile, reference_seq, ref_start, stats)
 				elif "paired_reads" == args.tensor_map:	
-					read_tensor = td.make_paired_read_tensor(args, v, samfile, record.seq, ref_start, ref_end, stats)
+					read_tensor = td.make_paired_read_tensor(args, v, samfile, reference_seq, ref_start, ref_end, stats)
 				else:
 					raise ValueError("Unknown read tensor mapping."+tt)
 
@@ -107,7 +100,7 @@ def annotate_vcf_with_inference(args):
 
 			if 'reference' in tm:
 				args.tensor_map = tm
-				reference_tensor = td.make_reference_tensor(args, record.seq)
+				reference_tensor = td.make_reference_tensor(args, reference_seq)
 				batch[tm][stats[batch_key]] = reference_tensor
 				stats[batch_key] += 1
 			
@@ -115,6 +108,7 @@ def annotate_vcf_with_inference(args):
 		variant_batch.append(variant)
 
 		if stats[batch_key] == args.batch_size:
+			annotate_batch(args, batch, variant_batch, stats)
 			apply_cnns_to_batch(args, cnns, batch, positions, variant_batch, vcf_writer, stats)
 			
 			# Reset the batch
@@ -135,38 +129,18 @@ def annotate_vcf_with_inference(args):
 			break
 
 	if stats[batch_key] > 0:
+		annotate_batch(args, batch, variant_batch, stats)
 		apply_cnns_to_batch(args, cnns, batch, positions, variant_batch, vcf_writer, stats)
 
 	for s in stats.keys():
 		print(s, 'has:', stats[s])	
 
 
-def pysam_variant_to_pyvcf(v):
-	alts = [vcf.model._Substitution(a) for a in v.alts]
-	return vcf.model._Record(v.contig, v.pos, v.id, v.ref, alts, v.qual, v.filter, v.info, [], None)
-
-
-def pysam_variant_in_pyvcf(variant, vcf_ram, contig_prefix=''):
-	''' Check if variant is in a VCF file.
-
-	Arguments
-		variant: the variant we are looking for
-		vcf_ram: the VCF we look in, must have an index (tbi, or idx)
-
-	Returns
-		variant if it is found otherwise None
-	'''	
-	start = variant.pos-1
-	end = variant.pos
-
-	variants = vcf_ram.fetch(contig_prefix+variant.chrom, start, end)
-	
-	for v in variants:
-		same_allele = any([a1 == a2 for a1 in v.ALT for a2 in variant.alts]) 
-		if v.POS == variant.pos and same_allele:
-			return v
-	
-	return None 
+def annotate_batch(args, batch, variant_batch, stats):
+	'''Fill the rows of the annotation inputs in batch for the variants in variant_batch in one pass.'''
+	for tm in batch:
+		if tm in defines.annotations:
+			td.get_annotation_matrix(args, variant_batch, stats, out=batch[tm][:len(variant_batch)])
 
 
 def score_key_from_json(json_file):
@@ -211,24 +185,16 @@ def load_tensors_and_annotations_from_class_dirs(args):
 	positions = []
 	annotations = []
 
-	for tp in os.listdir(args.tensors):
-
-		fn, file_extension = os.path.splitext(tp)
-		if not file_extension.lower() in tensor_exts:
+	for example in sorted(td.examples_in_directory(args.tensors), key=str):
+		try:
+			example_tensors = td.load_example_tensors(example, ['read_tensor', 'annotations'])
+		except (IOError, ValueError) as e:
+			print(str(e), '\nError loading tensor at:', example)
 			continue
 
-		gpos = tp.split('-')[2]
-		chrom = gpos.split('_')[0]
-		pos = os.path.splitext(gpos.split('_')[1])[0]
-
-		positions.append(chrom + '_' + pos)
-
-		try:
-			with h5py.File(args.tensors+'/'+tp, 'r') as hf:
-				tensors.append(np.array(hf.get('read_tensor')))
-				annotations.append(np.array(hf.get('annotations')))
-		except ValueError as e:
-			print(str(e), '\nValue error at:', tp)
+		tensors.append(example_tensors['read_tensor'])
+		annotations.append(example_tensors['annotations'])
+		positions.append(td.position_string_from_example(example))
 
 	return (np.asarray(tensors), np.asarray(annotations), np.asarray(positions))
 
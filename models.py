@@ -26,6 +26,7 @@ import json
 import plots
 import defines
 import numpy as np
+import training_data as td
 from collections import namedtuple
 
 # Keras Imports
@@ -35,7 +36,7 @@ import keras.backend as K
 import keras_resnet.models
 from keras.preprocessing import image
 from keras.optimizers import SGD, Adam, RMSprop
-from keras.utils import plot_model, to_categorical
+from keras.utils import plot_model, to_categorical, Sequence
 from keras.utils.vis_utils import model_to_dot
 from keras.models import Sequential, Model, load_model
 from keras.callbacks import ModelCheckpoint, EarlyStopping, TensorBoard, ReduceLROnPlateau
@@ -2114,13 +2115,13 @@ def inspect_model(args, model, generate_train, generate_valid, image_path=None):
 		plot_dot_model_in_color(args, model_to_dot(model, show_shapes=args.inspect_show_labels), image_path)
 
 	t0 = time.time()
-	history = model.fit_generator(generate_train, steps_per_epoch=args.training_steps, epochs=1, verbose=1, validation_steps=5, validation_data=generate_valid)
+	history = model.fit_generator(generate_train, steps_per_epoch=args.training_steps, epochs=1, verbose=1, validation_steps=5, validation_data=generate_valid, max_queue_size=td.batch_queue_size(args))
 	t1 = time.time()
 	train_speed = (t1-t0)/(args.batch_size*args.training_steps)
 	print('Spent: ', t1-t0, ' seconds training, batch_size:', args.batch_size, 'steps:', args.training_steps, ' Per example training speed:', train_speed)
 
 	t0 = time.time()
-	predictions = model.predict_generator(generate_valid, steps=args.training_steps, verbose=1)
+	predictions = model.predict_generator(generate_valid, steps=args.training_steps, verbose=1, max_queue_size=td.batch_queue_size(args))
 	t1 = time.time()
 	inference_speed = (t1-t0)/(args.batch_size*args.training_steps)
 	print('Spent: ', t1-t0, ' seconds predicting. Per tensor inference speed:', inference_speed)
@@ -2328,10 +2329,25 @@ def train_model_from_generators(args, model, generate_train, generate_valid, sav
 		image_path = args.id+'.png' if args.image_dir is None else args.image_dir+args.id+'.png'
 		inspect_model(args, model, generate_train, generate_valid, image_path=image_path)
 
-	history = model.fit_generator(generate_train, 
-		steps_per_epoch=args.training_steps, epochs=args.epochs, verbose=1, 
-		validation_steps=args.validation_steps, validation_data=generate_valid,
-		callbacks=get_callbacks(args, save_weight_hd5))
+	if isinstance(generate_train, td.IndexedBatches):
+		# Each epoch covers the training set once, batches are loaded by a Keras worker pool
+		validation_steps = args.validation_steps
+		if isinstance(generate_valid, td.IndexedBatches):
+			validation_steps = min(validation_steps, len(generate_valid))
+			generate_valid = MinibatchSequence(generate_valid)
+		history = model.fit_generator(MinibatchSequence(generate_train), 
+			steps_per_epoch=len(generate_train), epochs=args.epochs, verbose=1, 
+			validation_steps=validation_steps, validation_data=generate_valid,
+			callbacks=get_callbacks(args, save_weight_hd5), shuffle=False,
+			workers=max(1, args.prefetch_workers), use_multiprocessing=(args.prefetch_mode == 'process'))
+	else:
+		generate_train = td.prefetch_batches(args, generate_train)
+		generate_valid = td.prefetch_batches(args, generate_valid)
+		# Generators fill args.batch_buffers arrays in turn, see td.batch_queue_size()
+		history = model.fit_generator(generate_train, 
+			steps_per_epoch=args.training_steps, epochs=args.epochs, verbose=1, 
+			validation_steps=args.validation_steps, validation_data=generate_valid,
+			callbacks=get_callbacks(args, save_weight_hd5), max_queue_size=td.batch_queue_size(args))
 
 	plots.plot_metric_history(history, plots.weight_path_to_title(save_weight_hd5))
 	print('Model weights saved at: %s' % save_weight_hd5)
@@ -2339,6 +2355,25 @@ def train_model_from_generators(args, model, generate_train, generate_valid, sav
 	return model
 
 
+class MinibatchSequence(Sequence):
+	'''keras.utils.Sequence of index based minibatches such as td.LabelBalancedBatches.
+
+	Keras worker pools, including use_multiprocessing=True, can load these batches in parallel 
+	without duplicating them or mixing up their order, and each epoch is shuffled deterministically.
+	'''
+	def __init__(self, batches):
+		self.batches = batches
+
+	def __len__(self):
+		return len(self.batches)
+
+	def __getitem__(self, index):
+		return self.batches[index]
+
+	def on_epoch_end(self):
+		self.batches.on_epoch_end()
+
+
 def get_callbacks(args, save_weight_hd5):
 	callbacks = []
 	
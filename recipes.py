@@ -20,7 +20,6 @@ from __future__ import absolute_import
 # Imports
 import os
 import sys
-import vcf
 import h5py
 import time
 import plots
@@ -74,9 +73,9 @@ def train_calling_model(args):
 	model = models.build_2d_cnn_calling_segmentation_1d(args)
 	
 	train_paths, valid_paths, test_paths = td.get_train_valid_test_paths_all(args)
-	generate_train = td.calling_tensors_generator(args, train_paths)
-	generate_valid = td.calling_tensors_generator(args, valid_paths)
-	generate_test = td.calling_tensors_generator(args, test_paths)
+	generate_train = td.minibatches_from_args(args, td.calling_tensors_generator, args, train_paths)
+	generate_valid = td.minibatches_from_args(args, td.calling_tensors_generator, args, valid_paths)
+	generate_test = td.minibatches_from_args(args, td.calling_tensors_generator, args, test_paths)
 
 	weight_path = arguments.weight_path_from_args(args)
 	if args.inspect_model:
@@ -118,9 +117,9 @@ def train_calling_model_full(args):
 
 	train_paths, valid_paths, test_paths = td.get_train_valid_test_paths_all(args)
 
-	generate_train = td.calling_tensors_generator(args, train_paths)
-	generate_valid = td.calling_tensors_generator(args, valid_paths)
-	generate_test = td.calling_tensors_generator(args, test_paths)
+	generate_train = td.minibatches_from_args(args, td.calling_tensors_generator, args, train_paths)
+	generate_valid = td.minibatches_from_args(args, td.calling_tensors_generator, args, valid_paths)
+	generate_test = td.minibatches_from_args(args, td.calling_tensors_generator, args, test_paths)
 
 	weight_path = arguments.weight_path_from_args(args)
 	model = models.train_model_from_generators(args, model, generate_train, generate_valid, weight_path)
@@ -294,7 +293,7 @@ def test_caller_2d(args):
 	args.labels = defines.calling_labels
 
 	_, _, test_paths = td.get_train_valid_test_paths_all(args)
-	generate_test = td.calling_tensors_generator(args, test_paths)
+	generate_test = td.minibatches_from_args(args, td.calling_tensors_generator, args, test_paths)
 
 	#model = models.build_2d_cnn_calling_segmentation_1d(args)
 	model = models.load_model(args.weights_hd5, custom_objects=models.get_all_custom_objects(args.labels))
@@ -556,7 +555,7 @@ def train_reference_annotation_1layer(args):
 		model.save(args.output_dir + args.id + '_epoch_' + str(i) + '.hd5')
 		model.fit_generator(generate_train, 
 			steps_per_epoch=args.training_steps, epochs=1, verbose=1, 
-			validation_steps=args.validation_steps, validation_data=generate_valid)
+			validation_steps=args.validation_steps, validation_data=generate_valid, max_queue_size=td.batch_queue_size(args))
 
 	_, _, generate_test = td.train_valid_test_generators_from_args(args, with_positions=True)
 	test = td.big_batch_from_minibatch_generator(args, generate_test)
@@ -586,8 +585,8 @@ def train_ref_read_model(args):
 	else:
 		tensor_shape = (in_channels, args.read_limit, args.window_size) 
 
-	generate_train = td.tensor_generator(args, train_paths, tensor_shape)
-	generate_valid = td.tensor_generator(args, valid_paths, tensor_shape)
+	generate_train = td.minibatches_from_args(args, td.tensor_generator, args, train_paths, tensor_shape)
+	generate_valid = td.minibatches_from_args(args, td.tensor_generator, args, valid_paths, tensor_shape)
 
 	weight_path = arguments.weight_path_from_args(args)
 	model = models.build_read_tensor_2d_model(args)
@@ -619,8 +618,8 @@ def train_ref_read_b(args):
 	else:
 		tensor_shape = (in_channels, args.read_limit, args.window_size) 
 
-	generate_train = td.tensor_generator(args, train_paths, tensor_shape)
-	generate_valid = td.tensor_generator(args, valid_paths, tensor_shape)
+	generate_train = td.minibatches_from_args(args, td.tensor_generator, args, train_paths, tensor_shape)
+	generate_valid = td.minibatches_from_args(args, td.tensor_generator, args, valid_paths, tensor_shape)
 
 	weight_path = arguments.weight_path_from_args(args)
 	model = models.read_tensor_2d_model_from_args(args, 
@@ -664,8 +663,8 @@ def train_ref_read_c(args):
 	else:
 		tensor_shape = (in_channels, args.read_limit, args.window_size) 
 
-	generate_train = td.tensor_generator(args, train_paths, tensor_shape)
-	generate_valid = td.tensor_generator(args, valid_paths, tensor_shape)
+	generate_train = td.minibatches_from_args(args, td.tensor_generator, args, train_paths, tensor_shape)
+	generate_valid = td.minibatches_from_args(args, td.tensor_generator, args, valid_paths, tensor_shape)
 
 	weight_path = arguments.weight_path_from_args(args)
 	model = models.read_tensor_2d_model_from_args(args, 
@@ -765,8 +764,8 @@ def train_ref_read_inception_model(args):
 	else:
 		tensor_shape = (in_channels, args.read_limit, args.window_size) 
 
-	generate_train = td.tensor_generator(args, train_paths, tensor_shape)
-	generate_valid = td.tensor_generator(args, valid_paths, tensor_shape)
+	generate_train = td.minibatches_from_args(args, td.tensor_generator, args, train_paths, tensor_shape)
+	generate_valid = td.minibatches_from_args(args, td.tensor_generator, args, valid_paths, tensor_shape)
 
 	weight_path = arguments.weight_path_from_args(args)
 	model = models.build_read_tensor_2d_inception_model(args)
@@ -797,8 +796,8 @@ def train_ref_read_dilated_model(args):
 	else:
 		tensor_shape = (in_channels, args.read_limit, args.window_size) 
 
-	generate_train = td.tensor_generator(args, train_paths, tensor_shape)
-	generate_valid = td.tensor_generator(args, valid_paths, tensor_shape)
+	generate_train = td.minibatches_from_args(args, td.tensor_generator, args, train_paths, tensor_shape)
+	generate_valid = td.minibatches_from_args(args, td.tensor_generator, args, valid_paths, tensor_shape)
 
 	weight_path = arguments.weight_path_from_args(args)
 	model = models.build_read_tensor_2d_dilated_model(args)
@@ -855,8 +854,8 @@ def train_ref_read_annotation_exome_model(args):
 	else:
 		tensor_shape = (in_channels, args.read_limit, args.window_size) 
 
-	generate_train = td.tensor_annotation_generator(args, train_paths, tensor_shape)
-	generate_valid = td.tensor_annotation_generator(args, valid_paths, tensor_shape)
+	generate_train = td.minibatches_from_args(args, td.tensor_annotation_generator, args, train_paths, tensor_shape)
+	generate_valid = td.minibatches_from_args(args, td.tensor_annotation_generator, args, valid_paths, tensor_shape)
 
 	weight_path = arguments.weight_path_from_args(args)
 	model = models.build_read_tensor_2d_annotations_exome_model(args)
@@ -1207,8 +1206,8 @@ def bqsr_train_tensor(args):
 
 	train_paths, valid_paths, test_paths = td.get_train_valid_test_paths(args)
 
-	generate_train = td.bqsr_tensor_generator(args, train_paths)
-	generate_valid = td.bqsr_tensor_generator(args, valid_paths)
+	generate_train = td.minibatches_from_args(args, td.bqsr_tensor_generator, args, train_paths)
+	generate_valid = td.minibatches_from_args(args, td.bqsr_tensor_generator, args, valid_paths)
 
 	weight_path = arguments.weight_path_from_args(args)
 	model = models.build_bqsr_model(args)
@@ -1236,8 +1235,8 @@ def bqsr_train_annotation_tensor(args):
 
 	train_paths, valid_paths, test_paths = td.get_train_valid_test_paths(args)
 
-	generate_train = td.bqsr_tensor_annotation_generator(args, train_paths)
-	generate_valid = td.bqsr_tensor_annotation_generator(args, valid_paths)
+	generate_train = td.minibatches_from_args(args, td.bqsr_tensor_annotation_generator, args, train_paths)
+	generate_valid = td.minibatches_from_args(args, td.bqsr_tensor_annotation_generator, args, valid_paths)
 
 	weight_path = arguments.weight_path_from_args(args)
 	model = models.build_bqsr_annotation_model(args)
@@ -1264,8 +1263,8 @@ def bqsr_lstm_train_tensor(args):
 
 	train_paths, valid_paths, test_paths = td.get_train_valid_test_paths(args)
 
-	generate_train = td.bqsr_tensor_generator(args, train_paths)
-	generate_valid = td.bqsr_tensor_generator(args, valid_paths)
+	generate_train = td.minibatches_from_args(args, td.bqsr_tensor_generator, args, train_paths)
+	generate_valid = td.minibatches_from_args(args, td.bqsr_tensor_generator, args, valid_paths)
 
 	model = models.build_bqsr_lstm_model(args)
 	model = models.train_model_from_generators(args, model, generate_train, generate_valid, weight_path)
@@ -1325,8 +1324,8 @@ def roc_curve_through_learning(args):
 	else:
 		tensor_shape = (in_channels, args.read_limit, args.window_size) 
 
-	generate_train = td.tensor_annotation_generator(args, train_paths, tensor_shape)
-	generate_valid = td.tensor_annotation_generator(args, valid_paths, tensor_shape)
+	generate_train = td.minibatches_from_args(args, td.tensor_annotation_generator, args, train_paths, tensor_shape)
+	generate_valid = td.minibatches_from_args(args, td.tensor_annotation_generator, args, valid_paths, tensor_shape)
 
 	weight_path = arguments.weight_path_from_args(args)
 	model = models.build_read_tensor_2d_and_annotations_model(args)
@@ -1336,7 +1335,7 @@ def roc_curve_through_learning(args):
 		model.fit_generator(generate_train, 
 			samples_per_epoch=args.batch_size*2, nb_epoch=1, verbose=1, 
 			nb_val_samples=args.batch_size, validation_data=generate_valid,
-			callbacks=models.get_callbacks(weight_path, patience=4))
+			callbacks=models.get_callbacks(weight_path, patience=4), max_queue_size=td.batch_queue_size(args))
 		plots.plot_roc_per_class(model, [test[0], test[1], test[2]], test[3], args.labels, args.id+str(i), prefix='./figures/animations/')
 
 
@@ -1350,9 +1349,9 @@ def animate_learning_segmentation(args):
 	args.labels = defines.calling_labels
 	train_paths, valid_paths, test_paths = td.get_train_valid_test_paths_all(args)
 
-	generate_train = td.calling_tensors_generator(args, train_paths)
-	generate_valid = td.calling_tensors_generator(args, valid_paths)
-	generate_test = td.calling_tensors_generator(args, test_paths)
+	generate_train = td.minibatches_from_args(args, td.calling_tensors_generator, args, train_paths)
+	generate_valid = td.minibatches_from_args(args, td.calling_tensors_generator, args, valid_paths)
+	generate_test = td.minibatches_from_args(args, td.calling_tensors_generator, args, test_paths)
 
 	#model = models.build_2d_cnn_calling_segmentation_1d(args)
 	model = models.build_2d_cnn_calling_segmentation_full_2d(args)
@@ -1380,7 +1379,7 @@ def animate_learning_segmentation(args):
 
 		model.fit_generator(generate_train, 
 			steps_per_epoch=args.batch_size, epochs=1, verbose=1, 
-			validation_steps=args.batch_size*8, validation_data=generate_valid)
+			validation_steps=args.batch_size*8, validation_data=generate_valid, max_queue_size=td.batch_queue_size(args))
 
 
 def depristo_inception(args):
@@ -18,24 +18,47 @@ from __future__ import absolute_import
 # Imports
 import os
 import sys
-import vcf
+import copy
+import glob
+import hashlib
+import itertools
+import json
 import math
 import h5py
+import uuid
 import plots
 import errno
+import functools
 import pysam
+import atexit
 import random
+import shutil
 import defines
 import operator
 import arguments
+import tempfile
+import threading
+import traceback
+import time
 import numpy as np
+import multiprocessing
+
+try:
+	import queue
+except ImportError: # Python 2
+	import Queue as queue
 
 from random import shuffle
-from Bio import Seq, SeqIO
 from scipy.stats import norm
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 
 tensor_exts = ['.h5', '.hd5']
+image_exts = ['.png', '.jpg', '.jpeg', '.tif']
+shard_ext = '.shard.hd5'
+
+# Read only handles to tensor shards keyed by process id, see shard_file()
+open_shard_files = {}
+max_open_shard_files = 64
 
 p_lut = np.zeros((256,))
 not_p_lut = np.zeros((256,))
@@ -45,6 +68,11 @@ for i in range(256):
 	p_lut[i] = 1.0 - (10.0**exponent)
 	not_p_lut[i] = (1.0 - p_lut[i]) / 3.0
 
+# Cache of 256 entry DNA lookup tables, see dna_lookup_tables()
+dna_luts = {}
+# Cache of read base and quality lookup tables, see base_quality_lookup_table()
+base_quality_luts = {}
+
 
 def run_training_data():
 	'''Dispatch on args.mode command-line supplied recipe'''
@@ -52,11 +80,13 @@ def run_training_data():
 
 	# Writing tensor datasets for training
 	if 'write_tensors' == args.mode:
-		tensors_from_tensor_map(args)
+		scatter_tensor_writer(args, tensors_from_tensor_map)
+	elif 'write_cohort_tensors' == args.mode:
+		scatter_tensor_writer(args, cohort_tensors_from_tensor_map)
 	elif 'write_tensors_2bit' == args.mode:
 		tensors_from_tensor_map_2channel(args, include_annotations=True)
 	elif 'write_tensors_no_annotations' == args.mode:
-		tensors_from_tensor_map(args, include_annotations=False)
+		scatter_tensor_writer(args, tensors_from_tensor_map, include_annotations=False)
 	elif 'write_tensors_gnomad_annotations_1d' == args.mode:
 		tensors_from_tensor_map_gnomad_annos(args)
 	elif 'write_tensors_gnomad_annotations_per_allele_1d' == args.mode:
@@ -66,7 +96,7 @@ def run_training_data():
 	elif 'write_calling_tensors' == args.mode:
 		calling_tensors_from_tensor_map(args)
 	elif 'write_pileup_filter_tensors' == args.mode:
-		tensors_from_tensor_map(args, pileup=True)		
+		scatter_tensor_writer(args, tensors_from_tensor_map, pileup=True)		
 	elif 'write_calling_tensors_1d' == args.mode:
 		calling_tensors_from_tensor_map(args, pileup=True)		
 	elif 'write_dna_tensors' == args.mode:
@@ -81,14 +111,20 @@ def run_training_data():
 		bqsr_tensors_from_tensor_map(args, include_annotations=True)	
 	elif 'write_tranches' == args.mode:
 		write_tranches(args)
+	elif 'write_annotation_store' == args.mode:
+		write_annotation_store(args)
 
 	# Inspections			
 	elif 'inspect_tensors' == args.mode:
 		inspect_read_tensors(args)
 	elif 'inspect_dataset' == args.mode:
 		inspect_dataset(args)
+	elif 'merge_statistics' == args.mode:
+		merge_dataset_statistics(args)
 	elif 'inspect_gnomad' == args.mode:
 		inspect_gnomad_low_ac(args)
+	elif 'benchmark_compression' == args.mode:
+		benchmark_compression(args)
 	elif 'combine_vcfs' == args.mode:
 		combine_vcfs(args)	
 	
@@ -126,114 +162,343 @@ def tensors_from_tensor_map(args,
 	stats = Counter()
 	debug = False
 
-	samfile = pysam.AlignmentFile(args.bam_file, "rb")	
+	samfile = ReadWindowCache(args.bam_file)
 	bed_dict = bed_file_to_dict(args.bed_file)
-	record_dict = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
-	vcf_reader = vcf.Reader(open(args.negative_vcf, 'r'))
-	vcf_ram = vcf.Reader(open(args.train_vcf, 'r'))
+	reference = IndexedReference(args.reference_fasta)
+	vcf_reader = VariantReader(args.negative_vcf)
+	vcf_ram = VariantReader(args.train_vcf)
+	writer = tensor_writer_from_args(args)
+	manifest = WriteManifest(args, writer)
+	statistics = DatasetStatistics()
 
+	variants = manifest.resume(variants_from_args(args, vcf_reader), stats, statistics)
 
+	labeled_alleles = truth_labels_from_sorted_vcfs(variants, vcf_ram, bed_dict, stats, args.label_sites)
 
-	if args.chrom and not (args.start_pos and args.end_pos):
-		variants = vcf_reader.fetch(args.chrom)
-	elif args.chrom and args.start_pos and args.end_pos:
-		variants = vcf_reader.fetch(args.chrom, args.start_pos, args.end_pos)
-	else:
-		variants = vcf_reader
+	site = None
+	for variant, allele, cur_label_key in labeled_alleles:
+		allele_idx = variant.ALT.index(allele)
+		if site is None or site.variant is not variant:
+			site = SiteTensors(args, variant, samfile, reference, stats)
 
-	for variant in variants:
-		for allele_idx, allele in enumerate(variant.ALT):
-			idx_offset, ref_start, ref_end = get_variant_window(args, variant)
-			contig = record_dict[variant.CHROM]	
-			record = contig[ ref_start : ref_end ]
-
-			skip_this = False
-			reference_seq = record.seq
-			if reference_map is not None:
-				reference_tensor = np.zeros( (args.window_size, len(defines.inputs)) )
-				for i,b in enumerate(reference_seq):
-					if not args.use_lowercase_dna and b.islower():
-						skip_this = True
-						break						
-					b = b.upper()
-					if b in defines.inputs:
-						reference_tensor[i, defines.inputs[b]] = 1.0
-					elif b in defines.ambiguity_codes:
-						reference_tensor[i] = defines.ambiguity_codes[b]
-					else:
-						raise ValueError('Error! Unknown code:', b)
-			
-			if skip_this:
-				stats['Skipped lowercase DNA'] += 1
-				continue
+		if reference_map is not None and not args.use_lowercase_dna and has_lowercase(site.reference_seq):
+			stats['Skipped lowercase DNA'] += 1
+			continue
+		
+		if downsample(args, cur_label_key, stats, variant):
+			continue
 
-			if args.label_sites:
-				cur_label_key = get_true_site_label(variant, bed_dict, vcf_ram, stats)
-			else:
-				cur_label_key = get_true_allele_label(allele, variant, bed_dict, vcf_ram, stats)
-			
-			if not cur_label_key or downsample(args, cur_label_key, stats, variant):
+		if include_annotations:
+			annotation_data = {}
+			for a_set in annotation_sets:
+				annos = defines.annotations[a_set]
+				if not has_annotations(args, variant, annos):
+					stats['Missing ALL annotations'] += 1
+					continue # Require at least 1 annotation...
+				annotation_data[a_set] = get_annotation_data(args, variant, stats, allele_idx, annos)
+
+		read_tensors = {tt: site.read_tensor(tt) for tt in stored_tensor_types(args.tensor_types)}
+
+		tensor_path = get_path_to_train_valid_or_test(args, variant.CHROM)
+		tensor_prefix = plain_name(args.negative_vcf) +'_'+ plain_name(args.train_vcf) + '_allele_' + str(allele_idx) + '-' + cur_label_key 
+		tensor_path += cur_label_key + '/' + tensor_prefix + '-' + variant.CHROM + '_' + str(variant.POS) + '.hd5'
+		stats[cur_label_key] += 1
+
+		tensors = dict(read_tensors)
+		if include_annotations:
+			for a_set in annotation_sets:
+				tensors[a_set] = annotation_data[a_set]
+		if reference_map is not None:
+			tensors[reference_map] = site.reference_tensor()
+		if pileup:
+			tensors['pileup_tensor'] = site.pileup_tensor()
+		manifest.add(tensor_path, variant.CHROM, variant.POS, allele, args.tensor_types)
+		writer.write(tensor_path, tensors)
+		statistics.add(cur_label_key, variant, allele, annotation_data if include_annotations else {}, site.read_depth())
+	
+		stats['count'] += 1
+		if stats['count']%500 == 0:
+			print('Wrote', stats['count'], 'tensors out of', args.samples, ' last variant:', str(variant))
+		if stats['count'] >= args.samples:
+			break
+
+	writer.close()
+	manifest.close()
+	statistics.save(statistics_path_from_args(args))
+	for s in stats.keys():
+		print(s, 'has:', stats[s])
+	print('Generated tensors at:', args.data_dir, 'from vcf:', args.negative_vcf)
+	return stats
+
+
+def cohort_tensors_from_tensor_map(args, annotation_sets=None, reference_map='reference', include_annotations=True):
+	'''Write tensors for every sample of a cohort in a single pass over a joint called VCF.
+
+	Like tensors_from_tensor_map() but each site of args.negative_vcf is labeled and written 
+	for every sample in args.cohort_file that carries it, with reads from that sample's BAM.
+	The VCF, reference window and its encoding are parsed once per site rather than once per sample,
+	the BAM of every sample stays open for the whole pass. 
+	Tensor files are prefixed with the sample name and genotype annotations come from that sample.
+
+	Arguments
+		args.cohort_file: Tab separated file of sample name, BAM and optionally truth VCF and confident region BED for each sample
+		args.negative_vcf: Joint called VCF with a genotype for every sample in the cohort
+		annotation_sets: Annotation sets to write, defaults to args.annotation_set
+		Other arguments as in tensors_from_tensor_map()
+	'''
+	print('Writing cohort tensors with tensor type(s):', args.tensor_types, 'channel map.')
+	stats = Counter()
+	cohort = cohort_from_args(args)
+	reference = IndexedReference(args.reference_fasta)
+	vcf_reader = VariantReader(args.negative_vcf)
+	writer = tensor_writer_from_args(args)
+	manifest = WriteManifest(args, writer)
+	statistics = DatasetStatistics()
+	sample_name = args.sample_name
+	annotation_sets = annotation_sets or [args.annotation_set]
+
+	variants = manifest.resume(variants_from_args(args, vcf_reader), stats, statistics)
+	labeled_alleles = cohort_truth_labels_from_sorted_vcfs(variants, cohort, stats, args.label_sites)
+
+	site = None
+	for variant, sample, allele, cur_label_key in labeled_alleles:
+		allele_idx = variant.ALT.index(allele)
+		if site is None or site.variant is not variant:
+			site = SiteTensors(args, variant, None, reference, stats)
+			sample_sites = {}
+		if sample.name not in sample_sites:
+			sample_sites[sample.name] = site.with_reads_from(sample.samfile)
+
+		if reference_map is not None and not args.use_lowercase_dna and has_lowercase(site.reference_seq):
+			stats['Skipped lowercase DNA'] += 1
+			continue
+		if downsample(args, cur_label_key, stats, variant):
+			continue
+
+		tensors = {}
+		if include_annotations:
+			args.sample_name = sample.name
+			for a_set in annotation_sets:
+				tensors[a_set] = get_annotation_data(args, variant, stats, allele_idx, defines.annotations[a_set])
+			args.sample_name = sample_name
+		sample_site = sample_sites[sample.name]
+		for tt in stored_tensor_types(args.tensor_types):
+			tensors[tt] = sample_site.read_tensor(tt)
+		if reference_map is not None:
+			tensors[reference_map] = site.reference_tensor()
+
+		tensor_path = get_path_to_train_valid_or_test(args, variant.CHROM)
+		tensor_prefix = sample.name.replace('-', '.') + '_' + plain_name(args.negative_vcf) + '_allele_' + str(allele_idx) + '-' + cur_label_key 
+		tensor_path += cur_label_key + '/' + tensor_prefix + '-' + variant.CHROM + '_' + str(variant.POS) + '.hd5'
+		stats[cur_label_key] += 1
+		stats[sample.name] += 1
+
+		manifest.add(tensor_path, variant.CHROM, variant.POS, sample.name + ':' + str(allele), args.tensor_types)
+		writer.write(tensor_path, tensors)
+		statistics.add(cur_label_key, variant, allele, {a_set: tensors[a_set] for a_set in annotation_sets if a_set in tensors}, sample_site.read_depth())
+
+		stats['count'] += 1
+		if stats['count']%500 == 0:
+			print('Wrote', stats['count'], 'tensors out of', args.samples, ' last variant:', str(variant), 'sample:', sample.name)
+		if stats['count'] >= args.samples:
+			break
+
+	writer.close()
+	manifest.close()
+	statistics.save(statistics_path_from_args(args))
+	for s in stats.keys():
+		print(s, 'has:', stats[s])
+	print('Generated cohort tensors at:', args.data_dir, 'from vcf:', args.negative_vcf, 'for', len(cohort), 'samples.')
+	return stats
+
+
+class CohortSample(object):
+	'''A sample of a cohort with its open BAM, truth vcf and confident region.'''
+	def __init__(self, name, bam_file, truth_vcf, bed_dict, open_bam=True):
+		self.name = name
+		self.bam_file = bam_file
+		self.samfile = ReadWindowCache(bam_file) if open_bam else None
+		self.truth_vcf = VariantReader(truth_vcf)
+		self.bed_dict = bed_dict
+
+
+def cohort_from_args(args, open_bams=True):
+	'''Read the samples of a cohort from args.cohort_file.
+
+	Each line has tab separated sample name and BAM file, optionally followed by a truth VCF and confident region BED,
+	which default to args.train_vcf and args.bed_file. Empty lines and lines starting with # are skipped.
+	Samples sharing a BED share the parsed intervals.
+
+	Arguments:
+		args.cohort_file: The cohort file
+		open_bams: If False the BAMs are not opened, e.g. to only label sites
+
+	Returns:
+		cohort: list of CohortSample
+	'''
+	cohort = []
+	bed_dicts = {}
+	with open(args.cohort_file) as f:
+		for line in f:
+			fields = line.strip().split('\t')
+			if not fields[0] or fields[0].startswith('#'):
 				continue
+			if len(fields) not in [2, 4]:
+				raise ValueError('Error! Cohort file lines need sample name, BAM and optionally truth VCF and BED, got:', line)
+			name, bam_file = fields[:2]
+			truth_vcf, bed_file = fields[2:] if len(fields) == 4 else (args.train_vcf, args.bed_file)
+			if bed_file not in bed_dicts:
+				bed_dicts[bed_file] = bed_file_to_dict(bed_file)
+			cohort.append(CohortSample(name, bam_file, truth_vcf, bed_dicts[bed_file], open_bams))
+	return cohort
 
-			if include_annotations:
-				annotation_data = {}
-				for a_set in annotation_sets:
-					annos = defines.annotations[a_set]
-					if all(map(lambda x: x not in variant.INFO and x not in variant.FORMAT and x != "QUAL", annos)):
-						stats['Missing ALL annotations'] += 1
-						continue # Require at least 1 annotation...
-					annotation_data[a_set] = get_annotation_data(args, variant, stats, allele_idx, annos)
-
-			read_tensors = {}
-			for tt in args.tensor_types:
-				args.tensor_map = tt
-				if 'read_tensor' == tt:
-					read_tensors[tt] = make_reference_and_reads_tensor(args, variant, samfile, record.seq, ref_start, stats)
-				elif 'paired_reads' == tt:	
-					read_tensors[tt] = make_paired_read_tensor(args, variant, samfile, record.seq, ref_start, ref_end, stats)
-				elif 'reads_only' == tt:
-					args.tensor_map = 'read_tensor'
-					rt = make_reference_and_reads_tensor(args, variant, samfile, record.seq, ref_start, stats)	
-					args.tensor_map = tt
-					read_tensors[tt] = rt[:len(defines.get_tensor_channel_map_from_args(args)), :, :]
-				elif 'reads_reference' == tt:
-					args.tensor_map = 'read_tensor'
-					rt = make_reference_and_reads_tensor(args, variant, samfile, record.seq, ref_start, stats)
-					args.tensor_map = tt
-					read_tensors[tt] = rt[:len(defines.get_tensor_channel_map_from_args(args)), :, :]				
-				else:
-					raise ValueError("Unknown read tensor mapping."+tt)
 
-			tensor_path = get_path_to_train_valid_or_test(args, variant.CHROM)
-			tensor_prefix = plain_name(args.negative_vcf) +'_'+ plain_name(args.train_vcf) + '_allele_' + str(allele_idx) + '-' + cur_label_key 
-			tensor_path += cur_label_key + '/' + tensor_prefix + '-' + variant.CHROM + '_' + str(variant.POS) + '.hd5'
-			stats[cur_label_key] += 1
+def scatter_tensor_writer(args, writer, **writer_kwargs):
+	'''Write tensors in parallel by scattering genomic intervals of the negative VCF over a process pool.
 
-			if not os.path.exists(os.path.dirname(tensor_path)):
-				os.makedirs(os.path.dirname(tensor_path))
-			with h5py.File(tensor_path, 'w') as hf:
-				for rt in read_tensors:
-					if read_tensors[rt] is not None:
-						hf.create_dataset(rt, data=read_tensors[rt], compression='gzip')
-				if include_annotations:
-					for a_set in annotation_sets:
-						hf.create_dataset(a_set, data=annotation_data[a_set], compression='gzip')
-				if reference_map is not None:
-					hf.create_dataset(reference_map, data=reference_tensor, compression='gzip')
-				if pileup:
-					pileup_tensor = read_tensor_to_pileup(args, read_tensor)
-					hf.create_dataset('pileup_tensor', data=pileup_tensor, compression='gzip')
+	Each worker runs the writer on its own interval by setting args.chrom, args.start_pos and args.end_pos,
+	so every worker opens its own BAM, VCF, BED and reference handles.
+	The stats Counters returned by each worker are merged into a single report.
 
-			stats['count'] += 1
-			if stats['count']%500 == 0:
-				print('Wrote', stats['count'], 'tensors out of', args.samples, ' last variant:', str(variant))
-			if stats['count'] >= args.samples:
-				break
+	Arguments
+		args.write_workers: Number of processes to write with, if less than 2 the writer is called directly
+		args.write_interval_size: Size in base pairs of the genomic intervals handed to each worker
+		args.samples: Maximum number of tensors to write, split among the intervals in proportion to their size, see samples_per_interval()
+		args.target_counts: If given the downsampling rates are planned first, see plan_downsampling()
+		writer: The tensor writing function, must take args and return a stats Counter
+		writer_kwargs: Keyword arguments passed along to the writer
 
-		for s in stats.keys():
-			print(s, 'has:', stats[s])
-		if variant:
-			print('Generated tensors at:', args.data_dir, '\nLast variant:', str(variant), 'from vcf:', args.negative_vcf)
+	Returns
+		stats: Counter merged from all the workers
+	'''
+	if args.target_counts:
+		plan_downsampling(args)
+
+	if args.write_workers < 2:
+		return writer(args, **writer_kwargs)
+
+	intervals = scatter_intervals_from_args(args)
+	budgets = samples_per_interval(args.samples, intervals)
+	jobs = [(args, writer, writer_kwargs, interval, budget, args.random_seed+i) 
+			for i, (interval, budget) in enumerate(zip(intervals, budgets)) if budget > 0]
+	print('Scattering', len(jobs), 'intervals of', args.write_interval_size, 'base pairs over', args.write_workers, 'processes.')
+
+	stats = Counter()
+	pool = multiprocessing.Pool(args.write_workers)
+	try:
+		for i, interval_stats in enumerate(pool.imap_unordered(write_tensors_in_interval, jobs)):
+			stats.update(interval_stats)
+			print('Finished', i+1, 'of', len(jobs), 'intervals, total tensors written:', stats['count'])
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+	print('\nMerged stats from', len(jobs), 'intervals:')
+	for s in sorted(stats.keys()):
+		print(s, 'has:', stats[s])
+	print('Generated tensors at:', args.data_dir, 'from vcf:', args.negative_vcf)
+	return stats
+
+
+def write_tensors_in_interval(job):
+	'''Worker for scatter_tensor_writer, runs the writer on a single genomic interval.
+
+	Arguments
+		job: tuple of (args, writer, writer_kwargs, interval, samples, random_seed) 
+			where interval is a tuple of (contig, start, end) and samples the number of tensors the interval may write
+
+	Returns
+		stats: Counter returned by the writer
+	'''
+	args, writer, writer_kwargs, interval, samples, random_seed = job
+	args = copy.copy(args)
+	args.chrom, args.start_pos, args.end_pos = interval
+	args.samples = samples
+	np.random.seed(random_seed)
+	return writer(args, **writer_kwargs)
+
+
+def samples_per_interval(samples, intervals):
+	'''Split a budget of tensors among genomic intervals in proportion to their size.
+
+	Remainders go to the intervals with the largest fractional share, so the budgets add up to samples.
+
+	Arguments
+		samples: Total number of tensors to write
+		intervals: list of (contig, start, end) tuples
+
+	Returns
+		budgets: list with the number of tensors each interval may write
+	'''
+	sizes = np.array([end-start for _, start, end in intervals], dtype=np.float64)
+	if len(intervals) == 0 or sizes.sum() == 0:
+		return [0]*len(intervals)
+	shares = samples * sizes / sizes.sum()
+	budgets = np.floor(shares).astype(np.int64)
+	for i in np.argsort(budgets - shares, kind='mergesort')[:int(samples - budgets.sum())]:
+		budgets[i] += 1
+	return budgets.tolist()
+
+
+def scatter_intervals_from_args(args):
+	'''Split the contigs of the negative VCF into intervals for parallel tensor writing.
+
+	Contig lengths come from the reference FASTA index (.fai), 
+	only contigs present in the tabix index of the negative VCF are included.
+
+	Arguments
+		args.chrom: Only scatter over this chromosome (optional)
+		args.start_pos: Only scatter after this position (optional, requires args.chrom and args.end_pos)
+		args.end_pos: Only scatter before this position (optional, requires args.chrom)
+		args.write_interval_size: Size in base pairs of each interval
+
+	Returns
+		intervals: list of (contig, start, end) tuples
+	'''
+	fasta = pysam.FastaFile(args.reference_fasta)
+	vcf_contigs = set(pysam.TabixFile(args.negative_vcf).contigs)
+
+	intervals = []
+	for contig, length in zip(fasta.references, fasta.lengths):
+		if contig not in vcf_contigs or (args.chrom and contig != args.chrom):
+			continue
+
+		start, end = 0, length
+		if args.chrom and args.end_pos:
+			start, end = args.start_pos, min(args.end_pos, length)
+
+		for interval_start in range(start, end, args.write_interval_size):
+			intervals.append((contig, interval_start, min(interval_start+args.write_interval_size, end)))
+	
+	fasta.close()
+	return intervals
+
+
+def variants_from_args(args, vcf_reader):
+	'''Get the variants to write tensors from, optionally restricted to an interval.
+
+	When an interval is given only variants starting inside it are returned,
+	so variants spanning the boundary of adjacent intervals are not written twice.
+
+	Arguments
+		args.chrom: Only get variants from this chromosome (optional)
+		args.start_pos: Only get variants starting at or after this 0-based position (optional)
+		args.end_pos: Only get variants starting before this 0-based position (optional)
+		vcf_reader: the indexed VCF to get variants from
+
+	Returns
+		variants: iterable of variants
+	'''
+	if args.chrom and args.end_pos:
+		variants = vcf_reader.fetch(args.chrom, args.start_pos, args.end_pos)
+		return (v for v in variants if args.start_pos < v.POS <= args.end_pos)
+	elif args.chrom:
+		return vcf_reader.fetch(args.chrom)
+	else:
+		return vcf_reader
 
 
 def calling_tensors_from_tensor_map(args, pileup=False):
@@ -256,22 +521,22 @@ def calling_tensors_from_tensor_map(args, pileup=False):
 	print('Writing tensors for Variant Calling from tensor channel map:', args.tensor_map)
 	stats = Counter()
 
-	vcf_ram = vcf.Reader(open(args.train_vcf, 'r'))
-	samfile = pysam.AlignmentFile(args.bam_file, "rb")	
-	record_dict = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
+	vcf_ram = VariantReader(args.train_vcf)
+	samfile = ReadWindowCache(args.bam_file)
+	reference = IndexedReference(args.reference_fasta)
+	writer = tensor_writer_from_args(args)
+	manifest = WriteManifest(args, writer)
 
 	tensor_channel_map = defines.get_tensor_channel_map_from_args(args)
 	
-	cur_pos = args.start_pos
-	contig = record_dict[args.chrom]		
-	label_vector = np.zeros((args.window_size,))
+	window_starts = range(args.start_pos, args.end_pos - args.window_size, args.window_size)
 
-	while cur_pos < args.end_pos - args.window_size:
+	for cur_pos in manifest.resume(window_starts, stats):
 		
 		skip_this = False
-		label_vector[:] = defines.calling_labels['REFERENCE']
+		label_vector = np.full((args.window_size,), defines.calling_labels['REFERENCE'], dtype=float)
 		
-		record = contig[cur_pos : cur_pos+args.window_size]
+		reference_seq = reference.fetch(args.chrom, cur_pos, cur_pos+args.window_size)
 		
 		cur_labels = []
 		known_inserts = {}
@@ -338,13 +603,11 @@ def calling_tensors_from_tensor_map(args, pileup=False):
 			skip_this = True
 
 		if skip_this:
-			cur_pos += args.window_size
 			continue	
 
 		for l in cur_labels:
 			stats[l] += 1	
 
-		reference_seq = record.seq
 		for i in sorted(insert_dict.keys(), key=int, reverse=True):
 			if i < 0:
 				reference_seq = defines.indel_char*insert_dict[i] + reference_seq
@@ -358,21 +621,16 @@ def calling_tensors_from_tensor_map(args, pileup=False):
 		read_tensor = good_reads_to_tensor(args, good_reads, cur_pos, insert_dict)
 		reference_sequence_into_tensor(args, reference_seq, read_tensor)
 
-		tensor_path = get_path_to_train_valid_or_test(args.data_dir, variant.CHROM)	
+		tensor_path = get_path_to_train_valid_or_test(args, args.chrom)	
 		tensor_prefix = 'calling_tensor_' + plain_name(args.bam_file) +'_'+ plain_name(args.train_vcf) 
 		tensor_path += tensor_prefix + '-' + args.chrom + '_' + str(cur_pos) + '_' +str(cur_pos+args.window_size) + '.hd5'
 
-		if not os.path.exists(os.path.dirname(tensor_path)):
-			os.makedirs(os.path.dirname(tensor_path))
-		with h5py.File(tensor_path, 'w') as hf:
-			if pileup:
-				pileup_tensor = read_tensor_to_pileup(args, read_tensor)
-				hf.create_dataset('pileup_tensor', data=pileup_tensor, compression='gzip')
-			else:
-				hf.create_dataset(args.tensor_map, data=read_tensor, compression='gzip')
-			hf.create_dataset('site_labels', data=label_vector, compression='gzip')
+		manifest.add(tensor_path, args.chrom, cur_pos, 'window', [args.tensor_map])
+		if pileup:
+			writer.write(tensor_path, {'pileup_tensor':read_tensor_to_pileup(args, read_tensor), 'site_labels':label_vector})
+		else:
+			writer.write(tensor_path, {args.tensor_map:read_tensor, 'site_labels':label_vector})
 		
-		cur_pos += args.window_size
 		stats['count'] += 1
 		if stats['count']%400 == 0:
 			print('Wrote', stats['count'], 'calling tensors out of', args.samples)
@@ -386,6 +644,8 @@ def calling_tensors_from_tensor_map(args, pileup=False):
 		if stats['count'] >= args.samples:
 			break
 	
+	writer.close()
+	manifest.close()
 	if stats['count'] > 0:
 		print('Done generating tensors from vcf:', args.train_vcf, 'count is:', stats['count'])
 
@@ -420,20 +680,20 @@ def tensors_from_tensor_map_gnomad_annos(args):
 	gnomads = gnomads_to_dict(args)
 
 	#bed_dict = bed_file_to_dict(args.bed_file)
-	record_dict = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
-	#vcf_reader = vcf.Reader(open(args.negative_vcf, 'r'))
-	vcf_ram = vcf.Reader(open(args.train_vcf, 'r'))
-	vcf_omni = vcf.Reader(open(defines.omni_vcf, 'r'))
-	vcf_mills = vcf.Reader(open(defines.mills_vcf, 'r')) 
+	reference = IndexedReference(args.reference_fasta)
+	#vcf_reader = VariantReader(args.negative_vcf)
+	vcf_ram = VariantReader(args.train_vcf)
+	vcf_omni = VariantReader(defines.omni_vcf)
+	vcf_mills = VariantReader(defines.mills_vcf) 
 	tensor_channel_map = defines.get_tensor_channel_map() 
+	writer = tensor_writer_from_args(args, compression=None)
 
 	variants = gnomads[args.chrom].fetch(args.chrom, args.start_pos, args.end_pos)
 
 	for variant in variants:
 		idx_offset, ref_start, ref_end = get_variant_window(args, variant)
 
-		contig = record_dict[variant.CHROM]	
-		record = contig[variant.POS-idx_offset: variant.POS+idx_offset]
+		record_seq = reference.fetch(variant.CHROM, variant.POS-idx_offset, variant.POS+idx_offset)
 
 		# annotation_variant = variant_in_vcf(variant, gnomads[variant.CHROM])
 		# if not annotation_variant:
@@ -474,25 +734,14 @@ def tensors_from_tensor_map_gnomad_annos(args):
 			if a == "DP" or a == "QUAL":
 				 annotation_data[i] /= qual_and_dp_normalizer
 
-		dna_data = np.zeros( (args.window_size, len(defines.inputs)) )
-		for i,b in enumerate(record.seq):
-			if b in defines.inputs:
-				dna_data[i, defines.inputs[b]] = 1.0
-			elif b in defines.ambiguity_codes:
-				dna_data[i] = defines.ambiguity_codes[b]
-			else:
-				raise ValueError('Error! Unknown code:', b)
+		dna_data = encode_dna(record_seq, defines.inputs, args.window_size, uppercase=False)
 
 		tensor_path = get_path_to_train_valid_or_test(args, variant.CHROM)	
 		tensor_prefix = plain_name(defines.omni_vcf) + '-' + cur_label_key 
 		tensor_path += cur_label_key + '/' + tensor_prefix + '-' + variant.CHROM + '_' + str(variant.POS) + '.hd5'
 		stats[cur_label_key] += 1
 
-		if not os.path.exists(os.path.dirname(tensor_path)):
-			os.makedirs(os.path.dirname(tensor_path))
-		with h5py.File(tensor_path, 'w') as hf:
-			hf.create_dataset(args.annotation_set, data=annotation_data)
-			hf.create_dataset(args.tensor_map, data=dna_data)
+		writer.write(tensor_path, {args.annotation_set:annotation_data, args.tensor_map:dna_data})
 
 		stats['count'] += 1
 		if stats['count']%400 == 0:
@@ -500,6 +749,7 @@ def tensors_from_tensor_map_gnomad_annos(args):
 		if stats['count'] >= args.samples:
 			break
 
+	writer.close()
 	for s in stats.keys():
 		print(s, 'has:', stats[s])
 	print('Done generating gnomAD annotated tensors. Last variant:', str(variant), 'count is:', stats['count'])
@@ -533,11 +783,12 @@ def tensors_from_tensor_map_gnomad_annos_per_allele(args, include_reads=True, in
 
 	gnomads = gnomads_to_dict(args)
 
-	samfile = pysam.AlignmentFile(args.bam_file, "rb")	
+	samfile = ReadWindowCache(args.bam_file)
 	bed_dict = bed_file_to_dict(args.bed_file)
-	record_dict = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
-	vcf_reader = vcf.Reader(open(args.negative_vcf, 'r'))
-	vcf_ram = vcf.Reader(open(args.train_vcf, 'r'))
+	reference = IndexedReference(args.reference_fasta)
+	vcf_reader = VariantReader(args.negative_vcf)
+	vcf_ram = VariantReader(args.train_vcf)
+	writer = tensor_writer_from_args(args, compression=None)
 
 	tensor_channel_map = defines.get_tensor_channel_map() 
 
@@ -550,8 +801,7 @@ def tensors_from_tensor_map_gnomad_annos_per_allele(args, include_reads=True, in
 		for allele_index, allele in enumerate(variant.ALT):
 			idx_offset, ref_start, ref_end = get_variant_window(args, variant)
 
-			contig = record_dict[variant.CHROM]	
-			record = contig[variant.POS-idx_offset: variant.POS+idx_offset]
+			record_seq = reference.fetch(variant.CHROM, variant.POS-idx_offset, variant.POS+idx_offset)
 
 			cur_label_key = get_true_allele_label(allele, variant, bed_dict, vcf_ram, stats)
 			if not cur_label_key or downsample(args, cur_label_key, stats):
@@ -585,19 +835,11 @@ def tensors_from_tensor_map_gnomad_annos_per_allele(args, include_reads=True, in
 						 annotation_data[i] /= as_normalizer
 
 			if include_reference:
-				dna_data = np.zeros( (args.window_size, len(defines.inputs)) )
-				for i,b in enumerate(record.seq):
-					if b in defines.inputs:
-						dna_data[i, defines.inputs[b]] = 1.0
-					elif b in defines.ambiguity_codes:
-						dna_data[i] = defines.ambiguity_codes[b]
-					else:
-						raise ValueError('Error! Unknown code:', b)
-						
+				dna_data = encode_dna(record_seq, defines.inputs, args.window_size, uppercase=False)
 			
 			if include_reads:
 				good_reads, insert_dict = get_good_reads(args, samfile, variant)
-				reference_seq = record.seq
+				reference_seq = record_seq
 				for i in sorted(insert_dict.keys(), key=int, reverse=True):
 					reference_seq = reference_seq[:i] + defines.indel_char*insert_dict[i] + reference_seq[i:]
 
@@ -614,21 +856,20 @@ def tensors_from_tensor_map_gnomad_annos_per_allele(args, include_reads=True, in
 					add_flags_to_read_tensor(args, read_tensor, tensor_channel_map, flags)
 					add_mq_to_read_tensor(args, read_tensor, tensor_channel_map, mapping_qualities)
 
-			tensor_path = get_path_to_train_valid_or_test(args.data_dir, variant.CHROM)	
+			tensor_path = get_path_to_train_valid_or_test(args, variant.CHROM)	
 			tensor_prefix = plain_name(args.negative_vcf) +'_'+ plain_name(args.train_vcf) +'_allele_'+ str(allele_index) + '-' + cur_label_key 
 			tensor_path += cur_label_key + '/' + tensor_prefix + '-' + variant.CHROM + '_' + str(variant.POS) + '.hd5'
 			stats[cur_label_key] += 1
 			stats['Allele index '+str(allele_index)] += 1
 
-			if not os.path.exists(os.path.dirname(tensor_path)):
-				os.makedirs(os.path.dirname(tensor_path))
-			with h5py.File(tensor_path, 'w') as hf:
-				if include_reads:
-					hf.create_dataset(args.tensor_map, data=read_tensor)
-				if include_annotations:
-					hf.create_dataset(args.annotation_set, data=annotation_data)
-				if include_reference:
-					hf.create_dataset('reference', data=dna_data)
+			tensors = {}
+			if include_reads:
+				tensors[args.tensor_map] = read_tensor
+			if include_annotations:
+				tensors[args.annotation_set] = annotation_data
+			if include_reference:
+				tensors['reference'] = dna_data
+			writer.write(tensor_path, tensors)
 
 			stats['count'] += 1
 			if stats['count']%400 == 0:
@@ -636,6 +877,7 @@ def tensors_from_tensor_map_gnomad_annos_per_allele(args, include_reads=True, in
 			if stats['count'] >= args.samples:
 				break
 
+	writer.close()
 	for s in stats.keys():
 		print(s, 'has:', stats[s])
 	print('Done generating gnomAD annotated tensors. Last variant:', str(variant), 'from vcf:', args.negative_vcf, 'count is:', stats['count'])
@@ -668,11 +910,12 @@ def tensors_from_tensor_map_2channel(args, include_annotations=True):
 
 	args.input_symbols = defines.dna_2bit
 
-	samfile = pysam.AlignmentFile(args.bam_file, "rb")	
+	samfile = ReadWindowCache(args.bam_file)
 	bed_dict = bed_file_to_dict(args.bed_file)
-	record_dict = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
-	vcf_reader = vcf.Reader(open(args.negative_vcf, 'r'))
-	vcf_ram = vcf.Reader(open(args.train_vcf, 'r'))
+	reference = IndexedReference(args.reference_fasta)
+	vcf_reader = VariantReader(args.negative_vcf)
+	vcf_ram = VariantReader(args.train_vcf)
+	writer = tensor_writer_from_args(args, compression=None)
 	
 	tensor_channel_map = defines.get_tensor_channel_map_from_args(args)
 
@@ -684,21 +927,20 @@ def tensors_from_tensor_map_2channel(args, include_annotations=True):
 	for variant in variants:
 		for allele_idx, allele in enumerate(variant.ALT):
 			idx_offset, ref_start, ref_end = get_variant_window(args, variant)
-			contig = record_dict[variant.CHROM]	
-			record = contig[ ref_start : ref_end ]
+			record_seq = reference.fetch(variant.CHROM, ref_start, ref_end)
 
 			cur_label_key = get_true_site_label(variant, bed_dict, vcf_ram, stats)
 			if not cur_label_key or downsample(args, cur_label_key, stats):
 				continue
 
 			if include_annotations:
-				if all(map(lambda x: x not in variant.INFO and x not in variant.FORMAT and x != "QUAL", args.annotations)):
+				if not has_annotations(args, variant, args.annotations):
 					stats['Missing ALL annotations'] += 1
 					continue # Require at least 1 annotation...
 				annotation_data = get_annotation_data(args, variant, stats)
 
 			good_reads, insert_dict = get_good_reads(args, samfile, variant)
-			reference_seq = record.seq
+			reference_seq = record_seq
 			for i in sorted(insert_dict.keys(), key=int, reverse=True):
 				reference_seq = reference_seq[:i] + defines.indel_char*insert_dict[i] + reference_seq[i:]
 
@@ -713,17 +955,15 @@ def tensors_from_tensor_map_2channel(args, include_annotations=True):
 					read_tensor[:6,:,:] = reads_to_2bit_tensor(args, sequences, qualities, reference_seq)
 				add_flags_to_read_tensor(args, read_tensor, tensor_channel_map, flags)
 				add_mq_to_read_tensor(args, read_tensor, tensor_channel_map, mapping_qualities)
-				tensor_path = get_path_to_train_valid_or_test(args.data_dir, variant.CHROM)	
+				tensor_path = get_path_to_train_valid_or_test(args, variant.CHROM)	
 				tensor_prefix = plain_name(args.negative_vcf) +'_'+ plain_name(args.train_vcf) +'_allele_'+ str(allele_index) +'-'+ cur_label_key 
 				tensor_path += cur_label_key + '/' + tensor_prefix + '-' + variant.CHROM + '_' + str(variant.POS) + '.hd5'
 				stats[cur_label_key] += 1
 
-				if not os.path.exists(os.path.dirname(tensor_path)):
-					os.makedirs(os.path.dirname(tensor_path))
-				with h5py.File(tensor_path, 'w') as hf:
-					hf.create_dataset(args.tensor_map, data=read_tensor)
-					if include_annotations:
-						hf.create_dataset(args.annotation_set, data=annotation_data)
+				tensors = {args.tensor_map:read_tensor}
+				if include_annotations:
+					tensors[args.annotation_set] = annotation_data
+				writer.write(tensor_path, tensors)
 				
 				if debug:
 					print('Reads:', len(good_reads), 'count:', stats['count'],  'Variant:', variant.CHROM, variant.POS, variant.REF, variant.ALT, '\n')
@@ -737,6 +977,7 @@ def tensors_from_tensor_map_2channel(args, include_annotations=True):
 				if stats['count'] >= args.samples:
 					break
 
+	writer.close()
 	for s in stats.keys():
 		print(s, 'has:', stats[s])
 	print('Done generating tensors. Last variant:', str(variant), 'from vcf:', args.negative_vcf, 'count is:', stats['count'])
@@ -764,10 +1005,10 @@ def bqsr_tensors_from_tensor_map(args, include_annotations=False):
 	stats = Counter()
 
 	samfile = pysam.AlignmentFile(args.bam_file, "rb")	
-	vcf_ram = vcf.Reader(open(args.train_vcf, 'r'))
+	vcf_ram = VariantReader(args.train_vcf)
 	bed_dict = bed_file_to_dict(args.bed_file)
-	record_dict = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
-	contig = record_dict[args.chrom]
+	reference = IndexedReference(args.reference_fasta)
+	writer = tensor_writer_from_args(args, compression=None)
 
 	tensor_channel_map = defines.bqsr_tensor_channel_map() 
 
@@ -783,7 +1024,7 @@ def bqsr_tensors_from_tensor_map(args, include_annotations=False):
 			continue
 
 		for ref_pos, read_idx in zip(read.get_reference_positions(), range(len(read.query_sequence))):	
-			if contig[ref_pos] != read.query_sequence[read_idx]:
+			if reference.fetch(args.chrom, ref_pos, ref_pos+1) != read.query_sequence[read_idx]:
 				variants = vcf_ram.fetch(args.chrom, ref_pos-1, ref_pos+1)
 				in_vcf = False
 				for v in variants:
@@ -802,7 +1043,7 @@ def bqsr_tensors_from_tensor_map(args, include_annotations=False):
 
 			stats[cur_label_key] += 1
 
-			ref_string = contig.seq[ref_pos-args.window_size:ref_pos]
+			ref_string = reference.fetch(args.chrom, ref_pos-args.window_size, ref_pos)
 			read_string = read.query_sequence[max(0,read_idx-args.window_size) : read_idx]
 			read_qualities = read.query_alignment_qualities[max(0,read_idx-args.window_size) : read_idx].tolist()
 			if read_idx-args.window_size < 0:
@@ -830,12 +1071,10 @@ def bqsr_tensors_from_tensor_map(args, include_annotations=False):
 			tensor_path = get_path_to_train_valid_or_test(args, args.chrom)	
 			tensor_prefix = plain_name(args.bam_file) +'_'+ plain_name(args.train_vcf) + '-' + cur_label_key 
 			tensor_path += cur_label_key + '/' + tensor_prefix + '-' + args.chrom + '_' + str(ref_pos) + '.hd5'
-			if not os.path.exists(os.path.dirname(tensor_path)):
-				os.makedirs(os.path.dirname(tensor_path))
-			with h5py.File(tensor_path, 'w') as hf:
-				hf.create_dataset(args.tensor_map, data=read_tensor)
-				if include_annotations:
-					hf.create_dataset(args.annotation_set, data=annotation_data)
+			tensors = {args.tensor_map:read_tensor}
+			if include_annotations:
+				tensors[args.annotation_set] = annotation_data
+			writer.write(tensor_path, tensors)
 		
 			stats['count'] += 1
 			if stats['count']%400 == 0:
@@ -845,6 +1084,7 @@ def bqsr_tensors_from_tensor_map(args, include_annotations=False):
 		if stats['count'] >= args.samples:
 			break
 	
+	writer.close()
 	for k in stats.keys():
 		print('%s has %d' %(k, stats[k]))
 
@@ -855,10 +1095,11 @@ def write_dna_and_annotations(args, include_dna=True, include_annotations=True):
 	debug = False
 	stats = Counter()
 
-	record_dict = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
-	vcf_reader = vcf.Reader(open(args.negative_vcf, 'r'))
-	vcf_ram = vcf.Reader(open(args.train_vcf, 'r'))
+	reference = IndexedReference(args.reference_fasta)
+	vcf_reader = VariantReader(args.negative_vcf)
+	vcf_ram = VariantReader(args.train_vcf)
 	bed_dict = bed_file_to_dict(args.bed_file)
+	writer = tensor_writer_from_args(args)
 
 	idx_offset = (args.window_size//2)
 
@@ -870,47 +1111,37 @@ def write_dna_and_annotations(args, include_dna=True, include_annotations=True):
 	for variant in variants:
 		for allele_idx, allele in enumerate(variant.ALT):
 			idx_offset, ref_start, ref_end = get_variant_window(args, variant)
-			contig = record_dict[variant.CHROM]	
-			record = contig[variant.POS-idx_offset: variant.POS+idx_offset]
+			record_seq = reference.fetch(variant.CHROM, variant.POS-idx_offset, variant.POS+idx_offset)
 
 			cur_label_key = get_true_label(allele, variant, bed_dict, vcf_ram, stats)
 			if not cur_label_key or downsample(args, cur_label_key, stats):
 				continue
 
 			if include_annotations:
-				if all(map(lambda x: x not in variant.INFO and x not in variant.FORMAT and x != "QUAL", args.annotations)):
+				if not has_annotations(args, variant, args.annotations):
 					stats['Missing ALL annotations'] += 1
 					continue # Require at least 1 annotation...
 				annotation_data = get_annotation_data(args, variant, stats)
 
 			if include_dna:
-				dna_data = np.zeros( (args.window_size, len(defines.inputs)) )
-				for i,b in enumerate(record.seq):
-					if b in defines.inputs:
-						dna_data[i, defines.inputs[b]] = 1.0
-					elif b in defines.ambiguity_codes:
-						dna_data[i] = defines.ambiguity_codes[b]
-					else:
-						raise ValueError('Error! Unknown code:', b)
-						
+				dna_data = encode_dna(record_seq, defines.inputs, args.window_size, uppercase=False)
 
-			tensor_path = get_path_to_train_valid_or_test(args.data_dir)
+			tensor_path = get_path_to_train_valid_or_test(args, variant.CHROM)
 			tensor_path += cur_label_key +'/'+ plain_name(args.negative_vcf) +'_'+ plain_name(args.train_vcf) 
 			tensor_path += '_allele_' + str(allele_idx) +'-'+ variant.CHROM +'_'+ str(variant.POS) + '.hd5'
-			if not os.path.exists(os.path.dirname(tensor_path)):
-				os.makedirs(os.path.dirname(tensor_path))
 
 			if debug:
 				print('Try to write tensor to:', tensor_path)
-				print('Sequence was:', record.seq)
+				print('Sequence was:', record_seq)
 				print('DNA tensor is:', dna_data)
 				print('Annotation tensor is:', annotation_data)
 
-			with h5py.File(tensor_path, 'w') as hf:
-				if include_annotations:
-					hf.create_dataset(args.annotation_set, data=annotation_data, compression='gzip')
-				if include_dna:
-					hf.create_dataset(args.tensor_map, data=dna_data, compression='gzip')
+			tensors = {}
+			if include_annotations:
+				tensors[args.annotation_set] = annotation_data
+			if include_dna:
+				tensors[args.tensor_map] = dna_data
+			writer.write(tensor_path, tensors)
 			
 			stats[cur_label_key] += 1
 			stats['count'] += 1
@@ -919,6 +1150,7 @@ def write_dna_and_annotations(args, include_dna=True, include_annotations=True):
 			if args.samples == stats['count']:
 				break
 
+	writer.close()
 	print('Done Writing. DNA:', include_dna,' and Annotations:',include_annotations, ' Wanted: ', args.samples)
 	for k in stats.keys():
 		print(k, ' has:', stats[k])
@@ -928,20 +1160,27 @@ def write_dna_multisource_annotations(args, include_dna=True, include_annotation
 	debug = False
 	stats = Counter()
 
-	record_dict = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
-	vcf_reader = vcf.Reader(open(args.negative_vcf, 'r'))
-	vcf_ram = vcf.Reader(open(args.train_vcf, 'r'))
+	reference = IndexedReference(args.reference_fasta)
+	vcf_reader = VariantReader(args.negative_vcf)
+	vcf_ram = VariantReader(args.train_vcf)
 	bed_dict = bed_file_to_dict(args.bed_file)
+	writer = tensor_writer_from_args(args, compression=None)
 
 	idx_offset = (args.window_size//2)
 
 	channel_map = defines.get_tensor_channel_map_from_args(args)
 
 	# Get bed file dicts
-	bed_dicts = {}
-	for b in channel_map.keys():
+	bed_channels = [b for b in sorted(channel_map, key=channel_map.get) if b not in defines.inputs]
+	bed_dicts = []
+	for b in bed_channels:
 		if os.path.exists(b) and os.path.splitext(b)[1].lower() == '.bed':
-			bed_dicts[b] = bed_file_to_dict(b)
+			bed_dicts.append(bed_file_to_dict(b))
+		else:
+			print('Warning! Channel:', b, 'is not DNA and not a bed file, it will be left empty.')
+			bed_dicts.append({}) # Empty bed dicts rasterize to all zeros
+	bed_rasterizer = BedRasterizer(bed_dicts, args.bed_bitsets)
+	dna_symbols = {b: channel_map[b] for b in channel_map if b in defines.inputs}
 
 	# Do we need to fetch a particular region of the genome?	
 	if args.chrom:
@@ -952,67 +1191,54 @@ def write_dna_multisource_annotations(args, include_dna=True, include_annotation
 	for variant in variants:
 		for allele_idx, allele in enumerate(variant.ALT):
 			idx_offset, ref_start, ref_end = get_variant_window(args, variant)
-			contig = record_dict[variant.CHROM]	
-			record = contig[variant.POS-idx_offset: variant.POS+idx_offset+(args.window_size%2)]
+			record_seq = reference.fetch(variant.CHROM, variant.POS-idx_offset, variant.POS+idx_offset+(args.window_size%2))
 
 			cur_label_key = get_true_label(allele, variant, bed_dict, vcf_ram, stats)
 			if not cur_label_key or downsample(args, cur_label_key, stats):
 				continue		
 
-		if include_annotations:
-			if all(map(lambda x: x not in annotation_variant.INFO and x != "QUAL", args.annotations)):
-				stats['Missing ALL annotations'] += 1
-				continue # Require at least 1 annotation...
-			annotation_data = get_annotation_data(args, variant, stats)
-
-		if include_dna:
-			dna_data = np.zeros( (args.window_size, len(channel_map)) )
-			for i,b in enumerate(record.seq):
-				# Get the reference DNA for the first 4 channels
-				if b in channel_map:
-					dna_data[i, channel_map[b]] = 1.0
-				elif b in defines.ambiguity_codes:
-					dna_data[i] = defines.ambiguity_codes[b]
-				else:
-					raise ValueError('Error! Unknown code:', b)
-					
+			if include_annotations:
+				if not has_annotations(args, variant, args.annotations):
+					stats['Missing ALL annotations'] += 1
+					continue # Require at least 1 annotation...
+				annotation_data = get_annotation_data(args, variant, stats)
 
+			if include_dna:
+				dna_data = np.zeros( (args.window_size, len(channel_map)) )
+				# Get the reference DNA for the first 4 channels
+				dna_data[:, :len(dna_symbols)] = encode_dna(record_seq, dna_symbols, args.window_size, uppercase=False)
 				# Add data to remaining channels from bed files	
-				ref_i = variant.POS-idx_offset + i
-				for k in channel_map.keys():
-					if k in defines.inputs:
-						continue
-					if in_bed_file(bed_dicts[k], variant.CHROM, ref_i):
-						dna_data[i, channel_map[k]] = 1.0 # TODO: update this to read a value from the bed file
+				window_start = variant.POS-idx_offset
+				dna_data[:, len(dna_symbols):] = bed_rasterizer.window(variant.CHROM, window_start, window_start+args.window_size)
 
-		tensor_path = get_path_to_train_valid_or_test(args.data_dir)	
-		tensor_prefix = plain_name(args.negative_vcf) +'_'+ plain_name(args.train_vcf) +'_allele_'+ str(allele_idx) +'_'+ cur_label_key 
-		tensor_path += cur_label_key + '/' + tensor_prefix + '-' + variant.CHROM + '_' + str(variant.POS) + '.hd5'
-		if not os.path.exists(os.path.dirname(tensor_path)):
-			os.makedirs(os.path.dirname(tensor_path))
+			tensor_path = get_path_to_train_valid_or_test(args, variant.CHROM)	
+			tensor_prefix = plain_name(args.negative_vcf) +'_'+ plain_name(args.train_vcf) +'_allele_'+ str(allele_idx) +'_'+ cur_label_key 
+			tensor_path += cur_label_key + '/' + tensor_prefix + '-' + variant.CHROM + '_' + str(variant.POS) + '.hd5'
 
-		if debug:
-			print('Try to write tensor to:', tensor_path)
-			print('Sequence was:', record.seq)
-			if include_dna:
-				print('DNA tensor is:\n', dna_data)
-				print('DNA Column sums are:', np.sum(dna_data, axis=0))
-			if include_annotations:
-				print('Annotation tensor is:', annotation_data)
+			if debug:
+				print('Try to write tensor to:', tensor_path)
+				print('Sequence was:', record_seq)
+				if include_dna:
+					print('DNA tensor is:\n', dna_data)
+					print('DNA Column sums are:', np.sum(dna_data, axis=0))
+				if include_annotations:
+					print('Annotation tensor is:', annotation_data)
 
-		with h5py.File(tensor_path, 'w') as hf:
+			tensors = {}
 			if include_annotations:
-				hf.create_dataset(args.annotation_set, data=annotation_data)
+				tensors[args.annotation_set] = annotation_data
 			if include_dna:
-				hf.create_dataset(args.tensor_map, data=dna_data)
-		
-		stats[cur_label_key] += 1
-		stats['count'] += 1
-		if stats['count']%500==0:
-			print('Wrote', stats['count'], 'out of:', args.samples, 'Last variant:', variant)
-		if args.samples == stats['count']:
-			break
+				tensors[args.tensor_map] = dna_data
+			writer.write(tensor_path, tensors)
+			
+			stats[cur_label_key] += 1
+			stats['count'] += 1
+			if stats['count']%500==0:
+				print('Wrote', stats['count'], 'out of:', args.samples, 'Last variant:', variant)
+			if args.samples == stats['count']:
+				break
 
+	writer.close()
 	print('Done writing reference tensors')
 	for k in stats.keys():
 		print('Label:', k, 'Got', stats[k], ' examples.')
@@ -1044,11 +1270,11 @@ def nist_samples_to_png(args):
 	debug = False
 	stats = Counter()
 
-	samfile = pysam.AlignmentFile(args.bam_file, "rb")	
-	vcf_reader = vcf.Reader(open(args.negative_vcf, 'r'))
-	vcf_ram = vcf.Reader(open(args.train_vcf, 'r'))
+	samfile = ReadWindowCache(args.bam_file)
+	vcf_reader = VariantReader(args.negative_vcf)
+	vcf_ram = VariantReader(args.train_vcf)
 	bed_dict = bed_file_to_dict(args.bed_file)
-	record_dict = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
+	reference = IndexedReference(args.reference_fasta)
 
 	if args.chrom:
 		variants  = vcf_reader.fetch(args.chrom, args.start_pos, args.end_pos)
@@ -1058,8 +1284,7 @@ def nist_samples_to_png(args):
 	for variant in variants:
 		for allele_idx, allele in enumerate(variant.ALT):
 			idx_offset, ref_start, ref_end = get_variant_window(args, variant)
-			contig = record_dict[variant.CHROM]	
-			record = contig[ ref_start : ref_end ]
+			record_seq = reference.fetch(variant.CHROM, ref_start, ref_end)
 
 			cur_label_key = get_true_label(allele, variant, bed_dict, vcf_ram, stats)
 			if not cur_label_key or downsample(args, cur_label_key, stats):
@@ -1071,7 +1296,7 @@ def nist_samples_to_png(args):
 
 			stats[cur_label_key] += 1
 			good_reads, insert_dict = get_good_reads(args, samfile, variant)
-			reference_seq = record.seq
+			reference_seq = record_seq
 			for i in sorted(insert_dict.keys(), key=int, reverse=True):
 				if i < 0:
 					reference_seq = defines.indel_char*insert_dict[i] + reference_seq
@@ -1105,6 +1330,288 @@ def nist_samples_to_png(args):
 	print('Done generating images. Last variant:', str(variant), 'from vcf:', args.negative_vcf, 'count is:', stats['count'])
 
 
+class IndexedReference(object):
+	'''Random access to a reference FASTA through its .fai index, instead of SeqIO.to_dict().
+
+	Sequence is read on demand with pysam.FastaFile, so nothing is parsed up front.
+	A block of the current contig is cached so sorted iteration reads each base from disk about once.
+	Returned sequence keeps the case of the FASTA file, so soft-masked (lowercase) bases can be detected.
+	'''
+	def __init__(self, reference_fasta, cache_size=10000000):
+		self.fasta = pysam.FastaFile(reference_fasta)
+		self.lengths = dict(zip(self.fasta.references, self.fasta.lengths))
+		self.cache_size = cache_size
+		self.contig = None
+		self.cache_start = 0
+		self.cache = ''
+
+	def fetch(self, contig, start, end):
+		'''Return the reference sequence on contig from 0-based start to exclusive end as a string.'''
+		start = max(0, start)
+		end = min(end, self.lengths[contig])
+		if contig != self.contig or start < self.cache_start or end > self.cache_start+len(self.cache):
+			self.contig = contig
+			self.cache_start = start
+			self.cache = self.fasta.fetch(contig, start, max(end, start+self.cache_size))
+		return self.cache[start-self.cache_start : end-self.cache_start]
+
+	def contig_length(self, contig):
+		return self.lengths[contig]
+
+	def close(self):
+		self.fasta.close()
+
+
+class VariantReader(object):
+	'''Read a VCF with htslib through pysam.VariantFile, yielding VariantRecords.
+
+	Replaces vcf.Reader from PyVCF, which parses every record and all its sample columns in pure Python.
+	Iterating and fetch() have the same arguments and 0-based coordinates as vcf.Reader.
+	'''
+	def __init__(self, vcf_file):
+		self.vcf = pysam.VariantFile(vcf_file)
+		self.header = self.vcf.header
+		self.samples = list(self.header.samples)
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		return VariantRecord(next(self.vcf))
+
+	next = __next__ # Python 2
+
+	def fetch(self, contig, start=None, end=None):
+		'''Iterate over the records overlapping contig from 0-based start to end, needs a tabix index.'''
+		return (VariantRecord(r) for r in self.vcf.fetch(contig, start, end))
+
+	def add_filters_from(self, other):
+		'''Add the FILTER definitions of another VariantReader's header, so its filters can be set on this reader's records.'''
+		for name, f in other.header.filters.items():
+			if name not in self.header.filters:
+				self.header.filters.add(name, None, None, f.description)
+
+	def close(self):
+		self.vcf.close()
+
+
+class VariantRecord(object):
+	'''A pysam.VariantRecord with the attributes of a PyVCF record that the tensor writers use.
+
+	CHROM, POS, REF and ALT are set up front, QUAL, FILTER, INFO and FORMAT are read from the record when asked for.
+	Sample columns are only decoded for the samples and fields that are accessed, through genotype().
+	'''
+	def __init__(self, record):
+		self.record = record
+		self.CHROM = record.contig
+		self.POS = record.pos
+		self.REF = record.ref
+		self.ALT = list(record.alts) if record.alts else [None]
+
+	@property
+	def ID(self):
+		return self.record.id
+
+	@property
+	def QUAL(self):
+		return self.record.qual
+
+	@QUAL.setter
+	def QUAL(self, qual):
+		self.record.qual = qual
+
+	@property
+	def FILTER(self):
+		'''None if the filter is missing, an empty list if it PASSed, like PyVCF.'''
+		filters = list(self.record.filter.keys())
+		if not filters:
+			return None
+		return [f for f in filters if f != 'PASS']
+
+	@FILTER.setter
+	def FILTER(self, filters):
+		self.record.filter.clear()
+		if filters is not None:
+			for f in filters or ['PASS']:
+				self.record.filter.add(f)
+
+	@property
+	def INFO(self):
+		return self.record.info
+
+	@property
+	def FORMAT(self):
+		return ':'.join(self.record.format.keys()) or None
+
+	@property
+	def samples(self):
+		return [VariantCall(self.record.samples[s]) for s in self.record.samples]
+
+	def genotype(self, sample_name):
+		return VariantCall(self.record.samples[sample_name])
+
+	def get_hets(self):
+		'''The heterozygous calls of the record, like PyVCF.'''
+		return [call for call in self.samples if call.gt_type == 1]
+
+	def get_hom_alts(self):
+		'''The homozygous alternate calls of the record, like PyVCF.'''
+		return [call for call in self.samples if call.gt_type == 2]
+
+	@property
+	def is_sv(self):
+		return self.record.info.get('SVTYPE') is not None
+
+	@property
+	def is_snp(self):
+		if len(self.REF) > 1:
+			return False
+		for alt in self.ALT:
+			if alt is None or alt not in ['A', 'C', 'G', 'T', 'N', '*']:
+				return False
+		return True
+
+	@property
+	def is_indel(self):
+		is_sv = self.is_sv
+		if len(self.REF) > 1 and not is_sv:
+			return True
+		for alt in self.ALT:
+			if alt is None:
+				return True
+			if alt_type(alt) not in ['SNV', 'MNV']:
+				return False
+			elif len(alt) != len(self.REF):
+				return not is_sv
+		return False
+
+	@property
+	def is_deletion(self):
+		if len(self.ALT) > 1:
+			return False
+		if self.is_indel:
+			return self.ALT[0] is None or len(self.REF) > len(self.ALT[0])
+		return False
+
+	def __str__(self):
+		return 'Record(CHROM=%s, POS=%s, REF=%s, ALT=[%s])' % (self.CHROM, self.POS, self.REF, ', '.join(map(str, self.ALT)))
+
+
+def alt_type(alt):
+	'''PyVCF's type of an alternate allele: SV for symbolic alleles, BND for breakends, otherwise SNV or MNV.'''
+	if alt.startswith('<') and alt.endswith('>'):
+		return 'SV'
+	if '[' in alt or ']' in alt or (len(alt) > 1 and (alt.startswith('.') or alt.endswith('.'))):
+		return 'BND'
+	return 'SNV' if len(alt) == 1 else 'MNV'
+
+
+class VariantCall(object):
+	'''The call of one sample at a record, a PyVCF style view of a pysam.VariantRecordSample.'''
+	def __init__(self, sample):
+		self.sample = sample
+		self.data = VariantCallData(sample)
+
+	@property
+	def called(self):
+		alleles = self.sample.allele_indices
+		return alleles is not None and len(alleles) > 0 and None not in alleles
+
+	@property
+	def gt_type(self):
+		'''0 for homozygous reference, 1 for heterozygous, 2 for homozygous alternate and None if not called.'''
+		if not self.called:
+			return None
+		alleles = set(self.sample.allele_indices)
+		if alleles == set([0]):
+			return 0
+		return 2 if len(alleles) == 1 else 1
+
+	@property
+	def is_variant(self):
+		if not self.called:
+			return None
+		return self.gt_type != 0
+
+
+class VariantCallData(object):
+	'''FORMAT fields of a call as attributes, decoded when read. Multi-valued fields are lists and GT is a string, like PyVCF.'''
+	def __init__(self, sample):
+		self._sample = sample
+
+	def __getattr__(self, key):
+		if key.startswith('_') or key not in self._sample:
+			raise AttributeError(key)
+		if key == 'GT':
+			alleles = self._sample.allele_indices
+			if alleles is None or len(alleles) == 0:
+				return None
+			return ('|' if self._sample.phased else '/').join('.' if a is None else str(a) for a in alleles)
+		value = self._sample[key]
+		return list(value) if isinstance(value, tuple) else value
+
+
+class VariantWriter(object):
+	'''Write VariantRecords with pysam.VariantFile using the header of a VariantReader, like vcf.Writer.'''
+	def __init__(self, vcf_file, template):
+		self.vcf = pysam.VariantFile(vcf_file, 'w', header=template.header)
+
+	def write_record(self, variant):
+		self.vcf.write(variant.record)
+
+	def close(self):
+		self.vcf.close()
+
+
+class ReadWindowCache(object):
+	'''Sliding window of BAM reads for queries in sorted order, a drop in replacement for samfile.fetch().
+
+	Reads come from one forward iterator over the contig, so each BGZF block is decoded
+	and each read is built by pysam only once, however many variant windows overlap it.
+	Reads are kept in an ordered buffer until they end before the start of a query.
+	A query on a new contig, or one that starts before the previous query, restarts the iterator.
+	'''
+	def __init__(self, bam_file):
+		self.samfile = pysam.AlignmentFile(bam_file, 'rb')
+		self.contig = None
+		self.start = 0
+		self.reads = []
+		self.iterator = iter([])
+		self.next_read = None
+
+	def fetch(self, contig, start, end):
+		'''Return a list of the reads overlapping contig from 0-based start to exclusive end, in file order.'''
+		if contig != self.contig or start < self.start:
+			self.contig = contig
+			self.reads = []
+			self.iterator = self.samfile.fetch(contig, max(0, start), multiple_iterators=True)
+			self.next_read = next(self.iterator, None)
+		self.start = start
+
+		while self.next_read is not None and self.next_read.reference_start < end:
+			self.reads.append((self.next_read, read_end(self.next_read)))
+			self.next_read = next(self.iterator, None)
+
+		self.reads = [(read, stop) for read, stop in self.reads if stop > start]
+		return [read for read, stop in self.reads if read.reference_start < end]
+
+	def count(self, contig, start, end):
+		return len(self.fetch(contig, start, end))
+
+	def close(self):
+		self.samfile.close()
+
+
+def read_end(read):
+	'''Exclusive end of a read in reference coordinates, like htslib uses for BAM index queries.
+
+	Unmapped reads and alignments that consume no reference occupy their start position.
+	'''
+	if read.reference_end is None or read.reference_end <= read.reference_start:
+		return read.reference_start + 1
+	return read.reference_end
+
+
 def get_variant_window(args, variant):
 	index_offset = (args.window_size//2)
 	reference_start = (variant.POS-1)-index_offset
@@ -1135,54 +1642,149 @@ def get_annotation_data(args, annotation_variant, stats, allele_index=0, overrid
 	else:
 		annos = args.annotations
 
+	extractor = annotation_extractor(annos, annotation_variant, args.sample_name)
 	annotation_data = np.zeros(( len(annos), ))
+	extractor.fill_row(annotation_variant, annotation_data, stats, allele_index)
+	return annotation_data
+
+
+def get_annotation_matrix(args, variants, stats, allele_indices=None, override_annotations=None, out=None):
+	'''Return a matrix with the annotation data of many variants from the same VCF, one row per variant.
 
-	for i,a in enumerate(annos):
+	Arguments:
+		args.annotations: List of variant annotations to use
+		variants: list of variants, VariantRecords or pysam records
+		stats: Counter of run statistics
+		allele_indices: optional allele index of each variant for allele specific annotations, defaults to 0
+		override_annotations: optional array of annotations to prevent using arg's annotations 
+		out: optional preallocated float array with a row for each variant, it is zeroed and filled
+
+	Returns:
+		annotation_data: numpy array of shape (len(variants), len(annotations))
+	'''
+	annos = args.annotations if override_annotations is None else override_annotations
+	if out is None:
+		out = np.zeros((len(variants), len(annos)))
+	if len(variants) > 0:
+		extractor = annotation_extractor(annos, variants[0], args.sample_name)
+		extractor.fill(variants, out, stats, allele_indices)
+	return out
+
+
+def has_annotations(args, variant, annotations):
+	'''True if variant has a value for at least one of the annotations in its INFO, FORMAT or QUAL.'''
+	return annotation_extractor(annotations, variant, args.sample_name).has_annotations(variant)
+
+
+# Compiled AnnotationExtractors keyed by annotations, sample and VCF header, see annotation_extractor()
+annotation_extractors = {}
+
+def annotation_extractor(annotations, variant, sample_name):
+	'''Return the AnnotationExtractor for these annotations and sample on the VCF header of variant, compiling it once.'''
+	header = pysam_record(variant).header
+	key = (tuple(annotations), sample_name, id(header))
+	if key not in annotation_extractors or annotation_extractors[key].header is not header:
+		annotation_extractors[key] = AnnotationExtractor(annotations, header, sample_name)
+	return annotation_extractors[key]
+
+
+def pysam_record(variant):
+	'''The pysam.VariantRecord behind a VariantRecord, or variant itself if it already is one.'''
+	return variant.record if isinstance(variant, VariantRecord) else variant
+
+
+class AnnotationExtractor(object):
+	'''Reads a list of annotations from the records of one VCF into float arrays.
+
+	Each annotation is resolved once against the VCF header to an INFO accessor and a FORMAT accessor
+	for args.sample_name, so filling a row is a loop over prebuilt functions rather than a 
+	chain of string comparisons and PyVCF style lookups for every field of every record.
+	Values are the ones get_annotation_data() has always returned: INFO values win unless missing or NaN, 
+	then the sample's FORMAT fields are used, annotations found in neither are left at zero and counted in stats.
+	'''
+	def __init__(self, annotations, header, sample_name):
+		self.header = header
+		self.annotations = list(annotations)
+		self.sample_name = sample_name
+		self.info_getters = [self.info_getter(a) for a in self.annotations]
+		self.format_getters = [self.format_getter(a) for a in self.annotations]
+		self.genotype_annotations = [genotype_annotation(a) for a in self.annotations]
+		self.info_keys = set(a for a in self.annotations if a in header.info)
+		self.format_keys = set(a for a in self.annotations if a in header.formats)
+
+	def info_getter(self, a):
 		if a == 'QUAL':
-			annotation_data[i] = annotation_variant.QUAL
+			return lambda record, allele_index: float('nan') if record.qual is None else record.qual
+		elif a not in self.header.info:
+			return None
 		elif a == 'AF':
-			annotation_data[i] = annotation_variant.INFO[a][0]
-		elif a in annotation_variant.INFO and not math.isnan(annotation_variant.INFO[a]):
-			annotation_data[i] = annotation_variant.INFO[a]
-		elif len(annotation_variant.samples) > 0:
-			call = annotation_variant.genotype(args.sample_name)
-			if a == 'MBQ' and hasattr(call.data, a):
-				if len(annotation_variant.ALT) > 1:
-					annotation_data[i] = call.data.MBQ[allele_index]
-				else:
-					annotation_data[i] = call.data.MBQ
-			elif a == 'MPOS' and hasattr(call.data, a):
-				if len(annotation_variant.ALT) > 1:
-					annotation_data[i] = call.data.MPOS[allele_index]
-				else:
-					annotation_data[i] = call.data.MPOS
-			elif a == 'MMQ' and hasattr(call.data, a):
-				if len(annotation_variant.ALT) > 1:
-					annotation_data[i] = call.data.MMQ[allele_index]
+			return lambda record, allele_index: first_value(record.info.get(a), 0)
+		return lambda record, allele_index: first_value(record.info.get(a), allele_index)
+
+	def format_getter(self, a):
+		formats = self.header.formats
+		if a in ['MBQ', 'MPOS', 'MMQ'] and a in formats:
+			return lambda call, allele_index: first_value(call.get(a), allele_index)
+		elif a in ['MFRL_0', 'AD_0', 'MBQ_0'] and a[:-2] in formats:
+			return lambda call, allele_index: first_value(call.get(a[:-2]), 0)
+		elif a in ['MFRL_1', 'AD_1'] and a[:-2] in formats:
+			return lambda call, allele_index: nth_value(call.get(a[:-2]), allele_index+1)
+		elif a == 'MBQ_1' and 'MBQ' in formats:
+			return lambda call, allele_index: nth_value(call.get('MBQ'), allele_index+1, scalar=False)
+		return None
+
+	def has_annotations(self, variant):
+		'''True if the record has a value for at least one of the annotations in INFO, FORMAT or QUAL.'''
+		record = pysam_record(variant)
+		if 'QUAL' in self.annotations:
+			return True
+		if any(a in record.info for a in self.info_keys):
+			return True
+		return any(a in record.format for a in self.format_keys)
+
+	def fill_row(self, variant, row, stats, allele_index=0):
+		'''Write the annotations of one variant into the float array row.'''
+		record = pysam_record(variant)
+		call = None
+		for i, a in enumerate(self.annotations):
+			if self.info_getters[i] is not None:
+				value = self.info_getters[i](record, allele_index)
+				if value is not None and (a == 'QUAL' or not math.isnan(value)):
+					row[i] = value
+					continue
+			if len(record.samples) > 0:
+				if call is None:
+					call = record.samples[self.sample_name]
+				value = None if self.format_getters[i] is None else self.format_getters[i](call, allele_index)
+				if value is not None:
+					row[i] = value
 				else:
-					annotation_data[i] = call.data.MMQ		
-			elif a == 'MFRL_0' and hasattr(call.data, 'MFRL'):
-				annotation_data[i] = call.data.MFRL[0] 
-			elif a == 'MFRL_1' and hasattr(call.data, 'MFRL'):
-				annotation_data[i] = call.data.MFRL[allele_index+1] 
-			elif a == 'AD_0' and hasattr(call.data, 'AD'):
-				annotation_data[i] = call.data.AD[0]
-			elif a == 'AD_1' and hasattr(call.data, 'AD'):
-				annotation_data[i] = call.data.AD[allele_index+1]				
-			elif a == 'MBQ_0' and hasattr(call.data, 'MBQ') and isinstance(call.data.MBQ, list):
-				annotation_data[i] = call.data.MBQ[0]
-			elif a == 'MBQ_0' and hasattr(call.data, 'MBQ') and not isinstance(call.data.MBQ, list):
-				annotation_data[i] = call.data.MBQ	
-			elif a == 'MBQ_1' and hasattr(call.data, 'MBQ') and isinstance(call.data.MBQ, list) and len(call.data.MBQ) > allele_index+1:
-				annotation_data[i] = call.data.MBQ[allele_index+1]	
+					stats['Could not handle genotyped annotation:'+a] += 1
+			elif self.genotype_annotations[i]:
+				raise ValueError('Genotype level annotations requested but variant has no sample (format) data.')
 			else:
-				stats['Could not handle genotyped annotation:'+a] += 1
-		elif len(annotation_variant.samples) == 0 and genotype_annotation(a):
-			raise ValueError('Genotype level annotations requested but variant has no sample (format) data.')
-		else:
-			stats['Could not handle annotation:'+a] += 1
+				stats['Could not handle annotation:'+a] += 1
 
-	return annotation_data
+	def fill(self, variants, out, stats, allele_indices=None):
+		'''Zero the preallocated float array out and write the annotations of the i-th variant into its i-th row.'''
+		out[:len(variants)] = 0
+		for i, variant in enumerate(variants):
+			self.fill_row(variant, out[i], stats, 0 if allele_indices is None else allele_indices[i])
+		return out
+
+
+def first_value(value, index):
+	'''A scalar annotation value, the index-th value of multi-valued fields, None if missing.'''
+	if isinstance(value, tuple):
+		value = value[index] if index < len(value) else None
+	return value
+
+
+def nth_value(value, index, scalar=True):
+	'''The index-th value of a multi-valued field, scalar fields are returned as is when scalar is True.'''
+	if not isinstance(value, tuple):
+		return value if scalar else None
+	return value[index] if index < len(value) else None
 
 
 def genotype_annotation(a):
@@ -1207,7 +1809,23 @@ def get_true_site_label(variant, bed_dict, truth_vcf, stats):
 			NOT_INDEL if variant is indel and not in truth vcf
 	'''
 	in_bed = in_bed_file(bed_dict, variant.CHROM, variant.POS)
-	if variant_in_vcf(variant, truth_vcf) and in_bed:
+	in_truth = variant_in_vcf(variant, truth_vcf) is not None
+	return site_label_from_truth(variant, in_bed, in_truth, stats)
+
+
+def site_label_from_truth(variant, in_bed, in_truth, stats):
+	'''Label a variant site given its truth status and whether it is in the confident region.
+
+	Arguments:
+		variant: the variant to label
+		in_bed: True if the variant is in the confident region
+		in_truth: True if the variant is in the truth vcf
+		stats: Counter dict used to keep track of the label distribution, etc.
+
+	Returns:
+		None if outside the confident region, otherwise a label string as in get_true_site_label()
+	'''
+	if in_truth and in_bed:
 		class_prefix = ''
 	elif in_bed:
 		class_prefix = 'NOT_'
@@ -1215,7 +1833,6 @@ def get_true_site_label(variant, bed_dict, truth_vcf, stats):
 		stats['Variant outside confident bed file'] += 1
 		return None
 
-
 	if variant.is_snp:
 		cur_label_key = class_prefix + 'SNP'
 	elif variant.is_indel:
@@ -1246,7 +1863,24 @@ def get_true_allele_label(allele, variant, bed_dict, truth_vcf, stats):
 			NOT_INDEL if variant is indel and not in truth vcf
 	'''
 	in_bed = in_bed_file(bed_dict, variant.CHROM, variant.POS)
-	if allele_in_vcf(allele, variant, truth_vcf) and in_bed:
+	in_truth = allele_in_vcf(allele, variant, truth_vcf) is not None
+	return allele_label_from_truth(allele, variant, in_bed, in_truth, stats)
+
+
+def allele_label_from_truth(allele, variant, in_bed, in_truth, stats):
+	'''Label a variant allele given its truth status and whether it is in the confident region.
+
+	Arguments:
+		allele: The allele to label
+		variant: the variant whose allele we label
+		in_bed: True if the variant is in the confident region
+		in_truth: True if the allele is in the truth vcf
+		stats: Counter dict used to keep track of the label distribution, etc.
+
+	Returns:
+		None if outside the confident region, otherwise a label string as in get_true_allele_label()
+	'''
+	if in_truth and in_bed:
 		class_prefix = ''
 	elif in_bed:
 		class_prefix = 'NOT_'
@@ -1254,15 +1888,137 @@ def get_true_allele_label(allele, variant, bed_dict, truth_vcf, stats):
 		stats['Variant outside confident bed file'] += 1
 		return None
 
-	if is_snp_allele(allele, variant):
-		cur_label_key = class_prefix + 'SNP'
-	elif is_indel_allele(allele, variant):
-		cur_label_key = class_prefix + 'INDEL'
-	else:
-		stats['Not SNP or INDEL'] += 1
-		return None
+	if is_snp_allele(allele, variant):
+		cur_label_key = class_prefix + 'SNP'
+	elif is_indel_allele(allele, variant):
+		cur_label_key = class_prefix + 'INDEL'
+	else:
+		stats['Not SNP or INDEL'] += 1
+		return None
+
+	return cur_label_key
+
+
+def truth_labels_from_sorted_vcfs(variants, truth_vcf, bed_dict, stats, label_sites=True):
+	'''Label variant alleles by walking position sorted variants and the truth vcf together.
+
+	Replaces a tabix fetch on the truth vcf for every allele with a single pass over the truth vcf,
+	see merge_join_vcf(). Alleles outside the confident region or neither SNP nor INDEL are counted in stats and skipped.
+
+	Arguments:
+		variants: position sorted iterable of variants, e.g. from variants_from_args()
+		truth_vcf: indexed vcf of validated variants
+		bed_dict: confident region dict defined by intervals e.g. from bed_file_to_dict()
+		stats: Counter dict used to keep track of the label distribution, etc.
+		label_sites: If True labels are for variant sites, as in get_true_site_label() 
+			otherwise labels are allele specific, as in get_true_allele_label()
+
+	Yields:
+		(variant, allele, label) tuples for each labeled allele
+	'''
+	for variant, truth_records in merge_join_vcf(variants, truth_vcf):
+		in_bed = in_bed_file(bed_dict, variant.CHROM, variant.POS)
+		for allele, cur_label_key in allele_labels_from_records(variant, truth_records, in_bed, stats, label_sites):
+			yield variant, allele, cur_label_key
+
+
+def allele_labels_from_records(variant, truth_records, in_bed, stats, label_sites=True, alleles=None):
+	'''Label the alleles of a variant given the truth vcf records at its position, see truth_labels_from_sorted_vcfs().
+
+	Arguments:
+		alleles: The alternate alleles to label, all of variant.ALT if None
+
+	Yields:
+		(allele, label) tuples for each labeled allele
+	'''
+	site_in_truth = variant_in_records(variant, truth_records) is not None
+	for allele in variant.ALT if alleles is None else alleles:
+		if label_sites:
+			cur_label_key = site_label_from_truth(variant, in_bed, site_in_truth, stats)
+		else:
+			in_truth = allele_in_records(allele, variant, truth_records) is not None
+			cur_label_key = allele_label_from_truth(allele, variant, in_bed, in_truth, stats)
+	
+		if cur_label_key:
+			yield allele, cur_label_key
+
+
+def cohort_truth_labels_from_sorted_vcfs(variants, cohort, stats, label_sites=True):
+	'''Label the alleles each sample of a cohort carries, walking the joint called variants once.
+
+	The variants are merge-joined with the truth vcf of every sample in lockstep, see merge_join_vcf().
+	Samples whose genotype is missing or homozygous reference at a site are skipped, 
+	and only the alternate alleles in a sample's genotype are labeled for it.
+
+	Arguments:
+		variants: position sorted iterable of joint called variants, e.g. from variants_from_args()
+		cohort: list of CohortSample from cohort_from_args()
+		stats: Counter dict used to keep track of the label distribution, etc.
+		label_sites: If True labels are for variant sites, otherwise labels are allele specific
+
+	Yields:
+		(variant, sample, allele, label) tuples for each labeled allele of each sample
+	'''
+	iterators = itertools.tee(variants, len(cohort))
+	joins = [merge_join_vcf(v, sample.truth_vcf) for v, sample in zip(iterators, cohort)]
+	for site in zip(*joins):
+		variant = site[0][0]
+		for sample, (_, truth_records) in zip(cohort, site):
+			call = variant.genotype(sample.name)
+			if not call.is_variant:
+				stats['Sample not variant at site'] += 1
+				continue
+			in_bed = in_bed_file(sample.bed_dict, variant.CHROM, variant.POS)
+			alleles = [variant.ALT[i-1] for i in sorted(set(call.sample.allele_indices)) if i > 0]
+			for allele, cur_label_key in allele_labels_from_records(variant, truth_records, in_bed, stats, label_sites, alleles):
+				yield variant, sample, allele, cur_label_key
+
+
+def merge_join_vcf(variants, other_vcf, contig_prefix=''):
+	'''Walk position sorted variants alongside the records of another indexed vcf.
+
+	The other vcf is streamed one contig at a time so each of its records is read once,
+	rather than fetched separately for every variant. 
+	If the variants go backwards (e.g. unsorted input) the other vcf is fetched again from the start of the contig.
+
+	Arguments:
+		variants: iterable of variants sorted by position within each contig
+		other_vcf: indexed vcf to join with, its fetch() must yield records sorted by position
+		contig_prefix: prefix added to contig names when fetching from other_vcf (e.g. 'chr')
+
+	Yields:
+		(variant, records) tuples where records is a list of all records in other_vcf 
+		on the same contig and at the same position as the variant
+	'''
+	contig = None
+	records = []
+	records_pos = None
+	for variant in variants:
+		if variant.CHROM != contig or variant.POS < records_pos:
+			contig = variant.CHROM
+			others = fetch_contig(other_vcf, contig_prefix+contig)
+			head = next(others, None)
+			records_pos = None
+
+		if variant.POS != records_pos:
+			while head is not None and head.POS < variant.POS:
+				head = next(others, None)
+			records = []
+			while head is not None and head.POS == variant.POS:
+				records.append(head)
+				head = next(others, None)
+			records_pos = variant.POS
+
+		yield variant, records
+
+
+def fetch_contig(vcf_reader, contig):
+	'''Return an iterator over the records of a contig, empty if the contig is not in the vcf index.'''
+	try:
+		return iter(vcf_reader.fetch(contig))
+	except (ValueError, KeyError):
+		return iter([])
 
-	return cur_label_key
 
 def downsample(args, cur_label_key, stats, variant=None):
 	'''Indicates whether or not to downsample a variant.
@@ -1309,22 +2065,152 @@ def downsample(args, cur_label_key, stats, variant=None):
 	return False
 
 
+downsample_arguments = {'SNP':'downsample_snps', 'INDEL':'downsample_indels', 'NOT_SNP':'downsample_not_snps', 'NOT_INDEL':'downsample_not_indels'}
+
+
+def target_counts_from_args(args):
+	'''Parse args.target_counts into a dict mapping labels to the number of examples wanted.
+
+	A single number is the target for every label in args.labels, otherwise each entry is LABEL=COUNT.
+	'''
+	if len(args.target_counts) == 1 and '=' not in args.target_counts[0]:
+		return {label: int(args.target_counts[0]) for label in args.labels}
+
+	targets = {}
+	for target in args.target_counts:
+		label, _, count = target.partition('=')
+		if label not in downsample_arguments or not count:
+			raise ValueError('Error! Target counts must be a number or LABEL=COUNT with a label in:', list(downsample_arguments.keys()), 'not:', target)
+		targets[label] = int(count)
+	return targets
+
+
+def count_candidate_labels(args):
+	'''Count the labels of the examples a tensor writer would consider, without touching the BAM.
+
+	Walks the negative VCF, truth VCF and confident region like tensors_from_tensor_map() does 
+	(or those of each sample like cohort_tensors_from_tensor_map()) and skips the alleles downsample() always skips.
+
+	Arguments:
+		args.negative_vcf, args.train_vcf, args.bed_file: Inputs of the tensor writer
+		args.cohort_file: If given count the examples of every sample in the cohort, see cohort_from_args()
+		args.chrom, args.start_pos, args.end_pos: Only count variants in this interval (optional)
+		args.label_sites: Label variant sites or alleles, see truth_labels_from_sorted_vcfs()
+
+	Returns:
+		counts: Counter mapping labels to the number of candidate examples
+	'''
+	counts = Counter()
+	vcf_reader = VariantReader(args.negative_vcf)
+	variants = variants_from_args(args, vcf_reader)
+	if args.cohort_file:
+		labeled = cohort_truth_labels_from_sorted_vcfs(variants, cohort_from_args(args, open_bams=False), Counter(), args.label_sites)
+		labeled_alleles = ((variant, allele, label) for variant, _, allele, label in labeled)
+	else:
+		vcf_ram = VariantReader(args.train_vcf)
+		labeled_alleles = truth_labels_from_sorted_vcfs(variants, vcf_ram, bed_file_to_dict(args.bed_file), Counter(), args.label_sites)
+	for variant, allele, cur_label_key in labeled_alleles:
+		if args.skip_positive_class and cur_label_key in ['SNP', 'INDEL']:
+			continue
+		if args.multiallelics == 'ignore' and len(variant.ALT) > 1:
+			continue
+		counts[cur_label_key] += 1
+	return counts
+
+
+def plan_downsampling(args):
+	'''Set the downsampling rates so a tensor writer keeps about args.target_counts examples of each label.
+
+	A cheap planning pass counts the candidates of each label from the VCFs alone, see count_candidate_labels(),
+	then each label is kept at the rate target/count (at most 1.0).
+	Since downsample() is applied before any reads are fetched, no BAM I/O is spent on examples that are thrown away.
+	Labels without a target keep their args.downsample_* rate.
+
+	Arguments:
+		args.target_counts: Targets, see target_counts_from_args()
+
+	Returns:
+		rates: dict mapping labels to the fraction of examples kept
+	'''
+	targets = target_counts_from_args(args)
+	counts = count_candidate_labels(args)
+	rates = {}
+	for label in targets:
+		if label not in downsample_arguments:
+			continue
+		rates[label] = min(1.0, targets[label] / max(1, counts[label]))
+		setattr(args, downsample_arguments[label], rates[label])
+		print('Planned', label, 'keeping', min(targets[label], counts[label]), 'of', counts[label], 'candidates at rate:', rates[label])
+
+	if args.write_workers < 2 and sum(min(targets[l], counts[l]) for l in rates) > args.samples:
+		print('Warning! Target counts add up to more than args.samples:', args.samples, 'the writer will stop before reaching them.')
+	return rates
+
+
 def make_reference_tensor(args, reference_seq):
-	reference_tensor = np.zeros( (args.window_size, len(defines.inputs)) )
-	
-	for i,b in enumerate(reference_seq):
-		if i >= args.window_size:
-			break
-			
-		b = b.upper()
-		if b in defines.inputs:
-			reference_tensor[i, defines.inputs[b]] = 1.0
-		elif b in defines.ambiguity_codes:
-			reference_tensor[i] = defines.ambiguity_codes[b]
-		else:
-			raise ValueError('Error! Unknown code:', b)
+	return encode_dna(reference_seq, defines.inputs, args.window_size)
+
+
+def dna_lookup_tables(symbols, uppercase=True):
+	'''Get 256 entry lookup tables which map the bytes of a DNA string to their encoding.
+
+	Symbols are one hot encoded, IUPAC ambiguity codes are encoded by defines.ambiguity_codes in the first 4 channels.
+	Tables are built once for each symbol dict and cached in dna_luts.
 
-	return reference_tensor
+	Arguments:
+		symbols: Dict mapping input symbols to their channel index e.g. defines.inputs
+		uppercase: If True lowercase bases are encoded like their uppercase versions
+
+	Returns:
+		(lut, known): lut is a (256, channels) array of encodings, 
+			known is a (256,) boolean array which is False for unknown bytes
+	'''
+	key = (tuple(sorted(symbols.items())), uppercase)
+	if key not in dna_luts:
+		lut = np.zeros((256, len(set(symbols.values()))))
+		known = np.zeros((256,), dtype=bool)
+		for b, encoding in defines.ambiguity_codes.items():
+			for c in set([b, b.lower()] if uppercase else [b]):
+				lut[ord(c), :4] = encoding
+				known[ord(c)] = True
+		for b, i in symbols.items():
+			for c in set([b, b.lower()] if uppercase else [b]):
+				lut[ord(c)] = 0
+				lut[ord(c), i] = 1.0
+				known[ord(c)] = True
+		dna_luts[key] = (lut, known)
+
+	return dna_luts[key]
+
+
+def encode_dna(sequence, symbols=defines.inputs, window_size=None, uppercase=True, strict=True):
+	'''One hot encode a DNA string with a single lookup table indexing operation.
+
+	Arguments:
+		sequence: DNA string, bases after window_size are ignored
+		symbols: Dict mapping input symbols to their channel index e.g. defines.inputs
+		window_size: Length of the encoded tensor, shorter sequences are zero padded. Defaults to the sequence length
+		uppercase: If True lowercase bases are encoded like their uppercase versions
+		strict: If True raise an error on unknown bases, otherwise they are encoded as all zeros
+
+	Returns:
+		tensor: (window_size, channels) array
+	'''
+	if window_size is None:
+		window_size = len(sequence)
+	lut, known = dna_lookup_tables(symbols, uppercase)
+	codes = np.frombuffer(sequence[:window_size].encode('latin-1'), dtype=np.uint8)
+	if strict and not np.all(known[codes]):
+		raise ValueError('Error! Unknown code:', chr(codes[np.argmin(known[codes])]))
+
+	tensor = np.zeros((window_size, lut.shape[1]))
+	tensor[:len(codes)] = lut[codes]
+	return tensor
+
+
+def has_lowercase(sequence):
+	'''True if the sequence has any lowercase (e.g. soft-masked) bases.'''
+	return sequence.upper() != sequence
 
 
 
@@ -1364,6 +2250,75 @@ def make_paired_read_tensor(args, variant, samfile, ref_seq, ref_start, ref_end,
 	return read_tensor
 
 
+class SiteTensors(object):
+	'''Tensors of one variant site, each computed at most once and shared by every allele and tensor type.
+
+	The reads, reference window and tensors do not depend on the allele, so a writer keeps one SiteTensors 
+	while it walks the alleles of a site. Everything is computed lazily, alleles which are skipped cost no BAM I/O.
+	Tensors are shared between the examples of a site so must not be changed after they are returned.
+	'''
+	def __init__(self, args, variant, samfile, reference, stats):
+		self.args = args
+		self.variant = variant
+		self.samfile = samfile
+		self.stats = stats
+		self.idx_offset, self.ref_start, self.ref_end = get_variant_window(args, variant)
+		self.reference_seq = reference.fetch(variant.CHROM, self.ref_start, self.ref_end)
+		self.tensors = {}
+
+	def with_reads_from(self, samfile):
+		'''SiteTensors of the same site with reads from another BAM, e.g. of another sample, sharing the reference.'''
+		site = copy.copy(self)
+		site.samfile = samfile
+		site.tensors = {'reference': self.reference_tensor()}
+		return site
+
+	def reference_tensor(self):
+		if 'reference' not in self.tensors:
+			self.tensors['reference'] = encode_dna(self.reference_seq, defines.inputs, self.args.window_size)
+		return self.tensors['reference']
+
+	def read_tensor(self, tensor_map):
+		'''Get the read tensor for a tensor map, reads_only and reads_reference are channel slices of the read_tensor.'''
+		if tensor_map in self.tensors:
+			return self.tensors[tensor_map]
+
+		args = self.args
+		tensor_map_arg = args.tensor_map
+		if 'read_tensor' == tensor_map:
+			args.tensor_map = tensor_map
+			tensor = make_reference_and_reads_tensor(args, self.variant, self.samfile, self.reference_seq, self.ref_start, self.stats)
+		elif 'paired_reads' == tensor_map:
+			args.tensor_map = tensor_map
+			tensor = make_paired_read_tensor(args, self.variant, self.samfile, self.reference_seq, self.ref_start, self.ref_end, self.stats)
+		elif tensor_map in defines.derived_tensor_maps:
+			source_map = defines.derived_tensor_maps[tensor_map]
+			source = self.read_tensor(source_map)
+			channel_maps = [defines.get_tensor_channel_map_by_name(tm) for tm in [source_map, tensor_map]]
+			tensor = None if source is None else tensor_channel_subset(source, channel_maps[0], channel_maps[1], args.channels_last)
+		else:
+			raise ValueError("Unknown read tensor mapping."+tensor_map)
+		args.tensor_map = tensor_map_arg
+
+		self.tensors[tensor_map] = tensor
+		return tensor
+
+	def read_depth(self):
+		'''Number of reads in the first read tensor built for this site, None if none was.'''
+		for tensor_map in ['read_tensor', 'paired_reads']:
+			if tensor_map in self.tensors:
+				if self.tensors[tensor_map] is None:
+					return 0
+				channel_map = defines.get_tensor_channel_map_by_name(tensor_map)
+				return read_depth_of_tensor(self.tensors[tensor_map], channel_map, self.args.channels_last)
+		return None
+
+	def pileup_tensor(self):
+		if 'pileup_tensor' not in self.tensors:
+			self.tensors['pileup_tensor'] = read_tensor_to_pileup(self.args, self.read_tensor('read_tensor'))
+		return self.tensors['pileup_tensor']
+
+
 def make_calling_tensor(args, samfile, reference_seq, reference_start, stats):
 	good_reads, insert_dict = get_good_reads_in_window(args, samfile, reference_start, reference_start+args.window_size)
 	if len(good_reads) >= args.read_limit:
@@ -1788,8 +2743,9 @@ def good_reads_and_mates_to_tensor(args, variant, good_reads, ref_start, insert_
 def good_reads_to_tensor(args, good_reads, ref_start, insert_dict):
 	'''Create a read tensor based on a tensor channel map.
 
-	Assumes read pairs have the same name. 
-	Only loads reads that might align inside the tensor.
+	Aligned sequences and qualities are packed into uint8 matrices,
+	so all the base, flag and mapping quality channels are filled with a few numpy indexing operations.
+	Gives exactly the same tensors as the per base loop it replaced, kept in unit_tests.py.
 
 	Arguments:
 		args.read_limit: maximum number of reads to return
@@ -1801,67 +2757,90 @@ def good_reads_to_tensor(args, good_reads, ref_start, insert_dict):
 		tensor: 3D read tensor.
 	'''
 	channel_map = defines.get_tensor_channel_map_from_args(args)
-	tensor = np.zeros( defines.tensor_shape_from_args(args) )
+	tensor = np.zeros( (args.read_limit, args.window_size, len(channel_map)) )
+	if len(good_reads) == 0:
+		return tensor if args.channels_last else np.ascontiguousarray(np.transpose(tensor, (2, 0, 1)))
 
+	codes = np.zeros((len(good_reads), args.window_size), dtype=np.uint8)
+	quals = np.zeros((len(good_reads), args.window_size), dtype=np.uint8)
 	for j,read in enumerate(good_reads):
-
 		rseq, rqual = sequence_and_qualities_from_read(args, read, ref_start, insert_dict)
-		flag_start = -1
-		flag_end = 0
+		rseq = rseq[:args.window_size]
+		codes[j, :len(rseq)] = np.frombuffer(rseq.encode('latin-1'), dtype=np.uint8)
+		quals[j, :len(rseq)] = rqual[:len(rseq)]
+
+	lut, known, indel_channel = base_quality_lookup_table(args.base_quality_mode, args.input_symbols)
+	if not np.all(known[codes]):
+		raise ValueError('Error! Unknown symbol in seq block:', chr(codes[~known[codes]][0]))
+
+	n = len(good_reads)
+	tensor[:n, :, :4] = lut[codes, quals]
+	if indel_channel is not None:
+		tensor[:n, :, indel_channel][codes == ord(defines.indel_char)] = 1.0
+
+	# Flags and MQ span from the first aligned base up to, but not including, the last one
+	aligned = (codes != 0) & (codes != ord(defines.skip_char))
+	first = np.argmax(aligned, axis=1)
+	last = args.window_size - 1 - np.argmax(aligned[:, ::-1], axis=1)
+	columns = np.arange(args.window_size)
+	span = (columns >= first[:, np.newaxis]) & (columns < last[:, np.newaxis]) & np.any(aligned, axis=1)[:, np.newaxis]
+
+	read_flags = np.array([read.flag for read in good_reads])
+	for i in range(defines.read_flags):
+		flag_str = 'flag_bit_'+ str(i)
+		if flag_str in channel_map:
+			tensor[:n, :, channel_map[flag_str]][span & ((read_flags[:, np.newaxis] >> i) & 1).astype(bool)] = 1.0
 
-		for i,b in enumerate(rseq):
-			
-			if i == args.window_size:
-				break
-			
-			if b == defines.skip_char:
-				continue
-			elif flag_start == -1:
-				flag_start = i
-			else:
-				flag_end = i
+	if 'mapping_quality' in channel_map:
+		mqs = np.array([float(read.mapping_quality)/defines.mapping_quality_max for read in good_reads])
+		tensor[:n, :, channel_map['mapping_quality']] = np.where(span, mqs[:, np.newaxis], 0.0)
 
-			if b in args.input_symbols:
-				if b == defines.indel_char:
-					if args.channels_last:
-						tensor[j, i, args.input_symbols[b]] = 1.0
-					else:
-						tensor[args.input_symbols[b], j, i] = 1.0
-				else:
-					hot_array = quality_from_mode(args, rqual[i], b, args.input_symbols)
-					if args.channels_last:
-						tensor[j, i, :4] = hot_array
-					else:
-						tensor[:4, j, i] = hot_array
+	if args.channels_last:
+		return tensor
+	return np.ascontiguousarray(np.transpose(tensor, (2, 0, 1)))
 
-			elif b in defines.ambiguity_codes:
-				if args.channels_last:
-					tensor[j, i, :4] = defines.ambiguity_codes[b]
-				else:
-					tensor[:4, j, i] = defines.ambiguity_codes[b]
-			
-			else:
-				raise ValueError('Error! Unknown symbol in seq block:', b)
-				
 
-		flags = flag_to_array(read.flag)
-		for i in range(defines.read_flags):
-			flag_str = 'flag_bit_'+ str(i)
+def base_quality_lookup_table(base_quality_mode, symbols):
+	'''Get a lookup table mapping a base byte and its quality to the first 4 channels of a read tensor.
 
-			if flags[i] and flag_str in channel_map:
-				if args.channels_last:
-					tensor[j, flag_start:flag_end, channel_map[flag_str]] = 1.0
-				else:
-					tensor[channel_map[flag_str], j,  flag_start:flag_end] = 1.0
-		
-		if 'mapping_quality' in channel_map:
-			if args.channels_last:
-				tensor[j, flag_start:flag_end, channel_map['mapping_quality']] = float(read.mapping_quality)/defines.mapping_quality_max
-			else:
-				tensor[channel_map['mapping_quality'], j, flag_start:flag_end] = float(read.mapping_quality)/defines.mapping_quality_max
+	Tables are built once for each mode and symbol dict and cached in base_quality_luts.
 
-	return tensor
+	Arguments:
+		base_quality_mode: How to encode qualities, one of 'phot', 'phred' or '1hot'
+		symbols: Dict mapping input symbols to their channel index e.g. defines.inputs_indel
 
+	Returns:
+		(lut, known, indel_channel): lut is a (256, 256, 4) array indexed by base byte and quality,
+			known is a (256,) boolean array which is False for bytes that can not be in a read sequence,
+			indel_channel is the channel of the indel symbol or None if it is not a symbol.
+	'''
+	key = (base_quality_mode, tuple(sorted(symbols.items())))
+	if key not in base_quality_luts:
+		lut = np.zeros((256, 256, 4))
+		known = np.zeros((256,), dtype=bool)
+		known[[0, ord(defines.skip_char)]] = True # 0 pads sequences shorter than the window
+		for b, encoding in defines.ambiguity_codes.items():
+			if b not in symbols:
+				lut[ord(b)] = encoding
+			known[ord(b)] = True
+		for b, i in symbols.items():
+			known[ord(b)] = True
+			if b == defines.indel_char:
+				continue
+			elif base_quality_mode == 'phot':
+				lut[ord(b)] = not_p_lut[:, np.newaxis]
+				lut[ord(b), :, i] = p_lut
+			elif base_quality_mode == 'phred':
+				with np.errstate(divide='ignore'):
+					for q in range(256):
+						lut[ord(b), q] = base_quality_to_phred_array(q, b, symbols)
+			elif base_quality_mode == '1hot':
+				lut[ord(b), :, i] = 1.0
+			else:
+				raise ValueError('Error! Unknown base quality mode:', base_quality_mode)
+		base_quality_luts[key] = (lut, known, symbols.get(defines.indel_char))
+
+	return base_quality_luts[key]
 
 
 def sequence_and_qualities_from_read(args, read, ref_start, insert_dict):
@@ -1970,6 +2949,46 @@ def image_as_matrix(image_path, expand_dims=False, shape=(224,224), channels_las
 	return img
 
 
+class BatchBuffers(object):
+	'''Ring of preallocated minibatch arrays which generators fill in turn instead of allocating each batch.
+
+	next() hands out the arrays of the next slot of the ring zeroed, so they look like fresh np.zeros().
+	A batch is only written again after count-1 more batches have been handed out, so a consumer 
+	may hold on to the last count-1 batches, Keras generator calls limit their queue with batch_queue_size().
+
+	Arguments:
+		shapes: dict mapping names to the shapes of their batch arrays, including the batch dimension
+		count: Number of batches in the ring, at least 2
+		dtype: numpy dtype of the arrays
+	'''
+	def __init__(self, shapes, count=2, dtype=np.float32):
+		if count < 2:
+			raise ValueError('Error! Batch buffers need at least 2 batches, not:', count)
+		self.buffers = [{name: np.zeros(shape, dtype=dtype) for name, shape in shapes.items()} for _ in range(count)]
+		self.slot = -1
+
+	def next(self):
+		'''Return a dict mapping names to the zeroed arrays of the next batch.'''
+		self.slot = (self.slot + 1) % len(self.buffers)
+		arrays = self.buffers[self.slot]
+		for array in arrays.values():
+			array.fill(0)
+		return arrays
+
+
+def batch_buffers_from_args(args, shapes):
+	'''BatchBuffers of args.batch_buffers batches in args.batch_dtype, see BatchBuffers.'''
+	return BatchBuffers(shapes, args.batch_buffers, np.dtype(args.batch_dtype))
+
+
+def batch_queue_size(args):
+	'''Largest max_queue_size for Keras generator calls which never see a batch buffer refilled.
+
+	Besides the queued batches one is in use by the model and one is being filled, see BatchBuffers.
+	'''
+	return max(1, args.batch_buffers-2)
+
+
 def image_generator(args, train_paths, shape=(224,224)):
 	"""Data generator of PNGs for DeepVariant.
 
@@ -1988,16 +3007,14 @@ def image_generator(args, train_paths, shape=(224,224)):
 	import cv2	
 	debug = False
 	per_batch_per_label = (args.batch_size // len(args.labels)) 
-	image_exts = ['.png', '.jpg', '.jpeg', '.tif']
 	image_counts = Counter()
 	images = {}
 
 	if args.channels_last:
-		image_matrix = np.zeros((args.batch_size, shape[0], shape[1], 3))
+		image_shape = (args.batch_size, shape[0], shape[1], 3)
 	else:
-		image_matrix = np.zeros((args.batch_size, 3, shape[0], shape[1]))
-
-	label_matrix = np.zeros((args.batch_size, len(args.labels)))
+		image_shape = (args.batch_size, 3, shape[0], shape[1])
+	buffers = batch_buffers_from_args(args, {'images': image_shape, 'labels': (args.batch_size, len(args.labels))})
 
 	for tp in train_paths:
 		label_key = os.path.basename(tp)
@@ -2006,10 +3023,12 @@ def image_generator(args, train_paths, shape=(224,224)):
 			continue
 		label = args.labels[label_key] 
 
-		images[label] = [os.path.join(tp, img) for img in os.listdir(tp) if os.path.splitext(img)[1] in image_exts]
+		images[label] = worker_share([os.path.join(tp, img) for img in os.listdir(tp) if os.path.splitext(img)[1] in image_exts])
 		image_counts[label] = 0
 		
 	while True:
+		arrays = buffers.next()
+		image_matrix, label_matrix = arrays['images'], arrays['labels']
 		cur_example = 0
 		for label in images.keys():
 			for i in range(per_batch_per_label):
@@ -2051,12 +3070,11 @@ def pileup_tensor_generator(args, train_paths, include_annotations=False):
 	tensor_counts = Counter()
 	tensors = {}
 
+	shapes = {'annotations': (args.batch_size, len(args.annotations)), 'labels': (args.batch_size, len(args.labels))}
 	if args.window_size > 0:
 		channels = defines.get_reference_and_read_channels(args)
-		tensor = np.zeros((args.batch_size, args.window_size, channels))
-
-	annotation_data = np.zeros((args.batch_size, len(args.annotations)))
-	label_matrix = np.zeros((args.batch_size, len(args.labels)))
+		shapes['pileup_tensor'] = (args.batch_size, args.window_size, channels)
+	buffers = batch_buffers_from_args(args, shapes)
 
 	for tp in train_paths:
 		label_key = os.path.basename(tp)
@@ -2065,20 +3083,22 @@ def pileup_tensor_generator(args, train_paths, include_annotations=False):
 			continue
 		label = args.labels[label_key] 
 
-		tensors[label] = [os.path.join(tp, t) for t in os.listdir(tp) if os.path.splitext(t)[1] in tensor_exts]
+		tensors[label] = worker_share(examples_in_directory(tp))
 		tensor_counts[label] = 0
 		
 	while True:
+		arrays = buffers.next()
+		tensor, annotation_data, label_matrix = arrays.get('pileup_tensor'), arrays['annotations'], arrays['labels']
 		cur_example = 0
 		for label in tensors.keys():
 			for i in range(per_batch_per_label):
 				tensor_path = tensors[label][tensor_counts[label]]
 				label_matrix[cur_example, label] = 1.0
-				with h5py.File(tensor_path,'r') as hf:
-					if include_annotations:
-						annotation_data[cur_example,:] = np.array(hf.get(args.tensor_map))
-					if args.window_size > 0:
-						tensor[cur_example,:,:] = np.array(hf.get('pileup_tensor'))
+				example = load_example_tensors(tensor_path, [args.tensor_map, 'pileup_tensor'])
+				if include_annotations:
+					annotation_data[cur_example,:] = example[args.tensor_map]
+				if args.window_size > 0:
+					tensor[cur_example,:,:] = example['pileup_tensor']
 				
 				tensor_counts[label] += 1
 				if tensor_counts[label] == len(tensors[label]):
@@ -2122,8 +3142,7 @@ def bqsr_tensor_generator(args, train_paths):
 	tensor_counts = Counter()
 	tensors = {}
 
-	tensor = np.zeros((args.batch_size, args.window_size, len(args.input_symbols)))
-	label_matrix = np.zeros((args.batch_size, len(args.labels)))
+	buffers = batch_buffers_from_args(args, {'read_tensor': (args.batch_size, args.window_size, len(args.input_symbols)), 'labels': (args.batch_size, len(args.labels))})
 
 	for tp in train_paths:
 		label_key = os.path.basename(tp)
@@ -2131,17 +3150,18 @@ def bqsr_tensor_generator(args, train_paths):
 			print('Skipping label directory:', label_key, ' which is not in args label set:', args.labels.keys())
 			continue
 		label = args.labels[label_key] 
-		tensors[label] = [os.path.join(tp, t) for t in os.listdir(tp) if os.path.splitext(t)[1] in tensor_exts]
+		tensors[label] = worker_share(examples_in_directory(tp))
 		tensor_counts[label] = 0
 		
 	while True:
+		arrays = buffers.next()
+		tensor, label_matrix = arrays['read_tensor'], arrays['labels']
 		cur_example = 0
 		for label in tensors.keys():
 			for i in range(per_batch_per_label):
 				tensor_path = tensors[label][tensor_counts[label]]
 				try:
-					with h5py.File(tensor_path,'r') as hf:
-						tensor[cur_example] = np.array(hf.get('read_tensor'))			
+					tensor[cur_example] = load_example_tensor(tensor_path, 'read_tensor')
 				except:
 					e = sys.exc_info()
 					print('\nError', e, ' \n could be corrupt tensor at:', tensor_path )
@@ -2162,7 +3182,6 @@ def bqsr_tensor_generator(args, train_paths):
 			print('Tensor counts are:', tensor_counts, ' cur example:', cur_example, ' per b per label:', per_batch_per_label)
 
 		yield ({'read_tensor_input':tensor}, label_matrix)
-		label_matrix = np.zeros((args.batch_size, len(args.labels)))
 
 
 def bqsr_tensor_annotation_generator(args, train_paths):
@@ -2186,9 +3205,8 @@ def bqsr_tensor_annotation_generator(args, train_paths):
 	tensor_counts = Counter()
 	tensors = {}
 
-	annotation_data = np.zeros((args.batch_size, len(args.annotations)))
-	tensor = np.zeros((args.batch_size, args.window_size, len(args.input_symbols)))
-	label_matrix = np.zeros((args.batch_size, len(args.labels)))
+	buffers = batch_buffers_from_args(args, {'read_tensor': (args.batch_size, args.window_size, len(args.input_symbols)), 
+											'annotations': (args.batch_size, len(args.annotations)), 'labels': (args.batch_size, len(args.labels))})
 
 	for tp in train_paths:
 		label_key = os.path.basename(tp)
@@ -2196,18 +3214,20 @@ def bqsr_tensor_annotation_generator(args, train_paths):
 			print('Skipping label directory:', label_key, ' which is not in args label set:', args.labels.keys())
 			continue
 		label = args.labels[label_key] 
-		tensors[label] = [os.path.join(tp, t) for t in os.listdir(tp) if os.path.splitext(t)[1] in tensor_exts]
+		tensors[label] = worker_share(examples_in_directory(tp))
 		tensor_counts[label] = 0
 		
 	while True:
+		arrays = buffers.next()
+		tensor, annotation_data, label_matrix = arrays['read_tensor'], arrays['annotations'], arrays['labels']
 		cur_example = 0
 		for label in tensors.keys():
 			for i in range(per_batch_per_label):
 				tensor_path = tensors[label][tensor_counts[label]]
 				try:
-					with h5py.File(tensor_path,'r') as hf:
-						tensor[cur_example] = np.array(hf.get(args.tensor_map))
-						annotation_data[cur_example] = np.array(hf.get(args.annotation_set))
+					example = load_example_tensors(tensor_path, [args.tensor_map, args.annotation_set])
+					tensor[cur_example] = example[args.tensor_map]
+					annotation_data[cur_example] = example[args.annotation_set]
 				except:
 					e = sys.exc_info()
 					print('\nError', e, ' \n could be corrupt tensor at:', tensor_path)
@@ -2228,7 +3248,6 @@ def bqsr_tensor_annotation_generator(args, train_paths):
 			print('Tensor counts are:', tensor_counts, ' cur example:', cur_example, ' per b per label:', per_batch_per_label)
 
 		yield ({args.tensor_map:tensor, args.annotation_set:annotation_data}, label_matrix)
-		label_matrix = np.zeros((args.batch_size, len(args.labels)))
 
 
 def calling_tensors_generator(args, train_paths):
@@ -2246,6 +3265,7 @@ def calling_tensors_generator(args, train_paths):
 	'''	
 	from keras.utils import to_categorical # Lazy import because we don't want this file to be keras dependent
 
+	train_paths = worker_share(train_paths)
 	tensors = {}
 	stats = Counter()
 
@@ -2255,15 +3275,15 @@ def calling_tensors_generator(args, train_paths):
 	else:
 		tensor_shape = (in_channels, args.read_limit, args.window_size) 
 
-	tensor = np.zeros(((args.batch_size,)+tensor_shape))
-	label_matrix = np.zeros((args.batch_size, args.window_size, len(args.labels)))
+	buffers = batch_buffers_from_args(args, {'read_tensor': (args.batch_size,)+tensor_shape, 'labels': (args.batch_size, args.window_size, len(args.labels))})
+	arrays = buffers.next()
 	while True:
 		
 		for tp in train_paths:
 			try: 
-				with h5py.File(tp, 'r') as hf:
-					tensor[stats['batch_index']] = np.array(hf.get('read_tensor'))
-					label_matrix[stats['batch_index']] = to_categorical(np.array(hf.get('site_labels')), len(args.labels))
+				example = load_example_tensors(tp, ['read_tensor', 'site_labels'])
+				arrays['read_tensor'][stats['batch_index']] = example['read_tensor']
+				arrays['labels'][stats['batch_index']] = to_categorical(example['site_labels'], len(args.labels))
 
 			except Exception as e:
 				print('Exception for tensor at:', tp, '\n\n\nError is:', str(e))
@@ -2273,7 +3293,8 @@ def calling_tensors_generator(args, train_paths):
 
 			stats['batch_index'] += 1
 			if stats['batch_index'] == args.batch_size:
-				yield ({'read_tensor':tensor}, label_matrix)
+				yield ({'read_tensor':arrays['read_tensor']}, arrays['labels'])
+				arrays = buffers.next()
 				stats['batch_index'] = 0
 
 		print('\n\nGenerator looped over all ', len(train_paths),' tensors, now shuffle them. Last tensor was:', train_paths[-1])
@@ -2295,21 +3316,22 @@ def calling_pileup_tensors_generator(args, train_paths):
 	'''	
 	from keras.utils import to_categorical # Lazy import because we don't want this file to be keras dependent
 
+	train_paths = worker_share(train_paths)
 	tensors = {}
 	stats = Counter()
 
 	channels = defines.get_reference_and_read_channels(args)
 	in_shape = (args.window_size, channels)
 
-	tensor = np.zeros(((args.batch_size,)+in_shape))
-	label_matrix = np.zeros((args.batch_size, args.window_size, len(args.labels)))
+	buffers = batch_buffers_from_args(args, {'pileup_tensor': (args.batch_size,)+in_shape, 'labels': (args.batch_size, args.window_size, len(args.labels))})
+	arrays = buffers.next()
 	
 	while True:	
 		for tp in train_paths:
 			try: 
-				with h5py.File(tp, 'r') as hf:
-					tensor[stats['batch_index']] = np.array(hf.get('pileup_tensor'))
-					label_matrix[stats['batch_index']] = to_categorical(np.array(hf.get('site_labels')), len(args.labels))
+				example = load_example_tensors(tp, ['pileup_tensor', 'site_labels'])
+				arrays['pileup_tensor'][stats['batch_index']] = example['pileup_tensor']
+				arrays['labels'][stats['batch_index']] = to_categorical(example['site_labels'], len(args.labels))
 
 			except Exception as e:
 				print('\n\n\nException for tensor at:\n', tp, '\nError is:', str(e))
@@ -2319,7 +3341,8 @@ def calling_pileup_tensors_generator(args, train_paths):
 
 			stats['batch_index'] += 1
 			if stats['batch_index'] == args.batch_size:
-				yield ({'pileup_tensor':tensor}, label_matrix)
+				yield ({'pileup_tensor':arrays['pileup_tensor']}, arrays['labels'])
+				arrays = buffers.next()
 				stats['batch_index'] = 0
 
 		print('\n\nGenerator looped over all ', len(train_paths),' tensors, now shuffle them. Last tensor was:', train_paths[-1])
@@ -2347,8 +3370,7 @@ def tensor_generator(args, train_paths, tensor_shape):
 	tensor_counts = Counter()
 	tensors = {}
 
-	tensor = np.zeros(((args.batch_size,)+tensor_shape))
-	label_matrix = np.zeros((args.batch_size, len(args.labels)))
+	buffers = batch_buffers_from_args(args, {'read_tensor': (args.batch_size,)+tensor_shape, 'labels': (args.batch_size, len(args.labels))})
 
 	for tp in train_paths:
 		label_key = os.path.basename(tp)
@@ -2356,21 +3378,21 @@ def tensor_generator(args, train_paths, tensor_shape):
 			print('Skipping label directory:', label_key, ' which is not in args label set:', args.labels.keys())
 			continue
 		label = args.labels[label_key] 
-		tensors[label] = [os.path.join(tp, t) for t in os.listdir(tp) if os.path.splitext(t)[1] in tensor_exts]
+		tensors[label] = worker_share(examples_in_directory(tp))
 		tensor_counts[label] = 0
 		
 	while True:
+		arrays = buffers.next()
+		tensor, label_matrix = arrays['read_tensor'], arrays['labels']
 		cur_example = 0
 		for label in tensors.keys():
 			for i in range(per_batch_per_label):
 				tensor_path = tensors[label][tensor_counts[label]]
 				try:
-					with h5py.File(tensor_path,'r') as hf:
-						tensor[cur_example] = np.array(hf.get('read_tensor'))
+					tensor[cur_example] = load_example_tensor(tensor_path, 'read_tensor', tensor_shape)
 				except Exception as e:
 					print('Delete corrupt tensor at:', tensor_path)
 					print('Error is:', str(e), 'Expected shape:', tensor_shape)
-					print('in shape:', np.array(hf.get('read_tensor')).shape)
 					del tensors[label][tensor_counts[label]]
 					continue
 					
@@ -2388,7 +3410,6 @@ def tensor_generator(args, train_paths, tensor_shape):
 			print('Tensor counts are:', tensor_counts, ' cur example:', cur_example, ' per b per label:', per_batch_per_label)
 
 		yield ({'read_tensor':tensor}, label_matrix)
-		label_matrix = np.zeros((args.batch_size, len(args.labels)))
 
 
 def tensor_annotation_generator(args, train_paths, tensor_shape):
@@ -2413,9 +3434,8 @@ def tensor_annotation_generator(args, train_paths, tensor_shape):
 	tensor_counts = Counter()
 	tensors = {}
 
-	tensor = np.zeros(((args.batch_size,)+tensor_shape))
-	annotations = np.zeros((args.batch_size,len(args.annotations)))
-	label_matrix = np.zeros((args.batch_size, len(args.labels)))
+	buffers = batch_buffers_from_args(args, {'read_tensor': (args.batch_size,)+tensor_shape, 
+											'annotations': (args.batch_size, len(args.annotations)), 'labels': (args.batch_size, len(args.labels))})
 
 	for tp in train_paths:
 		label_key = os.path.basename(tp)
@@ -2423,19 +3443,21 @@ def tensor_annotation_generator(args, train_paths, tensor_shape):
 			print('Skipping label directory:', label_key, ' which is not in args label set:', args.labels.keys())
 			continue
 		label = args.labels[label_key] 
-		tensors[label] = [os.path.join(tp, t) for t in os.listdir(tp) if os.path.splitext(t)[1] in tensor_exts]
+		tensors[label] = worker_share(examples_in_directory(tp))
 		tensor_counts[label] = 0
 
 	while True:
+		arrays = buffers.next()
+		tensor, annotations, label_matrix = arrays['read_tensor'], arrays['annotations'], arrays['labels']
 		cur_example = 0
 		for label in tensors.keys():
 			for i in range(per_batch_per_label):
 				tensor_path = tensors[label][tensor_counts[label]]
 
 				try:
-					with h5py.File(tensor_path, 'r') as hf:
-						tensor[cur_example] = np.array(hf.get(args.tensor_map))
-						annotations[cur_example] = np.array(hf.get(args.annotation_set))
+					example = load_example_tensors(tensor_path, [args.tensor_map, args.annotation_set], {args.tensor_map: tensor_shape})
+					tensor[cur_example] = example[args.tensor_map]
+					annotations[cur_example] = example[args.annotation_set]
 
 				except Exception as e:
 					print('Delete corrupt tensor at:', tensor_path)
@@ -2457,16 +3479,28 @@ def tensor_annotation_generator(args, train_paths, tensor_shape):
 			print('Tensor counts are:', tensor_counts, ' cur example:', cur_example, ' per b per label:', per_batch_per_label)
 
 		yield ({args.tensor_map:tensor, args.annotation_set:annotations}, label_matrix)
-		label_matrix = np.zeros((args.batch_size, len(args.labels)))		
-		annotations = np.zeros((args.batch_size,len(args.annotations)))
 
 
 def train_valid_test_generators_from_args(args, with_positions=False):
+	if not defines.get_tensor_channel_map_from_args(args) and defines.annotations_from_args(args):
+		stores = [load_annotation_store(args, split) for split in ['train', 'valid', 'test']]
+		if all(store is not None for store in stores):
+			print('Serving annotation batches from:', annotation_store_path(args))
+			return tuple(minibatches_from_args(args, annotation_store_generator, args, store, with_positions) for store in stores)
+
 	train_paths, valid_paths, test_paths = get_train_valid_test_paths(args)
 
-	train_generator = tensor_generator_from_label_dirs_and_args(args, train_paths, with_positions)
-	valid_generator = tensor_generator_from_label_dirs_and_args(args, valid_paths, with_positions)
-	test_generator = tensor_generator_from_label_dirs_and_args(args, test_paths, with_positions)
+	if args.epoch_cache_dir:
+		generators = []
+		for split, split_paths in zip(['train', 'valid', 'test'], [train_paths, valid_paths, test_paths]):
+			cache = epoch_cache_from_args(args, split, split_paths)
+			inputs = {name: cache[name] for name in epoch_cache_inputs(args)}
+			generators.append(minibatches_from_args(args, array_store_generator, args, inputs, cache['labels'], cache['positions'], with_positions))
+		return tuple(generators)
+
+	train_generator = minibatches_from_args(args, tensor_generator_from_label_dirs_and_args, args, train_paths, with_positions)
+	valid_generator = minibatches_from_args(args, tensor_generator_from_label_dirs_and_args, args, valid_paths, with_positions)
+	test_generator = minibatches_from_args(args, tensor_generator_from_label_dirs_and_args, args, test_paths, with_positions)
 
 	return train_generator, valid_generator, test_generator
 
@@ -2490,24 +3524,25 @@ def tensor_generator_from_label_dirs_and_args(args, train_paths, with_positions=
 	"""	
 	debug = False
 
-	batch = {}
+	batch_shapes = {}
 	tensors = {}
 	stats = Counter()
 	tensor_counts = Counter()
 	per_batch_per_label = (args.batch_size // len(args.labels) ) 
 
+	shapes = tensor_shapes_from_args(args)
 	tm = defines.get_tensor_channel_map_from_args(args)
 	if tm:
 		tensor_shape = defines.tensor_shape_from_args(args)
-		batch[args.tensor_map] = np.zeros(((args.batch_size,)+tensor_shape))
+		batch_shapes[args.tensor_map] = (args.batch_size,)+tensor_shape
 	
 	if defines.annotations_from_args(args):
-		batch[args.annotation_set] = np.zeros((args.batch_size, len(args.annotations)))
+		batch_shapes[args.annotation_set] = (args.batch_size, len(args.annotations))
 	
 	if with_positions:
 		positions = []
 
-	label_matrix = np.zeros((args.batch_size, len(args.labels)))
+	buffers = batch_buffers_from_args(args, dict(batch_shapes, labels=(args.batch_size, len(args.labels))))
 
 	for tp in train_paths:
 		label_key = os.path.basename(tp)
@@ -2515,25 +3550,27 @@ def tensor_generator_from_label_dirs_and_args(args, train_paths, with_positions=
 			print('Skipping label directory:', label_key, ' which is not in args label set:', args.labels.keys())
 			continue
 		label = args.labels[label_key] 
-		tensors[label] = [os.path.join(tp, t) for t in os.listdir(tp) if os.path.splitext(t)[1] in tensor_exts]
+		tensors[label] = worker_share(examples_in_directory(tp))
 		tensor_counts[label] = 0
 
 	while True:
+		arrays = buffers.next()
+		batch = {key: arrays[key] for key in batch_shapes}
+		label_matrix = arrays['labels']
 		cur_example = 0
 		for label in tensors.keys():
 			for i in range(per_batch_per_label):
 				tensor_path = tensors[label][tensor_counts[label]]
 				try:
-					with h5py.File(tensor_path, 'r') as hf:
-						for key in batch.keys():
-							hf_tensor = hf.get(key)
-							if hf_tensor:
-								batch[key][cur_example] = np.array(hf_tensor)
-							else:
-								#raise ValueError('Could not find tensor with key:'+key+ '\nAt hd5 path:'+tensor_path) 
-								print('Could not find tensor with key:'+key+ '\nAt hd5 path:'+tensor_path)
-								del tensors[label][tensor_counts[label]]
-								continue
+					example = load_example_tensors(tensor_path, batch.keys(), shapes)
+					for key in batch.keys():
+						if example[key] is not None:
+							batch[key][cur_example] = example[key]
+						else:
+							#raise ValueError('Could not find tensor with key:'+key+ '\nAt hd5 path:'+str(tensor_path)) 
+							print('Could not find tensor with key:'+key+ '\nAt hd5 path:'+str(tensor_path))
+							del tensors[label][tensor_counts[label]]
+							continue
 				except IOError as e:
 					print('\n\nSkipping corrupt tensor at:', tensor_path, '\n ')
 					del tensors[label][tensor_counts[label]]
@@ -2550,7 +3587,7 @@ def tensor_generator_from_label_dirs_and_args(args, train_paths, with_positions=
 					tensor_counts[label] = 0
 				
 				if with_positions:
-					positions.append(position_string_from_tensor_name(tensor_path))
+					positions.append(position_string_from_example(tensor_path))
 
 				cur_example += 1
 				if cur_example == args.batch_size:
@@ -2566,13 +3603,144 @@ def tensor_generator_from_label_dirs_and_args(args, train_paths, with_positions=
 			positions = []
 		else:
 			yield (batch, label_matrix)
-		label_matrix = np.zeros((args.batch_size, len(args.labels)))		
-		if with_positions and tm:
-			tensor_shape = defines.tensor_shape_from_args(args)
-			batch[args.tensor_map] = np.zeros(((args.batch_size,)+tensor_shape))
-		
-		if with_positions and defines.annotations_from_args(args):
-			batch[args.annotation_set] = np.zeros((args.batch_size, len(args.annotations)))		
+
+
+def prefetch_generator(args, generator_function, *generator_args, **generator_kwargs):
+	'''Call generator_function(*generator_args, **generator_kwargs), prefetching its batches if args.prefetch_workers is set.
+
+	Arguments:
+		args.prefetch_workers: Number of background readers, 0 returns the generator itself
+		args.prefetch_mode: thread or process
+		args.prefetch_queue_size: Maximum number of ready batches waiting in the queue
+		generator_function: a generator of minibatches like tensor_generator_from_label_dirs_and_args()
+
+	Returns:
+		A generator of the same minibatches, see PrefetchGenerator
+	'''
+	if args.prefetch_workers < 1:
+		return generator_function(*generator_args, **generator_kwargs)
+	make_generator = functools.partial(generator_function, *generator_args, **generator_kwargs)
+	return PrefetchGenerator(make_generator, args.prefetch_workers, args.prefetch_queue_size, args.prefetch_mode == 'process')
+
+
+def prefetch_batches(args, generator):
+	'''Prefetch the batches of a generator that was already made in one background thread, if args.prefetch_workers is set.'''
+	if args.prefetch_workers < 1 or isinstance(generator, (PrefetchGenerator, IndexedBatches)):
+		return generator
+	return PrefetchGenerator(generator, 1, args.prefetch_queue_size)
+
+
+class PrefetchGenerator(object):
+	'''Generator of minibatches read ahead by background threads or processes into bounded queues.
+
+	Files are opened, decompressed and copied into batches while the model trains on the previous ones.
+	Each worker runs its own copy of the generator made by calling make_generator on its own share of the examples
+	of each label, see worker_share(), and batches are taken from the workers in turn, so every batch keeps 
+	the label balance of the generator it came from and a pass over the batches sees each example once.
+	With one worker the batches are exactly those of the generator and in the same order.
+	Worker processes are seeded differently so they shuffle their examples differently.
+	Batches are copied before they are queued, since generators reuse their batch arrays and 
+	multiprocessing queues only pickle them later, in a feeder thread.
+	An error in a worker is raised by next().
+
+	Arguments:
+		make_generator: function with no arguments returning a generator of minibatches, e.g. a functools.partial.
+			A generator which was already made can be given instead, with a single thread worker.
+		workers: Number of background readers
+		queue_size: Maximum number of ready batches waiting, shared among the workers
+		use_process: If True read in processes, otherwise in threads
+	'''
+	def __init__(self, make_generator, workers=1, queue_size=8, use_process=False):
+		if not callable(make_generator) and (workers != 1 or use_process):
+			raise ValueError('Error! Only a single prefetching thread can read from a generator that was already made.')
+		self.use_process = use_process
+		self.turn = 0
+		self.batches = []
+		self.workers = []
+		seed = np.random.randint(2**31 - workers)
+		for i in range(workers):
+			if use_process:
+				batches = multiprocessing.Queue(max(1, queue_size//workers))
+				worker = multiprocessing.Process(target=prefetch_worker_loop, args=(make_generator, batches, seed+i, i, workers))
+			else:
+				batches = queue.Queue(max(1, queue_size//workers))
+				worker = threading.Thread(target=prefetch_worker_loop, args=(make_generator, batches, None, i, workers))
+			worker.daemon = True
+			worker.start()
+			self.batches.append(batches)
+			self.workers.append(worker)
+		atexit.register(self.close)
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		while True:
+			try:
+				kind, batch = self.batches[self.turn].get(timeout=1.0)
+				break
+			except queue.Empty:
+				if not self.workers[self.turn].is_alive() and self.batches[self.turn].empty():
+					raise ValueError('Error! Prefetching worker stopped unexpectedly.')
+		if kind == 'error':
+			raise ValueError('Error! Prefetching worker failed:\n' + batch)
+		if kind == 'stop':
+			raise StopIteration
+		self.turn = (self.turn + 1) % len(self.workers)
+		return batch
+
+	next = __next__ # Python 2
+
+	def close(self):
+		'''Stop worker processes, worker threads are daemons and stop with the interpreter.'''
+		if self.use_process:
+			for batches, worker in zip(self.batches, self.workers):
+				batches.cancel_join_thread()
+				if worker.is_alive():
+					worker.terminate()
+
+
+# Index and count of the prefetch worker running on a thread, see worker_share()
+prefetch_worker = threading.local()
+
+def worker_share(examples):
+	'''The share of a list of examples that the generator of the prefetch worker on this thread reads.
+
+	Worker i of n gets examples i, i+n, i+2n, ... so the workers of a PrefetchGenerator split the examples
+	instead of each producing the same batches. Outside of prefetch workers, and for lists with fewer 
+	examples than there are workers, a copy of all the examples is returned.
+	'''
+	index, count = getattr(prefetch_worker, 'index', 0), getattr(prefetch_worker, 'count', 1)
+	if count < 2 or len(examples) < count:
+		return examples[:]
+	return examples[index::count]
+
+
+def prefetch_worker_loop(make_generator, batches, seed, index=0, count=1):
+	'''Worker index of count of PrefetchGenerator, puts ('batch', batch) on the batches queue, then ('stop', None) or ('error', traceback).'''
+	if seed is not None:
+		np.random.seed(seed)
+		random.seed(seed)
+	prefetch_worker.index = index
+	prefetch_worker.count = count
+	try:
+		generator = make_generator() if callable(make_generator) else make_generator
+		for batch in generator:
+			batches.put(('batch', copy_batch(batch)))
+		batches.put(('stop', None))
+	except Exception:
+		batches.put(('error', traceback.format_exc()))
+
+
+def copy_batch(batch):
+	'''Copy the numpy arrays of a minibatch, which may be nested in dicts, lists and tuples.'''
+	if isinstance(batch, np.ndarray):
+		return batch.copy()
+	elif isinstance(batch, dict):
+		return {k: copy_batch(v) for k, v in batch.items()}
+	elif isinstance(batch, (list, tuple)):
+		return type(batch)(copy_batch(v) for v in batch)
+	return batch
 
 
 def big_batch_from_minibatch_generator(args, generator):
@@ -2592,18 +3760,595 @@ def big_batch_from_minibatch_generator(args, generator):
 
 	for _ in range(minibatches):
 		next_batch = next(generator)
+		# Copy, generators fill the arrays of their batches again after a few more batches
 		if tm:
-			input_data[args.tensor_map].extend(next_batch[0][args.tensor_map])
+			input_data[args.tensor_map].extend(np.copy(next_batch[0][args.tensor_map]))
 		if annotations:
-			input_data[args.annotation_set].extend(next_batch[0][args.annotation_set])
-		labels.extend(next_batch[1])
+			input_data[args.annotation_set].extend(np.copy(next_batch[0][args.annotation_set]))
+		labels.extend(np.copy(next_batch[1]))
 		positions.extend(next_batch[-1])
 
-	for key in input_data:
-		input_data[key] = np.array(input_data[key])
-		print('Input tensor:', key, 'has shape:', input_data[key].shape)
+	for key in input_data:
+		input_data[key] = np.array(input_data[key])
+		print('Input tensor:', key, 'has shape:', input_data[key].shape)
+
+	return input_data, np.array(labels), positions
+
+
+def annotation_store_path(args):
+	'''Path of the columnar annotation store of args.annotation_set in args.data_dir, see write_annotation_store().'''
+	return os.path.join(args.data_dir, 'annotation_store_' + args.annotation_set + '.hd5')
+
+
+def variant_type_of_label(label_key):
+	'''SNP or INDEL for labels like SNP, NOT_SNP, INDEL and NOT_INDEL, otherwise the label itself.'''
+	for variant_type in ['SNP', 'INDEL']:
+		if variant_type in label_key:
+			return variant_type
+	return label_key
+
+
+def write_annotation_store(args):
+	'''Gather the annotations of a tensor dataset into one columnar hd5 file for annotation only models.
+
+	Annotation only architectures read a handful of floats per example, so opening a file for each one 
+	dominates training. The store holds a group for each of the train, valid and test splits with contiguous datasets:
+	annotations (examples x annotations float32), labels (index in args.labels), variant_types and positions,
+	which annotation_store_generator() serves whole minibatches from with fancy indexing.
+
+	Arguments:
+		args.data_dir: Dataset with train, valid and test label directories of hd5 tensors or shards
+		args.annotation_set: Annotation set to gather
+		args.labels: Labels to gather, other label directories are skipped
+
+	Returns:
+		store_path: Path of the annotation store written
+	'''
+	if defines.annotations_from_args(args) is None:
+		raise ValueError('Error! An annotation store needs an --annotation_set.')
+	stats = Counter()
+	store_path = annotation_store_path(args)
+	partial_path = store_path + '.partial'
+	split_paths_list = get_train_valid_test_paths(args)
+	with h5py.File(partial_path, 'w') as hf:
+		hf.attrs['annotation_set'] = args.annotation_set
+		hf.attrs['annotations'] = json.dumps(args.annotations)
+		hf.attrs['labels'] = json.dumps(args.labels)
+		hf.attrs['fingerprint'] = annotation_store_fingerprint(split_paths_list)
+		for split, split_paths in zip(['train', 'valid', 'test'], split_paths_list):
+			annotations, labels, variant_types, positions = [], [], [], []
+			for tp in split_paths:
+				label_key = os.path.basename(tp)
+				if label_key not in args.labels:
+					print('Skipping label directory:', label_key, ' which is not in args label set:', args.labels.keys())
+					continue
+				for example in sorted(examples_in_directory(tp), key=str):
+					try:
+						annotation_data = load_example_tensor(example, args.annotation_set)
+					except IOError:
+						stats['Skipped corrupt tensor'] += 1
+						continue
+					if annotation_data is None:
+						stats['Skipped tensor without annotations'] += 1
+						continue
+					annotations.append(annotation_data)
+					labels.append(args.labels[label_key])
+					variant_types.append(variant_type_of_label(label_key))
+					positions.append(position_string_from_example(example))
+					stats[split + ' ' + label_key] += 1
+
+			group = hf.create_group(split)
+			group.create_dataset('annotations', data=np.array(annotations, dtype=np.float32).reshape((-1, len(args.annotations))))
+			group.create_dataset('labels', data=np.array(labels, dtype=np.int32))
+			group.create_dataset('variant_types', data=np.array(variant_types, dtype=np.string_))
+			group.create_dataset('positions', data=np.array(positions, dtype=np.string_))
+	os.rename(partial_path, store_path)
+
+	for s in stats.keys():
+		print(s, 'has:', stats[s])
+	print('Wrote annotation store at:', store_path)
+	return store_path
+
+
+def annotation_store_fingerprint(split_paths_list):
+	'''Hash of the files in the label directories of the train, valid and test splits, see label_dir_sources().'''
+	return hashlib.sha1(json.dumps([label_dir_sources(split_paths) for split_paths in split_paths_list]).encode('utf-8')).hexdigest()
+
+
+def load_annotation_store(args, split):
+	'''Load one split of the annotation store of args into memory.
+
+	Arguments:
+		args.data_dir, args.annotation_set: Locate the store, see annotation_store_path()
+		split: train, valid or test
+
+	Returns:
+		A dict with the annotations matrix, labels, variant_types and positions arrays of the split,
+		or None if there is no store, it was written with different annotations or labels than args has,
+		or the files in the label directories changed since it was written.
+	'''
+	store_path = annotation_store_path(args)
+	if not os.path.exists(store_path):
+		return None
+	with h5py.File(store_path, 'r') as hf:
+		if json.loads(hf.attrs['annotations']) != list(args.annotations) or json.loads(hf.attrs['labels']) != dict(args.labels):
+			print('Ignoring annotation store:', store_path, 'written with other annotations or labels.')
+			return None
+		if hf.attrs.get('fingerprint') != annotation_store_fingerprint(get_train_valid_test_paths(args)):
+			print('Ignoring annotation store:', store_path, 'the tensors changed since it was written, rewrite it with write_annotation_store.')
+			return None
+		return {key: np.array(hf[split][key]) for key in hf[split]}
+
+
+# Bump when the layout of epoch caches changes, so old caches are rebuilt
+epoch_cache_version = 1
+
+def epoch_cache_inputs(args):
+	'''Dict mapping the input tensors cached for args to their shapes, like the batches of tensor_generator_from_label_dirs_and_args().'''
+	inputs = {}
+	if defines.get_tensor_channel_map_from_args(args):
+		inputs[args.tensor_map] = defines.tensor_shape_from_args(args)
+	if defines.annotations_from_args(args):
+		inputs[args.annotation_set] = (len(args.annotations),)
+	return inputs
+
+
+def epoch_cache_key(args):
+	'''Hash of the dataset directory, tensor map, input shapes, annotations, labels and channel order of an epoch cache.
+
+	Caches with the same key only differ in the files they were built from, so a new one replaces the others.
+	'''
+	description = {
+		'version': epoch_cache_version,
+		'data_dir': os.path.realpath(args.data_dir),
+		'tensor_map': args.tensor_map,
+		'inputs': sorted((name, list(shape)) for name, shape in epoch_cache_inputs(args).items()),
+		'annotations': args.annotations if defines.annotations_from_args(args) else None,
+		'labels': sorted(args.labels.items()),
+		'channels_last': args.channels_last,
+	}
+	return hashlib.sha1(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def epoch_cache_fingerprint(args, split_paths):
+	'''Hash of everything an epoch cache depends on: its epoch_cache_key() and the files in each label directory 
+	with their sizes and modification times.'''
+	return hashlib.sha1(json.dumps({'key': epoch_cache_key(args), 'sources': label_dir_sources(split_paths)}).encode('utf-8')).hexdigest()
+
+
+def label_dir_sources(split_paths):
+	'''List with the label directory, name, size and modification time of every file in the label directories.'''
+	sources = []
+	for tp in sorted(split_paths):
+		for name in sorted(os.listdir(tp)):
+			stat = os.stat(os.path.join(tp, name))
+			sources.append([os.path.basename(tp), name, stat.st_size, int(stat.st_mtime)])
+	return sources
+
+
+def epoch_cache_from_args(args, split, split_paths):
+	'''Memory map the epoch cache of a split of the dataset, building it on first use.
+
+	The cache is a directory of uncompressed .npy files in args.epoch_cache_dir named after the split, 
+	epoch_cache_key() and epoch_cache_fingerprint(), so changing the dataset or the tensor map, shapes, annotations 
+	or labels makes a new cache. Only stale caches of the same split and key are deleted, so caches of other datasets,
+	or of the same dataset with other arguments, can share args.epoch_cache_dir. It holds a float32 array with a row for each example 
+	for each input, the label index of each example (-1 for examples which failed to load) and their positions.
+
+	Arguments:
+		args.epoch_cache_dir: Directory on fast local disk for the caches
+		split: train, valid or test
+		split_paths: label directories of the split
+
+	Returns:
+		dict mapping input names, labels and positions to read only memory mapped arrays
+	'''
+	fingerprint = epoch_cache_fingerprint(args, split_paths)
+	cache_prefix = os.path.join(args.epoch_cache_dir, split + '_' + epoch_cache_key(args)[:16] + '_')
+	cache_dir = cache_prefix + fingerprint[:20]
+	if not os.path.exists(os.path.join(cache_dir, 'complete.json')):
+		for stale_dir in glob.glob(cache_prefix + '*'):
+			if not stale_dir.endswith('.partial'):
+				shutil.rmtree(stale_dir, ignore_errors=True)
+		write_epoch_cache(args, split_paths, cache_dir, fingerprint)
+
+	cache = {}
+	with open(os.path.join(cache_dir, 'complete.json')) as f:
+		inputs = json.load(f)['inputs']
+	for i, name in enumerate(inputs):
+		cache[name] = np.load(os.path.join(cache_dir, 'input_%d.npy' % i), mmap_mode='r')
+	cache['labels'] = np.load(os.path.join(cache_dir, 'labels.npy'))
+	cache['positions'] = np.load(os.path.join(cache_dir, 'positions.npy'))
+	return cache
+
+
+def write_epoch_cache(args, split_paths, cache_dir, fingerprint):
+	'''Decompress every example of a split once into the .npy files of an epoch cache, see epoch_cache_from_args().'''
+	inputs = epoch_cache_inputs(args)
+	names = sorted(inputs)
+	examples, labels = [], []
+	for tp in sorted(split_paths):
+		label_key = os.path.basename(tp)
+		if label_key not in args.labels:
+			continue
+		split_examples = sorted(examples_in_directory(tp), key=str)
+		examples.extend(split_examples)
+		labels.extend([args.labels[label_key]] * len(split_examples))
+	labels = np.array(labels, dtype=np.int32)
+
+	partial_dir = cache_dir + '.' + str(os.getpid()) + '.partial'
+	os.makedirs(partial_dir)
+	print('Writing epoch cache of', len(examples), 'examples at:', cache_dir)
+	arrays = [np.lib.format.open_memmap(os.path.join(partial_dir, 'input_%d.npy' % i), mode='w+', dtype=np.float32, shape=(len(examples),)+tuple(inputs[name])) for i, name in enumerate(names)]
+	positions = []
+	for row, example in enumerate(examples):
+		try:
+			tensors = load_example_tensors(example, names, inputs)
+			for name, array in zip(names, arrays):
+				array[row] = tensors[name]
+		except Exception as e:
+			print('Leaving corrupt tensor at:', example, 'out of the epoch cache. Error is:', str(e))
+			labels[row] = -1
+		positions.append(position_string_from_example(example) if labels[row] >= 0 else '')
+	for array in arrays:
+		array.flush()
+	del arrays
+	np.save(os.path.join(partial_dir, 'labels.npy'), labels)
+	np.save(os.path.join(partial_dir, 'positions.npy'), np.array(positions, dtype=np.string_))
+	with open(os.path.join(partial_dir, 'complete.json'), 'w') as f:
+		json.dump({'inputs': names, 'fingerprint': fingerprint, 'examples': len(examples)}, f)
+
+	try:
+		os.rename(partial_dir, cache_dir)
+	except OSError: # Another process finished the same cache first
+		shutil.rmtree(partial_dir, ignore_errors=True)
+
+
+def annotation_store_generator(args, store, with_positions=False):
+	'''Generator of annotation minibatches sliced from a split of the annotation store, see array_store_generator().
+
+	Arguments:
+		args: args object needed for batch_size, labels, label_smoothing and annotation_set
+		store: A split of the store from load_annotation_store()
+		with_positions: boolean if True will include a list of position strings as the last element of each tuple
+	'''
+	return array_store_generator(args, {args.annotation_set: store['annotations']}, store['labels'], store['positions'], with_positions)
+
+
+def array_store_generator(args, inputs, labels, positions, with_positions=False):
+	'''Generator of minibatches sliced out of arrays holding a row for each example, in memory or memory mapped.
+
+	Samples like tensor_generator_from_label_dirs_and_args(): args.batch_size // len(args.labels) examples 
+	of each label per batch, reshuffling the examples of a label each time they are used up.
+	The rows of a batch are read in sorted order, which keeps reads from memory mapped arrays sequential.
+
+	Arguments:
+		args: args object needed for batch_size, labels and label_smoothing
+		inputs: dict mapping the names of the input tensors to arrays with a row for each example
+		labels: array with the label index of each example, negative for examples to leave out
+		positions: array with the position string of each example, as bytes
+		with_positions: boolean if True will include a list of position strings as the last element of each tuple
+
+	Returns:
+		A tuple with a dict of the input tensors and a 1-Hot matrix (2D numpy array) of the labels.
+	'''
+	stats = Counter()
+	per_batch_per_label = (args.batch_size // len(args.labels))
+	label_rows = {}
+	for label in sorted(set(args.labels.values())):
+		label_rows[label] = np.random.permutation(worker_share(np.flatnonzero(labels == label)))
+		if len(label_rows[label]) == 0:
+			print('No examples of label:', label, 'in the stored arrays.')
+			del label_rows[label]
+	offsets = Counter()
+	shapes = {name: (args.batch_size,) + array.shape[1:] for name, array in inputs.items()}
+	buffers = batch_buffers_from_args(args, dict(shapes, labels=(args.batch_size, len(args.labels))))
+
+	while True:
+		arrays = buffers.next()
+		rows = []
+		for label in label_rows:
+			take = per_batch_per_label
+			while take > 0:
+				chunk = label_rows[label][offsets[label]:offsets[label]+take]
+				rows.append(chunk)
+				take -= len(chunk)
+				offsets[label] += len(chunk)
+				if offsets[label] == len(label_rows[label]):
+					np.random.shuffle(label_rows[label])
+					stats['label'+str(label)+'epochs'] += 1
+					print('\n\nGenerator looped over:', offsets[label], 'examples of label:', label, 'epochs:', stats['label'+str(label)+'epochs'])
+					offsets[label] = 0
+		rows = np.sort(np.concatenate(rows))
+
+		label_matrix = arrays['labels']
+		label_matrix[:] = args.label_smoothing/(len(args.labels)-1)
+		label_matrix[np.arange(len(rows)), labels[rows]] = 1.0-args.label_smoothing
+		batch = {}
+		for name, array in inputs.items():
+			batch[name] = arrays[name]
+			if array.dtype == batch[name].dtype:
+				np.take(array, rows, axis=0, out=batch[name][:len(rows)], mode='clip') # clip mode does not buffer
+			else:
+				batch[name][:len(rows)] = array[rows]
+
+		if with_positions:
+			yield (batch, label_matrix, [p.decode('utf-8') for p in positions[rows]])
+		else:
+			yield (batch, label_matrix)
+
+
+class IndexedBatches(object):
+	'''Minibatches addressed by index, like a keras.utils.Sequence, see models.MinibatchSequence.
+
+	Batch i of an epoch depends only on the seed, the epoch and i, so batches can be loaded 
+	by any number of workers in any order and each epoch covers the examples exactly as planned by epoch_order().
+	Subclasses define __len__(), the number of batches per epoch, epoch_order(rng), which returns the example indices
+	of an epoch with batch i made of entries i*batch_size to (i+1)*batch_size, and load_batch(rows), which returns
+	the minibatch tuple of those indices. Iterating walks through the epochs in order, 
+	so these also work wherever the minibatch generators are used.
+	'''
+	def __init__(self, args, seed=None):
+		self.args = args
+		self.seed = np.random.randint(2**31 - 2**16) if seed is None else seed
+		self.epoch = 0
+		self.order = None
+		self.cursor = 0
+
+	def __getitem__(self, index):
+		if index < 0 or index >= len(self):
+			raise IndexError('Error! Batch index: ' + str(index) + ' is out of range for ' + str(len(self)) + ' batches.')
+		if self.order is None:
+			self.order = self.epoch_order(np.random.RandomState(self.seed + self.epoch))
+		return self.load_batch(self.order[index*self.args.batch_size:(index+1)*self.args.batch_size])
+
+	def on_epoch_end(self):
+		self.epoch += 1
+		self.order = None
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		if self.cursor == len(self):
+			self.on_epoch_end()
+			self.cursor = 0
+		self.cursor += 1
+		return self[self.cursor-1]
+
+	next = __next__ # Python 2
+
+
+class LabelBalancedBatches(IndexedBatches):
+	'''Index based version of the label balanced generators over labelled directories of tensors.
+
+	Like tensor_generator_from_label_dirs_and_args() every batch holds args.batch_size // len(args.labels) examples 
+	of each label. Each epoch visits every example of the largest label once, in a new shuffled order, 
+	and cycles through the shuffled examples of the smaller labels to fill their share of each batch.
+	When the largest label does not fill the last batch its share wraps around to the start of its shuffle, 
+	so a few of its examples are visited twice in that epoch.
+	Batch slots of labels without examples and corrupt examples, which are reported, are left out of the batch,
+	so batches can be smaller than args.batch_size.
+
+	Arguments:
+		args: args object needed for batch_size and labels
+		train_paths: array of label directories with hd5 tensors within each
+		inputs: dict mapping the names of the input tensors of the batch to the names of the tensors loaded for them
+		shapes: optional dict mapping input names to the shape to load them with, see load_example_tensors()
+		label_smoothing: Rate of label smoothing
+		with_positions: If True batches end with a list of the position strings of their examples
+		seed: Random seed of the shuffles, each epoch is shuffled with seed + epoch
+	'''
+	def __init__(self, args, train_paths, inputs, shapes={}, label_smoothing=0.0, with_positions=False, seed=None):
+		super(LabelBalancedBatches, self).__init__(args, seed)
+		self.inputs = inputs
+		self.shapes = shapes
+		self.label_smoothing = label_smoothing
+		self.with_positions = with_positions
+		self.per_batch_per_label = args.batch_size // len(args.labels)
+		self.examples = []
+		self.example_labels = []
+		for tp in train_paths:
+			label_key = os.path.basename(tp)
+			if label_key not in args.labels:
+				print('Skipping label directory:', label_key, ' which is not in args label set:', args.labels.keys())
+				continue
+			examples = sorted(examples_in_directory(tp), key=str)
+			self.examples.extend(examples)
+			self.example_labels.extend([args.labels[label_key]] * len(examples))
+		self.index_labels(self.example_labels)
+
+	def index_labels(self, example_labels):
+		'''Group the example indices by label, leaving out negative labels, and count the batches of an epoch.'''
+		example_labels = np.asarray(example_labels)
+		self.label_rows = {label: np.flatnonzero(example_labels == label) for label in sorted(set(self.args.labels.values()))}
+		self.label_rows = {label: rows for label, rows in self.label_rows.items() if len(rows) > 0}
+		self.batch_count = -(-max(len(rows) for rows in self.label_rows.values()) // self.per_batch_per_label)
+
+	def __len__(self):
+		return self.batch_count
+
+	def epoch_order(self, rng):
+		order = np.full((self.batch_count, self.args.batch_size), -1, dtype=np.int64)
+		for i, label in enumerate(sorted(self.label_rows)):
+			rows = rng.permutation(self.label_rows[label])
+			take = np.arange(self.batch_count * self.per_batch_per_label) % len(rows)
+			order[:, i*self.per_batch_per_label:(i+1)*self.per_batch_per_label] = rows[take].reshape((self.batch_count, self.per_batch_per_label))
+		return order.reshape((-1,))
+
+	def load_batch(self, rows):
+		keys = list(self.inputs.values())
+		shapes = {key: self.shapes.get(name) for name, key in self.inputs.items()}
+		loaded, labels, positions = [], [], []
+		for row in rows:
+			if row < 0:
+				continue # Fewer labels than batch slots
+			example = self.examples[row]
+			try:
+				tensors = load_example_tensors(example, keys, shapes)
+				missing = [key for key in keys if tensors[key] is None]
+				if missing:
+					raise ValueError('Error! Missing tensors: ' + str(missing))
+			except Exception as e:
+				print('Skipping corrupt tensor at:', example, 'Error is:', str(e))
+				continue
+			loaded.append(tensors)
+			labels.append(self.example_labels[row])
+			if self.with_positions:
+				positions.append(position_string_from_example(example))
+
+		batch = {}
+		for name, key in self.inputs.items():
+			shape = self.shapes.get(name)
+			if shape is None:
+				shape = loaded[0][key].shape if loaded else (0,)
+			batch[name] = np.zeros((len(loaded),) + tuple(shape), dtype=self.args.batch_dtype)
+			for i, tensors in enumerate(loaded):
+				batch[name][i] = tensors[key]
+		label_matrix = np.full((len(loaded), len(self.args.labels)), self.label_smoothing/(len(self.args.labels)-1))
+		label_matrix[np.arange(len(loaded)), labels] = 1.0-self.label_smoothing
+		if self.with_positions:
+			return (batch, label_matrix, positions)
+		return (batch, label_matrix)
+
+
+class ArrayStoreBatches(LabelBalancedBatches):
+	'''Index based version of array_store_generator(), label balanced batches sliced out of arrays with a row for each example.
+
+	Batches are planned like those of LabelBalancedBatches and their rows are read in sorted order,
+	which keeps reads from memory mapped arrays sequential.
+
+	Arguments:
+		args: args object needed for batch_size, labels, label_smoothing and batch_dtype
+		inputs: dict mapping the names of the input tensors to arrays with a row for each example
+		labels: array with the label index of each example, negative for examples to leave out
+		positions: array with the position string of each example, as bytes
+		with_positions: If True batches end with a list of the position strings of their examples
+		seed: Random seed of the shuffles, each epoch is shuffled with seed + epoch
+	'''
+	def __init__(self, args, inputs, labels, positions, with_positions=False, seed=None):
+		IndexedBatches.__init__(self, args, seed)
+		self.arrays = inputs
+		self.example_labels = np.asarray(labels)
+		self.positions = positions
+		self.label_smoothing = args.label_smoothing
+		self.with_positions = with_positions
+		self.per_batch_per_label = args.batch_size // len(args.labels)
+		self.index_labels(self.example_labels)
+
+	def load_batch(self, rows):
+		rows = np.sort(rows[rows >= 0])
+		batch = {name: array[rows].astype(self.args.batch_dtype, copy=False) for name, array in self.arrays.items()}
+		label_matrix = np.full((len(rows), len(self.args.labels)), self.label_smoothing/(len(self.args.labels)-1))
+		label_matrix[np.arange(len(rows)), self.example_labels[rows]] = 1.0-self.label_smoothing
+		if self.with_positions:
+			return (batch, label_matrix, [p.decode('utf-8') for p in self.positions[rows]])
+		return (batch, label_matrix)
+
+
+class CallingBatches(IndexedBatches):
+	'''Index based version of calling_tensors_generator(), each epoch is a new shuffle of all the examples.
+
+	The last examples of a shuffle which do not fill a batch are left out of that epoch.
+	Examples which fail to load are reported and left out of their batch.
+	'''
+	def __init__(self, args, train_paths, seed=None):
+		super(CallingBatches, self).__init__(args, seed)
+		self.examples = sorted(train_paths, key=str)
+		in_channels = defines.total_input_channels_from_args(args)
+		if args.channels_last:
+			self.tensor_shape = (args.read_limit, args.window_size, in_channels)
+		else:
+			self.tensor_shape = (in_channels, args.read_limit, args.window_size) 
+
+	def __len__(self):
+		return len(self.examples) // self.args.batch_size
+
+	def epoch_order(self, rng):
+		return rng.permutation(len(self.examples))
+
+	def load_batch(self, rows):
+		tensor = np.zeros(((self.args.batch_size,)+self.tensor_shape), dtype=self.args.batch_dtype)
+		label_matrix = np.zeros((self.args.batch_size, self.args.window_size, len(self.args.labels)))
+		loaded = 0
+		for row in rows:
+			try:
+				example = load_example_tensors(self.examples[row], ['read_tensor', 'site_labels'])
+				tensor[loaded] = example['read_tensor']
+				label_matrix[loaded] = np.eye(len(self.args.labels))[np.array(example['site_labels'], dtype=int)]
+				loaded += 1
+			except Exception as e:
+				print('Skipping tensor at:', self.examples[row], 'Error is:', str(e))
+		return ({'read_tensor':tensor[:loaded]}, label_matrix[:loaded])
+
+
+def tensor_batches(args, train_paths, tensor_shape):
+	'''Index based version of tensor_generator().'''
+	return LabelBalancedBatches(args, train_paths, {'read_tensor':'read_tensor'}, {'read_tensor':tensor_shape})
+
+
+def tensor_annotation_batches(args, train_paths, tensor_shape):
+	'''Index based version of tensor_annotation_generator().'''
+	inputs = {args.tensor_map:args.tensor_map, args.annotation_set:args.annotation_set}
+	return LabelBalancedBatches(args, train_paths, inputs, {args.tensor_map:tensor_shape, args.annotation_set:(len(args.annotations),)})
+
+
+def label_dirs_batches(args, train_paths, with_positions=False):
+	'''Index based version of tensor_generator_from_label_dirs_and_args().'''
+	inputs = {}
+	shapes = tensor_shapes_from_args(args)
+	if defines.get_tensor_channel_map_from_args(args):
+		inputs[args.tensor_map] = args.tensor_map
+	if defines.annotations_from_args(args):
+		inputs[args.annotation_set] = args.annotation_set
+		shapes[args.annotation_set] = (len(args.annotations),)
+	return LabelBalancedBatches(args, train_paths, inputs, shapes, args.label_smoothing, with_positions)
+
+
+def annotation_store_batches(args, store, with_positions=False):
+	'''Index based version of annotation_store_generator().'''
+	return ArrayStoreBatches(args, {args.annotation_set: store['annotations']}, store['labels'], store['positions'], with_positions)
+
+
+def bqsr_tensor_batches(args, train_paths):
+	'''Index based version of bqsr_tensor_generator().'''
+	return LabelBalancedBatches(args, train_paths, {'read_tensor_input':'read_tensor'}, {'read_tensor_input':(args.window_size, len(args.input_symbols))})
+
+
+def bqsr_tensor_annotation_batches(args, train_paths):
+	'''Index based version of bqsr_tensor_annotation_generator().'''
+	inputs = {args.tensor_map:args.tensor_map, args.annotation_set:args.annotation_set}
+	shapes = {args.tensor_map:(args.window_size, len(args.input_symbols)), args.annotation_set:(len(args.annotations),)}
+	return LabelBalancedBatches(args, train_paths, inputs, shapes)
+
 
-	return input_data, np.array(labels), positions
+# Index based versions of minibatch generators, used by minibatches_from_args() when args.indexed_batches is set
+indexed_batch_feeds = {
+	tensor_generator: tensor_batches,
+	tensor_annotation_generator: tensor_annotation_batches,
+	tensor_generator_from_label_dirs_and_args: label_dirs_batches,
+	bqsr_tensor_generator: bqsr_tensor_batches,
+	bqsr_tensor_annotation_generator: bqsr_tensor_annotation_batches,
+	calling_tensors_generator: CallingBatches,
+	array_store_generator: ArrayStoreBatches,
+	annotation_store_generator: annotation_store_batches,
+}
+
+
+def minibatches_from_args(args, generator_function, *generator_args, **generator_kwargs):
+	'''Minibatches of a generator function, index based if args.indexed_batches is set and prefetched if args.prefetch_workers is.
+
+	Arguments:
+		args.indexed_batches: If True and generator_function has an index based version in indexed_batch_feeds,
+			return that so models.train_model_from_generators() can load batches with a Keras worker pool
+		generator_function: a minibatch generator like tensor_generator(), called with generator_args and generator_kwargs
+
+	Returns:
+		An IndexedBatches, or a generator of minibatches, see prefetch_generator()
+	'''
+	if args.indexed_batches and generator_function in indexed_batch_feeds:
+		return indexed_batch_feeds[generator_function](*generator_args, **generator_kwargs)
+	return prefetch_generator(args, generator_function, *generator_args, **generator_kwargs)
 
 
 def load_images_from_class_dirs(args, train_paths, shape=(224,224), per_class_max=2500, position_dict=None):
@@ -2619,14 +4364,10 @@ def load_images_from_class_dirs(args, train_paths, shape=(224,224), per_class_ma
 			continue
 		label = args.labels[label_key] 
 
-		imgs = os.listdir(tp)
+		imgs = [img for img in os.listdir(tp) if os.path.splitext(img)[1].lower() in image_exts]
 		count += 1
 		this_t = 0
 		for im in imgs:		
-			fn, file_extension = os.path.splitext(im)
-			if file_extension.lower() == '.gif':
-				continue
-
 			if this_t > per_class_max:
 				print('Per class max reached. bailing at', this_t)
 				break
@@ -2667,7 +4408,7 @@ def load_tensors_from_class_dirs(args, train_paths, per_class_max=2500, dataset_
 			print('Skipping label directory:', label_key, ' which is not in args label set:', args.labels.keys())
 			continue
 		label = args.labels[label_key] 
-		imgs = os.listdir(tp)
+		imgs = examples_in_directory(tp)
 		count += 1
 		print(count, " dir out of:", len(train_paths), tp, "has:", len(imgs))
 		this_t = 0
@@ -2677,23 +4418,18 @@ def load_tensors_from_class_dirs(args, train_paths, per_class_max=2500, dataset_
 				print('Per class max reached. bailing at', this_t)
 				break
 
-			fn, file_extension = os.path.splitext(t)
-			if not file_extension.lower() in tensor_exts:
-				continue
-
-			with h5py.File(tp+'/'+t, 'r') as hf:
-				A = np.array(hf.get(dataset_id))
-				if tensor_shape:
-					if A.shape!=tensor_shape:
-						print("ERROR: unexpected tensor shape:",A.shape,"vs expected",tensor_shape)
-						continue
-				tensors.append(A)
+			A = np.array(load_example_tensor(t, dataset_id, tensor_shape))
+			if tensor_shape:
+				if A.shape!=tensor_shape:
+					print("ERROR: unexpected tensor shape:",A.shape,"vs expected",tensor_shape)
+					continue
+			tensors.append(A)
 				
 			y_vector = np.zeros(len(args.labels)) # One hot Y vector of size labels, correct label is 1 all others are 0
 			y_vector[label] = 1.0
 
 			labels.append(y_vector)
-			positions.append(position_string_from_tensor_name(t))
+			positions.append(position_string_from_example(t))
 
 	return (np.asarray(tensors), np.asarray(labels), np.asarray(positions))
 
@@ -2712,7 +4448,7 @@ def load_tensors_and_annotations_from_class_dirs(args, train_paths, per_class_ma
 			continue
 
 		label = args.labels[label_key] 
-		imgs = os.listdir(tp)
+		imgs = examples_in_directory(tp)
 		count += 1
 		this_t = 0
 		for t in imgs:	
@@ -2720,18 +4456,14 @@ def load_tensors_and_annotations_from_class_dirs(args, train_paths, per_class_ma
 				print('Per class max reached. bailing at', this_t)
 				break
 
-			fn, file_extension = os.path.splitext(t)
-			if not file_extension.lower() in tensor_exts:
-				continue
-
-			with h5py.File(tp+'/'+t, 'r') as hf:
-				tensors.append(np.array(hf.get(args.tensor_map)))
-				annotations.append(np.array(hf.get(args.annotation_set)))
+			example = load_example_tensors(t, [args.tensor_map, args.annotation_set], tensor_shapes_from_args(args))
+			tensors.append(np.array(example[args.tensor_map]))
+			annotations.append(np.array(example[args.annotation_set]))
 
 			y_vector = np.zeros(len(args.labels)) # One hot Y vector of size labels, correct label is 1 all others are 0
 			y_vector[label] = 1.0
 			labels.append(y_vector)
-			positions.append(position_string_from_tensor_name(t))
+			positions.append(position_string_from_example(t))
 			this_t += 1
 
 		print(count, " dir out of:", len(train_paths), tp, "has:", len(imgs), 'Loaded:', this_t)
@@ -2751,7 +4483,7 @@ def load_bqsr_tensors_from_class_dirs(args, train_paths, per_class_max=4000):
 			print('Skipping label directory:', label_key, ' which is not in args label set:', args.labels.keys())
 			continue
 		label = args.labels[label_key] 
-		imgs = os.listdir(tp)
+		imgs = examples_in_directory(tp)
 		count += 1
 		print(count, " dir out of:", len(train_paths), tp, "has:", len(imgs))
 		this_t = 0
@@ -2761,12 +4493,7 @@ def load_bqsr_tensors_from_class_dirs(args, train_paths, per_class_max=4000):
 				print('Per class max reached. bailing at', this_t)
 				break
 
-			fn, file_extension = os.path.splitext(t)
-			if not file_extension.lower() in tensor_exts:
-				continue
-
-			with h5py.File(tp+'/'+t, 'r') as hf:
-				tensors.append(np.array(hf.get(args.tensor_map)))
+			tensors.append(np.array(load_example_tensor(t, args.tensor_map, defines.tensor_shape_from_args(args))))
 				
 			y_vector = np.zeros(len(args.labels)) # One hot Y vector of size labels, correct label is 1 all others are 0
 			y_vector[label] = 1.0
@@ -2788,7 +4515,7 @@ def load_bqsr_tensors_annotations_from_class_dirs(args, train_paths, per_class_m
 			print('Skipping label directory:', label_key, ' which is not in args label set:', args.labels.keys())
 			continue
 		label = args.labels[label_key] 
-		imgs = os.listdir(tp)
+		imgs = examples_in_directory(tp)
 		count += 1
 		print(count, " dir out of:", len(train_paths), tp, "has:", len(imgs))
 		this_t = 0
@@ -2798,13 +4525,9 @@ def load_bqsr_tensors_annotations_from_class_dirs(args, train_paths, per_class_m
 				print('Per class max reached. bailing at', this_t)
 				break
 
-			fn, file_extension = os.path.splitext(t)
-			if not file_extension.lower() in tensor_exts:
-				continue
-
-			with h5py.File(tp+'/'+t, 'r') as hf:
-				tensors.append(np.array(hf.get(args.tensor_map)))
-				annotations.append(np.array(hf.get(args.annotation_set)))
+			example = load_example_tensors(t, [args.tensor_map, args.annotation_set])
+			tensors.append(np.array(example[args.tensor_map]))
+			annotations.append(np.array(example[args.annotation_set]))
 				
 			y_vector = np.zeros(len(args.labels)) # One hot Y vector of size labels, correct label is 1 all others are 0
 			y_vector[label] = 1.0
@@ -2813,6 +4536,913 @@ def load_bqsr_tensors_annotations_from_class_dirs(args, train_paths, per_class_m
 	return (np.asarray(tensors), np.asarray(annotations), np.asarray(labels))
 
 
+def tensor_writer_from_args(args, compression='gzip'):
+	'''Get the writer that stores examples as args.tensor_storage says.
+
+	Arguments:
+		args.tensor_storage: 'files' for one hd5 file per example, 'shards' to pack many examples in each file
+		args.tensors_per_shard: Maximum number of examples in each shard
+		args.async_writer: 'none' to write in the calling thread, 'thread' or 'process' to write in the background
+		args.writer_queue_size: Maximum number of examples waiting for the background writer
+		compression: hd5 compression filter the writer uses unless args.compression is set
+
+	Returns:
+		writer: object with write(tensor_path, tensors), output_path(tensor_path), flush() and close() methods
+	'''
+	filters = hd5_filters_from_args(args, compression)
+	if args.tensor_storage == 'files':
+		writer = TensorFileWriter(filters, dataset_metadata_from_args(args, filters))
+	elif args.tensor_storage == 'shards':
+		writer = TensorShardWriter(args, filters)
+	else:
+		raise ValueError('Error! Unknown tensor storage:', args.tensor_storage)
+
+	if args.async_writer == 'none':
+		return writer
+	# Daemonic processes, like the workers of scatter_tensor_writer, cannot start processes of their own
+	use_process = args.async_writer == 'process' and not multiprocessing.current_process().daemon
+	return AsyncTensorWriter(writer, args.writer_queue_size, use_process)
+
+
+def hd5_filters_from_args(args, compression='gzip'):
+	'''Get the compression, shuffle and chunking options for writing tensors to hd5.
+
+	Arguments:
+		args.compression: 'none', 'lzf' or 'gzip', when not set the compression argument is used
+		args.compression_level: gzip level from 0 (fastest) to 9 (smallest)
+		args.shuffle_filter: If True bytes are shuffled before compression, which often helps floats compress
+		args.chunk_shape: Chunk shape for tensors with as many dimensions, others are chunked automatically
+		args.chunk_examples: Number of examples in each chunk of a shard
+		compression: Default compression filter of the writer, or None
+
+	Returns:
+		filters: dict of the options, see dataset_filter_kwargs()
+	'''
+	compression = args.compression or compression
+	if compression == 'none':
+		compression = None
+	elif compression not in [None, 'lzf', 'gzip']:
+		raise ValueError('Error! Unknown compression:', compression)
+
+	filters = {}
+	filters['compression'] = compression
+	filters['compression_opts'] = args.compression_level if compression == 'gzip' else None
+	filters['shuffle'] = args.shuffle_filter
+	filters['chunk_shape'] = tuple(args.chunk_shape) if args.chunk_shape else None
+	filters['chunk_examples'] = args.chunk_examples
+	return filters
+
+
+def dataset_filter_kwargs(filters, tensor_shape, stacked=False):
+	'''Keyword arguments for h5py create_dataset() to write a tensor with the given filters.
+
+	Arguments:
+		filters: dict from hd5_filters_from_args()
+		tensor_shape: Shape of one example's tensor
+		stacked: If True the dataset stacks examples along a new first axis, as shards do
+
+	Returns:
+		kwargs: dict with compression, compression_opts, shuffle and (if needed) chunks
+	'''
+	kwargs = {'compression':filters['compression'], 'compression_opts':filters['compression_opts'], 'shuffle':filters['shuffle']}
+	chunks = None
+	if filters['chunk_shape'] and len(filters['chunk_shape']) == len(tensor_shape):
+		chunks = tuple(max(1, min(c, s)) for c, s in zip(filters['chunk_shape'], tensor_shape))
+	if stacked:
+		chunks = (filters['chunk_examples'],) + (chunks or tuple(tensor_shape))
+	if chunks:
+		kwargs['chunks'] = chunks
+	return kwargs
+
+
+def dataset_metadata_from_args(args, filters):
+	'''Dict of the arguments that describe how tensors were written, stored as hd5 attributes.'''
+	metadata = {}
+	for k in ['tensor_map', 'window_size', 'read_limit', 'read_sort', 'channels_last', 'base_quality_mode', 
+			'annotation_set', 'bam_file', 'negative_vcf', 'train_vcf', 'bed_file', 'reference_fasta']:
+		if getattr(args, k, None) is not None:
+			metadata[k] = getattr(args, k)
+	metadata['tensor_types'] = json.dumps(getattr(args, 'tensor_types', []))
+	sources = set(defines.derived_tensor_maps.values()).intersection(stored_tensor_types(getattr(args, 'tensor_types', [])))
+	metadata['channel_maps'] = json.dumps({tm: defines.get_tensor_channel_map_by_name(tm) for tm in sources})
+	metadata['compression'] = filters['compression'] or 'none'
+	metadata['compression_level'] = filters['compression_opts'] or 0
+	metadata['shuffle_filter'] = filters['shuffle']
+	metadata['chunk_shape'] = json.dumps(filters['chunk_shape'])
+	return metadata
+
+
+def make_dirs(directory):
+	'''Create a directory and its parents unless it already exists, safe when several writer processes race.'''
+	try:
+		os.makedirs(directory)
+	except OSError:
+		if not os.path.isdir(directory):
+			raise
+
+
+class TensorFileWriter(object):
+	'''Write each example to its own hd5 file at the tensor path, the original dataset layout.'''
+	def __init__(self, filters, metadata):
+		self.filters = filters
+		self.metadata = metadata
+
+	def write(self, tensor_path, tensors):
+		'''Write a dict mapping dataset names to tensors, tensors which are None are skipped.'''
+		make_dirs(os.path.dirname(tensor_path))
+		with h5py.File(tensor_path, 'w') as hf:
+			for k in self.metadata:
+				hf.attrs[k] = self.metadata[k]
+			for key in tensors:
+				if tensors[key] is not None:
+					hf.create_dataset(key, data=tensors[key], **dataset_filter_kwargs(self.filters, tensors[key].shape))
+
+	def output_path(self, tensor_path):
+		'''Glob pattern matching the file the next write of this tensor path goes to.'''
+		return tensor_path
+
+	def flush(self):
+		pass
+
+	def close(self):
+		pass
+
+
+class TensorShardWriter(object):
+	'''Pack examples into shard files holding up to args.tensors_per_shard examples each.
+
+	Examples whose tensor paths share a directory (i.e. a split and a label) are written to the same shards,
+	so the usual data_dir/train|valid|test/label/ layout is kept with far fewer files.
+	Each shard has a chunked array for every tensor key with one row per example
+	and a boolean present/<key> array for rows missing that tensor.
+	The tensor_names, contigs and positions arrays say where each row came from.
+	Shard attributes hold the metadata of the writing arguments 
+	and the count of complete rows, which is set when the shard is closed.
+	'''
+	def __init__(self, args, filters):
+		self.filters = dict(filters, chunk_examples=min(filters['chunk_examples'], args.tensors_per_shard))
+		self.tensors_per_shard = args.tensors_per_shard
+		self.metadata = dataset_metadata_from_args(args, filters)
+		self.prefix = uuid.uuid4().hex[:12] # Unique so parallel writers never share a shard
+		self.flushes = 0
+		self.shards = {}
+		self.rows = Counter()
+		self.shard_counts = Counter()
+
+	def write(self, tensor_path, tensors):
+		'''Append a dict mapping dataset names to tensors to the shard for this tensor path's directory.'''
+		directory, tensor_name = os.path.split(tensor_path)
+		if directory not in self.shards:
+			self.open_shard(directory)
+		hf = self.shards[directory]
+		row = self.rows[directory]
+
+		for key in tensors:
+			if tensors[key] is None:
+				continue
+			if key not in hf:
+				hf.create_dataset(key, shape=(self.tensors_per_shard,)+tensors[key].shape, dtype=tensors[key].dtype,
+								maxshape=(None,)+tensors[key].shape, **dataset_filter_kwargs(self.filters, tensors[key].shape, stacked=True))
+				hf.create_dataset('present/'+key, shape=(self.tensors_per_shard,), dtype=bool, maxshape=(None,))
+			hf[key][row] = tensors[key]
+			hf['present/'+key][row] = True
+
+		gpos = position_string_from_tensor_name(tensor_name).split('_')
+		hf['tensor_names'][row] = tensor_name
+		hf['contigs'][row] = gpos[0]
+		hf['positions'][row] = int(gpos[1])
+
+		self.rows[directory] += 1
+		if self.rows[directory] == self.tensors_per_shard:
+			self.close_shard(directory)
+
+	def output_path(self, tensor_path):
+		'''Glob pattern matching the shard the next write of this tensor path goes to, and any shards after it until the next flush().'''
+		return os.path.join(os.path.dirname(tensor_path), '%s_%d_*%s' % (self.prefix, self.flushes, shard_ext))
+
+	def shard_path(self, directory):
+		return os.path.join(directory, '%s_%d_%d%s' % (self.prefix, self.flushes, self.shard_counts[directory], shard_ext))
+
+	def open_shard(self, directory):
+		make_dirs(directory)
+		shard_path = self.shard_path(directory)
+		self.shard_counts[directory] += 1
+
+		hf = h5py.File(shard_path, 'w')
+		for k in self.metadata:
+			hf.attrs[k] = self.metadata[k]
+		hf.attrs['count'] = 0
+		string_type = h5py.special_dtype(vlen=str)
+		for name, dtype in [('tensor_names', string_type), ('contigs', string_type), ('positions', np.int64)]:
+			hf.create_dataset(name, shape=(self.tensors_per_shard,), dtype=dtype, maxshape=(None,))
+		self.shards[directory] = hf
+		self.rows[directory] = 0
+
+	def close_shard(self, directory):
+		hf = self.shards.pop(directory)
+		rows = self.rows.pop(directory)
+		for name in ['tensor_names', 'contigs', 'positions']:
+			hf[name].resize((rows,))
+		for key in hf['present']:
+			hf[key].resize((rows,)+hf[key].shape[1:])
+			hf['present/'+key].resize((rows,))
+		hf.attrs['count'] = rows
+		hf.close()
+
+	def flush(self):
+		'''Close the open shards so every example written so far is safely on disk, later examples go to new shards.'''
+		for directory in list(self.shards.keys()):
+			self.close_shard(directory)
+		self.flushes += 1
+
+	def close(self):
+		self.flush()
+
+
+class AsyncTensorWriter(object):
+	'''Run a tensor writer in a background thread or process fed by a bounded queue.
+
+	The writing loop hands finished tensors off and goes on fetching reads and encoding 
+	while the hd5 files are created, compressed and closed in the background, which hides most of the file system latency.
+	Tensors must not be changed after they are given to write().
+	An error in the background writer is raised by the next write(), flush() or close().
+	flush() and close() wait until every queued example is written, close() is also called at exit.
+	'''
+	def __init__(self, writer, queue_size=64, use_process=False):
+		self.writer = writer
+		self.use_process = use_process
+		if use_process:
+			self.requests = multiprocessing.Queue(queue_size)
+			self.replies = multiprocessing.Queue()
+			self.worker = multiprocessing.Process(target=async_tensor_writer_loop, args=(writer, self.requests, self.replies))
+		else:
+			self.requests = queue.Queue(queue_size)
+			self.replies = queue.Queue()
+			self.worker = threading.Thread(target=async_tensor_writer_loop, args=(writer, self.requests, self.replies))
+		self.worker.daemon = True
+		self.worker.start()
+		self.error = None
+		self.closed = False
+		atexit.register(self.close)
+
+	def write(self, tensor_path, tensors):
+		self.put(('write', (tensor_path, tensors)))
+
+	def output_path(self, tensor_path):
+		return self.writer.output_path(tensor_path)
+
+	def flush(self):
+		if self.closed:
+			return
+		self.put(('flush', ()))
+		self.wait_for_ack()
+		if self.use_process:
+			self.writer.flush() # Keeps shard names in step with the writer's copy in the background process
+
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		self.put(('close', ()))
+		self.wait_for_ack()
+		self.worker.join()
+
+	def put(self, request):
+		while True:
+			self.check_replies()
+			try:
+				self.requests.put(request, timeout=1.0)
+				return
+			except queue.Full:
+				self.check_worker()
+
+	def check_replies(self):
+		try:
+			while True:
+				self.raise_error(self.replies.get_nowait())
+		except queue.Empty:
+			pass
+
+	def wait_for_ack(self):
+		while True:
+			try:
+				reply = self.replies.get(timeout=1.0)
+			except queue.Empty:
+				self.check_worker()
+				continue
+			self.raise_error(reply)
+			if reply[0] == 'ack':
+				return
+
+	def raise_error(self, reply):
+		kind, error = reply
+		if error is not None and self.error is None:
+			self.error = error
+			raise ValueError('Error! Background tensor writer failed:\n' + error)
+
+	def check_worker(self):
+		if not self.worker.is_alive():
+			self.closed = True
+			if self.use_process:
+				self.requests.cancel_join_thread() # Otherwise exit waits for the dead worker to read the queue
+			raise ValueError('Error! Background tensor writer stopped unexpectedly.')
+
+
+def async_tensor_writer_loop(writer, requests, replies):
+	'''Worker of AsyncTensorWriter, calls the writer's methods in order until told to close.
+
+	Replies are (kind, error) tuples, an ('error', traceback) as soon as a call fails 
+	and an ('ack', error) after each flush and close. After an error later writes are dropped.
+	'''
+	error = None
+	while True:
+		method, arguments = requests.get()
+		if error is None:
+			try:
+				getattr(writer, method)(*arguments)
+			except Exception:
+				error = traceback.format_exc()
+				replies.put(('error', error))
+		if method != 'write':
+			replies.put(('ack', error))
+		if method == 'close':
+			return
+
+
+class WriteManifest(object):
+	'''Append-only record of the examples a tensor writer has finished, so an interrupted writer can resume.
+
+	The manifest lives in data_dir/manifests/ and is named after the mode and the genomic interval,
+	so each worker of scatter_tensor_writer keeps its own.
+	The writer hands its input (variants or window positions) through resume() 
+	and calls add() with the key of every example before writing it, which appends the key and the file it goes to.
+	After at least args.manifest_checkpoint new examples, between two input items, the tensor writer is flushed 
+	and a checkpoint line is appended holding the stats Counter and the number of input items finished.
+	On restart the stats are restored and the finished input items are skipped before any reads are fetched.
+	Files of examples added after the last checkpoint are deleted and the examples written again.
+	'''
+	def __init__(self, args, writer):
+		self.writer = writer
+		self.checkpoint_every = args.manifest_checkpoint
+		self.keys = set()
+		self.pending = []
+		self.stats = Counter()
+		self.cursor = 0
+		self.started = 0
+		self.complete = False
+		self.live_stats = None
+		self.statistics = None
+		self.live_statistics = None
+		if self.checkpoint_every < 1:
+			self.path = None
+			return
+
+		self.path = os.path.join(args.data_dir, 'manifests', interval_name_from_args(args) + '.manifest')
+		header = {'arguments': manifest_arguments(args)}
+		if os.path.exists(self.path):
+			self.load(header)
+			self.manifest = open(self.path, 'a')
+			print('Resuming from manifest:', self.path, 'with', len(self.keys), 'examples already written.')
+		else:
+			make_dirs(os.path.dirname(self.path))
+			self.manifest = open(self.path, 'w')
+			self.append([header])
+
+	def load(self, header):
+		'''Read keys, stats and cursor up to the last checkpoint, delete files written after it and truncate the manifest.'''
+		with open(self.path, 'r') as f:
+			lines = f.read().split('\n')[:-1] # The piece after the last newline is empty or torn
+		if len(lines) == 0 or json.loads(lines[0]) != json.loads(json.dumps(header)):
+			raise ValueError('Error! Manifest was written with different arguments, delete it to start over:', self.path)
+
+		offset = end = len(lines[0]) + 1
+		for line in lines[1:]:
+			offset += len(line) + 1
+			try:
+				entry = json.loads(line)
+			except ValueError:
+				break
+			if isinstance(entry, list):
+				self.pending.append(entry)
+			else:
+				self.keys.update(tuple(e[:3]) for e in self.pending)
+				self.pending = []
+				self.cursor = entry['checkpoint']
+				self.complete = entry['complete']
+				self.stats = Counter(entry['stats'])
+				self.statistics = entry.get('statistics')
+				end = offset
+
+		for pattern in set(e[4] for e in self.pending):
+			for tensor_file in glob.glob(pattern):
+				os.remove(tensor_file)
+		self.pending = []
+		with open(self.path, 'r+') as f:
+			f.truncate(end)
+
+	def resume(self, items, stats, statistics=None):
+		'''Restore the stats, skip the items finished before the last checkpoint and checkpoint between the rest.
+
+		Arguments:
+			items: the writer's input in the same order on every run, e.g. variants or window positions
+			stats: the writer's stats Counter, updated with the stats of earlier runs
+			statistics: Optional DatasetStatistics of the writer, merged with those of earlier runs
+
+		Yields:
+			The items not yet finished
+		'''
+		stats.update(self.stats)
+		self.live_stats = stats
+		if statistics is not None and self.statistics is not None:
+			statistics.merge(DatasetStatistics(self.statistics))
+		self.live_statistics = statistics
+		self.started = self.cursor
+		if self.complete:
+			return
+		for i, item in enumerate(items):
+			if i < self.cursor:
+				continue
+			if self.path is not None and len(self.pending) >= self.checkpoint_every:
+				self.checkpoint(i)
+			self.started = i + 1
+			yield item
+
+	def add(self, tensor_path, contig, pos, allele, tensor_types):
+		'''Record an example, call just before giving it to the tensor writer.'''
+		if self.path is None:
+			return
+		entry = [contig, pos, str(allele), tensor_types, self.writer.output_path(tensor_path)]
+		self.manifest.write(json.dumps(entry) + '\n')
+		self.manifest.flush()
+		self.pending.append(entry)
+
+	def checkpoint(self, finished_items, complete=False):
+		self.writer.flush()
+		self.keys.update(tuple(e[:3]) for e in self.pending)
+		self.pending = []
+		self.cursor = finished_items
+		entry = {'checkpoint': finished_items, 'complete': complete, 'stats': dict(self.live_stats)}
+		if self.live_statistics is not None:
+			entry['statistics'] = self.live_statistics.state()
+		self.append([entry])
+
+	def append(self, entries):
+		self.manifest.write(''.join(json.dumps(e) + '\n' for e in entries))
+		self.manifest.flush()
+		os.fsync(self.manifest.fileno())
+
+	def close(self):
+		'''Mark the manifest complete so a restart writes nothing, call after the tensor writer has been closed.'''
+		if self.path is None:
+			return
+		if self.live_stats is not None and not self.complete:
+			self.checkpoint(self.started, complete=True)
+		self.manifest.close()
+
+
+def interval_name_from_args(args):
+	'''Name of the mode, VCFs and genomic interval a writer works on, used to name its manifest and statistics.
+
+	The VCFs are named like in the tensor file names, so writers of different VCFs into one data_dir keep their own files.
+	'''
+	vcfs = '_'.join(plain_name(vcf_file) for vcf_file in [args.negative_vcf, args.train_vcf] if vcf_file)
+	return '%s_%s_%s_%d_%d' % (args.mode, vcfs or 'novcf', args.chrom or 'all', args.start_pos, args.end_pos)
+
+
+def manifest_arguments(args):
+	'''The arguments a writer must be restarted with to resume from its manifest.'''
+	arguments = {}
+	for k in ['tensor_types', 'tensor_map', 'bam_file', 'negative_vcf', 'train_vcf', 'bed_file', 'reference_fasta', 
+			'window_size', 'read_limit', 'samples', 'tensor_storage', 'channels_last']:
+		arguments[k] = getattr(args, k, None)
+	return arguments
+
+
+class DatasetStatistics(object):
+	'''Mergeable running statistics of the examples a tensor writer writes.
+
+	Keeps label counts, variant type counts (transitions, transversions, insertions and deletions), 
+	a histogram of the number of reads in each read tensor 
+	and Welford running means and variances of each annotation set, where zeros (missing values) are not counted.
+	Writers save them to a sidecar in data_dir/statistics/, merge_dataset_statistics() merges the sidecars 
+	so inspect_dataset's second pass over every tensor is not needed.
+	'''
+	def __init__(self, state=None):
+		state = state or {}
+		self.counts = Counter(state.get('counts', {}))
+		self.read_depths = Counter({int(k): v for k, v in state.get('read_depths', {}).items()})
+		self.moments = {}
+		for a_set, m in state.get('moments', {}).items():
+			self.moments[a_set] = {'names': m['names'], 'count': np.array(m['count'], dtype=float), 
+									'mean': np.array(m['mean']), 'm2': np.array(m['m2'])}
+
+	def add(self, label, variant, allele, annotations={}, read_depth=None):
+		'''Count an example of label for an allele of variant, with a dict of annotation vectors and its number of reads.'''
+		self.counts[label] += 1
+		self.counts['total'] += 1
+		ref, alt = variant.REF, str(allele)
+		if 'SNP' in label and len(ref) == 1 and len(alt) == 1:
+			transition = (ref in 'AG' and alt in 'AG') or (ref in 'CT' and alt in 'CT')
+			self.counts[label + (' transitions' if transition else ' transversions')] += 1
+		elif 'INDEL' in label:
+			self.counts[label + (' deletion' if len(alt) < len(ref) else ' insertion')] += 1
+
+		for a_set in annotations:
+			self.add_annotations(a_set, defines.annotations[a_set], annotations[a_set])
+		if read_depth is not None:
+			self.read_depths[int(read_depth)] += 1
+
+	def add_annotations(self, a_set, names, values):
+		values = np.asarray(values, dtype=float)
+		if a_set not in self.moments:
+			self.moments[a_set] = {'names': list(names), 'count': np.zeros(len(values)), 'mean': np.zeros(len(values)), 'm2': np.zeros(len(values))}
+		m = self.moments[a_set]
+		present = values != 0
+		m['count'] += present
+		delta = np.where(present, values - m['mean'], 0)
+		m['mean'] += delta / np.maximum(m['count'], 1)
+		m['m2'] += delta * np.where(present, values - m['mean'], 0)
+
+	def merge(self, other):
+		'''Add the statistics of other, e.g. from another writer, with Chan's parallel variance update.'''
+		self.counts.update(other.counts)
+		self.read_depths.update(other.read_depths)
+		for a_set, o in other.moments.items():
+			if a_set not in self.moments:
+				self.moments[a_set] = {k: np.copy(v) if k != 'names' else list(v) for k, v in o.items()}
+				continue
+			m = self.moments[a_set]
+			count = m['count'] + o['count']
+			delta = o['mean'] - m['mean']
+			scale = o['count'] / np.maximum(count, 1)
+			m['m2'] += o['m2'] + delta * delta * m['count'] * scale
+			m['mean'] += delta * scale
+			m['count'] = count
+
+	def means_and_stds(self, a_set):
+		'''Array of the mean and standard deviation of each annotation in a_set, like inspect_dataset() writes.'''
+		m = self.moments[a_set]
+		means_and_stds = np.zeros((len(m['names']), 2))
+		means_and_stds[:, 0] = m['mean']
+		means_and_stds[:, 1] = np.sqrt(m['m2'] / np.maximum(m['count'], 1))
+		return means_and_stds
+
+	def state(self):
+		'''JSON serializable dict of the statistics, DatasetStatistics(state) restores them.'''
+		moments = {}
+		for a_set, m in self.moments.items():
+			moments[a_set] = {'names': m['names'], 'count': m['count'].tolist(), 'mean': m['mean'].tolist(), 'm2': m['m2'].tolist()}
+		return {'counts': dict(self.counts), 'read_depths': {str(k): v for k, v in self.read_depths.items()}, 'moments': moments}
+
+	def save(self, path):
+		make_dirs(os.path.dirname(path))
+		with open(path + '.tmp', 'w') as f:
+			json.dump(self.state(), f)
+		os.rename(path + '.tmp', path)
+
+
+def statistics_path_from_args(args):
+	'''Path of the statistics sidecar of a writer, one for each VCF and each worker of scatter_tensor_writer, see interval_name_from_args().'''
+	return os.path.join(args.data_dir, 'statistics', interval_name_from_args(args) + '.json')
+
+
+def read_depth_of_tensor(tensor, channel_map, channels_last):
+	'''Number of reads in a read tensor, rows with any read channel set.'''
+	read_channels = [channel_map[k] for k in channel_map if k.startswith('read_')]
+	if channels_last:
+		return int(np.count_nonzero(tensor[:, :, read_channels].any(axis=(1, 2))))
+	return int(np.count_nonzero(tensor[read_channels].any(axis=(0, 2))))
+
+
+def merge_dataset_statistics(args):
+	'''Merge the statistics sidecars of a dataset, print them and write means_and_stds.hd5 like inspect_dataset().
+
+	Arguments:
+		args.data_dir: Dataset whose statistics/ directory holds the sidecars written by the tensor writers
+		args.annotation_set: Annotation set to write the means and standard deviations of
+
+	Returns:
+		statistics: The merged DatasetStatistics
+	'''
+	statistics = DatasetStatistics()
+	sidecars = sorted(glob.glob(os.path.join(args.data_dir, 'statistics', '*.json')))
+	for sidecar in sidecars:
+		with open(sidecar) as f:
+			statistics.merge(DatasetStatistics(json.load(f)))
+	print('Merged statistics from', len(sidecars), 'sidecars.')
+
+	stats = Counter(statistics.counts)
+	for k in ['SNP', 'NOT_SNP']:
+		stats[k+' Ti/Tv'] = stats[k+' transitions'] / (float(stats[k+' transversions']) + 1e-7)
+	for k in ['INDEL', 'NOT_INDEL']:
+		stats[k+' Insertion/Deletion'] = stats[k+' insertion'] / (float(stats[k+' deletion']) + 1e-7)
+	for k, v in sorted(stats.items()):
+		if k in args.labels:
+			print('%s has: %d tensors %2.0f percent' % (k, stats[k], (100*stats[k] / (float(stats['total']) + 1e-7))))
+		else:
+			print('%s has: %.2f' % (k, stats[k]))
+
+	if statistics.read_depths:
+		depths = np.array(sorted(statistics.read_depths.keys()))
+		counts = np.array([statistics.read_depths[d] for d in depths])
+		median = depths[np.searchsorted(np.cumsum(counts), counts.sum() / 2.0)]
+		print('Reads per tensor, mean: %.2f median: %d max: %d' % (np.dot(depths, counts) / counts.sum(), median, depths[-1]))
+
+	dataset_summary_latex_table_line(stats)
+	if args.annotation_set in statistics.moments:
+		means_and_stds = statistics.means_and_stds(args.annotation_set)
+		for a, (mean, std) in zip(statistics.moments[args.annotation_set]['names'], means_and_stds):
+			print('Annotation:', a, ' Has mean:', mean, 'variance:', std*std, 'std:', std)
+		with h5py.File(os.path.join(args.data_dir, 'means_and_stds.hd5'), 'w') as hf:
+			hf.create_dataset('means_and_stds', data=means_and_stds)
+	return statistics
+
+
+def shard_file(shard_path):
+	'''Get a read only handle to a shard from a small least recently used cache of open shards.
+
+	Handles are cached for each process, so generators in forked workers open their own.
+	'''
+	handles = open_shard_files.setdefault(os.getpid(), OrderedDict())
+	if shard_path in handles:
+		hf = handles.pop(shard_path)
+	else:
+		hf = h5py.File(shard_path, 'r')
+		if len(handles) >= max_open_shard_files:
+			handles.popitem(last=False)[1].close()
+	handles[shard_path] = hf
+	return hf
+
+
+def examples_in_directory(directory):
+	'''List the examples in a directory of hd5 tensor files and/or tensor shards.
+
+	Arguments:
+		directory: a label directory, (or a split directory for calling tensors)
+
+	Returns:
+		examples: List with the path of each hd5 tensor file and a (shard_path, row) tuple for each row of each shard
+	'''
+	examples = []
+	for t in os.listdir(directory):
+		path = os.path.join(directory, t)
+		if t.endswith(shard_ext):
+			examples.extend([(path, row) for row in range(int(shard_file(path).attrs['count']))])
+		elif os.path.splitext(t)[1] in tensor_exts:
+			examples.append(path)
+	return examples
+
+
+def load_example_tensors(example, keys, shapes={}):
+	'''Load tensors of an example from its own hd5 file or from its row in a shard.
+
+	Tensor maps in defines.derived_tensor_maps which were not written themselves are sliced 
+	out of the wider tensor they derive from, see derived_tensor().
+	Tensors written with a larger window or read limit than requested are cropped, see crop_tensor().
+
+	Arguments:
+		example: hd5 file path, or (shard_path, row) tuple from examples_in_directory()
+		keys: names of the tensors to load
+		shapes: Optional dict mapping keys to the shape to crop their tensors to, e.g. from tensor_shapes_from_args()
+
+	Returns:
+		tensors: dict mapping each key to a numpy array, or to None if the example does not have that tensor
+	'''
+	tensors = {}
+	if isinstance(example, tuple):
+		shard_path, row = example
+		hf = shard_file(shard_path)
+		for key in keys:
+			stored_key = stored_tensor_key(hf, key)
+			if stored_key in hf and hf['present/'+stored_key][row]:
+				tensors[key] = stored_tensor(hf, stored_key, key, hf[stored_key][row], shapes.get(key))
+			else:
+				tensors[key] = None
+	else:
+		with h5py.File(example, 'r') as hf:
+			for key in keys:
+				stored_key = stored_tensor_key(hf, key)
+				hf_tensor = hf.get(stored_key)
+				tensors[key] = None if hf_tensor is None else stored_tensor(hf, stored_key, key, np.array(hf_tensor), shapes.get(key))
+	return tensors
+
+
+def stored_tensor(hf, stored_key, key, tensor, shape=None):
+	'''Derive the tensor of key from a tensor loaded from dataset stored_key and crop it to shape if given.'''
+	tensor = derived_tensor(hf, stored_key, key, tensor)
+	if shape is not None and 'channels_last' in hf.attrs:
+		channel_map = defines.get_tensor_channel_map_by_name(key)
+		read_channels = [i for name, i in channel_map.items() if not name.startswith('reference')] if channel_map else None
+		tensor = crop_tensor(tensor, shape, bool(hf.attrs['channels_last']), read_channels, hf.attrs.get('read_sort', 'base'))
+	return tensor
+
+
+def crop_tensor(tensor, shape, channels_last, read_channels=None, read_sort='base'):
+	'''Crop a tensor written with a larger window or read limit to a smaller shape.
+
+	The window is cropped around its centre, where get_variant_window() puts the variant.
+	Like get_good_reads() the read limit is met by sampling reads at random, from the rows with reads 
+	overlapping the cropped window, which keep their stored order and are followed by empty rows.
+	Reads sorted by base are grouped by allele and sorted again after sampling when written, 
+	so their read limit cannot be reduced. Files written before the read sort was recorded used the default, base.
+	Tensors are 2D (window, channels) or 3D (reads, window, channels) when channels_last, else (channels, reads, window).
+
+	Arguments:
+		tensor: Tensor of one example as stored
+		shape: Shape to crop to, channels must match
+		channels_last: Layout of the stored tensor
+		read_channels: Indices of the channels of read data, a row with none of them set in the window has no read. 
+			If None every channel is used.
+		read_sort: args.read_sort of the writer
+
+	Returns:
+		tensor: The tensor with the requested shape, a view unless reads were sampled
+	'''
+	shape = tuple(shape)
+	if tensor.shape == shape or tensor.ndim != len(shape) or tensor.ndim not in [2, 3]:
+		return tensor
+	if any(want > have for want, have in zip(shape, tensor.shape)):
+		raise ValueError('Error! Cannot crop tensor of shape:', tensor.shape, 'to larger shape:', shape)
+
+	if tensor.ndim == 2:
+		window_axis = read_axis = 0
+	else:
+		window_axis, read_axis = (1, 0) if channels_last else (2, 1)
+	slices = []
+	for axis, (want, have) in enumerate(zip(shape, tensor.shape)):
+		if tensor.ndim == 3 and axis == read_axis:
+			slices.append(slice(None))
+		else:
+			start = (have//2 - want//2) if axis == window_axis else 0
+			slices.append(slice(start, start+want))
+	tensor = tensor[tuple(slices)]
+	if tensor.shape != shape:
+		tensor = sample_read_rows(tensor, shape[read_axis], channels_last, read_channels, read_sort)
+	return tensor
+
+
+def sample_read_rows(tensor, read_limit, channels_last, read_channels=None, read_sort='base'):
+	'''Keep up to read_limit randomly chosen rows with reads of a 3D read tensor, in their stored order, see crop_tensor().'''
+	if read_sort == 'base':
+		raise ValueError('Error! Cannot reduce the read limit of tensors with reads sorted by base, the first reads would mostly have one allele.')
+	reads = tensor if channels_last else np.moveaxis(tensor, 0, -1)
+	if read_channels is not None:
+		reads = reads[..., read_channels]
+	rows = np.flatnonzero(np.any(reads.reshape(reads.shape[0], -1) != 0, axis=1))
+	if len(rows) > read_limit:
+		rows = np.sort(np.random.choice(rows, size=read_limit, replace=False))
+	if channels_last:
+		sampled = np.zeros((read_limit,) + tensor.shape[1:], dtype=tensor.dtype)
+		sampled[:len(rows)] = tensor[rows]
+	else:
+		sampled = np.zeros((tensor.shape[0], read_limit, tensor.shape[2]), dtype=tensor.dtype)
+		sampled[:, :len(rows)] = tensor[:, rows]
+	return sampled
+
+
+def tensor_shapes_from_args(args):
+	'''Dict mapping args.tensor_map to the shape its tensors are loaded with, for load_example_tensors().'''
+	if defines.get_tensor_channel_map_from_args(args):
+		return {args.tensor_map: defines.tensor_shape_from_args(args)}
+	return {}
+
+
+def stored_tensor_types(tensor_types):
+	'''The tensor types a writer stores, derived tensor maps are replaced by the wider tensor map they are sliced from.'''
+	stored = []
+	for tt in tensor_types:
+		tt = defines.derived_tensor_maps.get(tt, tt)
+		if tt not in stored:
+			stored.append(tt)
+	return stored
+
+
+def stored_tensor_key(hf, key):
+	'''Name of the dataset that holds the tensor key in an open hd5 file or shard.'''
+	if key in defines.derived_tensor_maps and key not in hf and defines.derived_tensor_maps[key] in json.loads(hf.attrs.get('channel_maps', '{}')):
+		return defines.derived_tensor_maps[key]
+	return key
+
+
+def derived_tensor(hf, stored_key, key, tensor):
+	'''Slice the channels of tensor map key out of a tensor loaded from dataset stored_key, using the channel maps in the hd5 attributes.'''
+	if stored_key == key:
+		return tensor
+	stored_map = json.loads(hf.attrs['channel_maps'])[stored_key]
+	return tensor_channel_subset(tensor, stored_map, defines.get_tensor_channel_map_by_name(key), bool(hf.attrs['channels_last']))
+
+
+def tensor_channel_subset(tensor, from_map, to_map, channels_last):
+	'''Select the channels of to_map, by channel name, from a tensor laid out by from_map.
+
+	Arguments:
+		tensor: read tensor of one example
+		from_map: channel map of the tensor, dict mapping channel names to indices
+		to_map: channel map of the tensor to return, all its channel names must be in from_map
+		channels_last: If True channels are the last axis of the tensor, otherwise the first
+
+	Returns:
+		tensor: with len(to_map) channels ordered by their to_map indices
+	'''
+	indices = [from_map[name] for name in sorted(to_map, key=to_map.get)]
+	axis = -1 if channels_last else 0
+	if indices == list(range(indices[0], indices[0]+len(indices))):
+		slices = [slice(None)] * tensor.ndim
+		slices[axis] = slice(indices[0], indices[0]+len(indices))
+		return tensor[tuple(slices)]
+	return np.take(tensor, indices, axis=axis)
+
+
+def load_example_tensor(example, key, shape=None):
+	'''Load one tensor of an example, optionally cropped to shape, see load_example_tensors().'''
+	return load_example_tensors(example, [key], {key: shape})[key]
+
+
+def position_string_from_example(example):
+	'''Genomic position string of an example, see position_string_from_tensor_name().'''
+	if isinstance(example, tuple):
+		shard_path, row = example
+		tensor_name = shard_file(shard_path)['tensor_names'][row]
+		if isinstance(tensor_name, bytes):
+			tensor_name = tensor_name.decode('utf-8')
+		return position_string_from_tensor_name(tensor_name)
+	return position_string_from_tensor_name(example)
+
+
+def example_tensor_keys(example):
+	'''List the names of the tensors an example has.'''
+	if isinstance(example, tuple):
+		shard_path, row = example
+		hf = shard_file(shard_path)
+		return [key for key in hf['present'] if hf['present/'+key][row]]
+	with h5py.File(example, 'r') as hf:
+		return list(hf.keys())
+
+
+def close_shard_files():
+	'''Close the shards this process has open for reading.'''
+	handles = open_shard_files.pop(os.getpid(), {})
+	for shard_path in handles:
+		handles[shard_path].close()
+
+
+def benchmark_compression(args, codecs=[('none', 0), ('lzf', 0), ('gzip', 1), ('gzip', 4), ('gzip', 9)]):
+	'''Report write speed, read speed and size of a sample of tensors with each compression filter.
+
+	Sampled tensors are written in the args.tensor_storage layout with args.chunk_shape chunks
+	to a temporary directory, with and without the shuffle filter, then read back.
+	Read speeds include the operating system's file cache, so they are best case numbers.
+
+	Arguments:
+		args.data_dir: Dataset with train, valid and test directories to sample tensors from
+		args.samples: Number of examples to sample
+		codecs: List of (compression, gzip level) tuples to benchmark
+	'''
+	examples = []
+	for split_paths in get_train_valid_test_paths(args):
+		for tp in split_paths:
+			examples.extend(examples_in_directory(tp))
+	np.random.shuffle(examples)
+	examples = examples[:args.samples]
+
+	sample = []
+	raw_bytes = 0
+	for example in examples:
+		path = example[0] if isinstance(example, tuple) else example
+		tensor_name = 'benchmark-' + position_string_from_example(example) + '.hd5'
+		tensors = load_example_tensors(example, example_tensor_keys(example))
+		raw_bytes += sum(t.nbytes for t in tensors.values())
+		sample.append((os.path.join(os.path.basename(os.path.dirname(path)), tensor_name), tensors))
+	print('Benchmarking compression with', len(sample), 'examples,', raw_bytes/1e6, 'MB uncompressed, stored as', args.tensor_storage)
+
+	benchmark_args = copy.copy(args)
+	for compression, level in codecs:
+		for shuffle_filter in [False, True]:
+			benchmark_args.compression = compression
+			benchmark_args.compression_level = level
+			benchmark_args.shuffle_filter = shuffle_filter
+			benchmark_dir = tempfile.mkdtemp(dir=args.output_dir if os.path.isdir(args.output_dir) else None)
+
+			start = time.time()
+			writer = tensor_writer_from_args(benchmark_args)
+			for tensor_name, tensors in sample:
+				writer.write(os.path.join(benchmark_dir, tensor_name), tensors)
+			writer.close()
+			write_time = time.time() - start
+
+			start = time.time()
+			for label_dir in os.listdir(benchmark_dir):
+				for example in examples_in_directory(os.path.join(benchmark_dir, label_dir)):
+					load_example_tensors(example, example_tensor_keys(example))
+			close_shard_files()
+			read_time = time.time() - start
+
+			disk_bytes = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(benchmark_dir) for f in files)
+			shutil.rmtree(benchmark_dir)
+			print('%5s level %d shuffle %-5s write: %9.1f tensors/s read: %9.1f tensors/s size: %9.2f MB ratio: %5.2f' 
+				% (compression, level, shuffle_filter, len(sample)/write_time, len(sample)/read_time, disk_bytes/1e6, raw_bytes/float(disk_bytes)))
+
+
 def position_string_from_tensor_name(tensor_name):
 	'''Genomic position as underscore delineated string from a filename.
 
@@ -2873,9 +5503,9 @@ def get_train_valid_test_paths_all(args):
 	train_dir = args.data_dir + 'train/'
 	valid_dir = args.data_dir + 'valid/'
 	test_dir = args.data_dir + 'test/'
-	train_paths = [train_dir + tp for tp in sorted(os.listdir(train_dir))]
-	valid_paths = [valid_dir + vp for vp in sorted(os.listdir(valid_dir))]
-	test_paths = [test_dir + vp for vp in sorted(os.listdir(test_dir))]		
+	train_paths = sorted(examples_in_directory(train_dir), key=str)
+	valid_paths = sorted(examples_in_directory(valid_dir), key=str)
+	test_paths = sorted(examples_in_directory(test_dir), key=str)
 
 	return train_paths, valid_paths, test_paths
 
@@ -3056,19 +5686,12 @@ def reads_to_tensor(args, sequences, qualities=None, reference_seq=None):
 
 def reference_sequence_into_tensor(args, reference_seq, tensor):
 	ref_offset = len(set(args.input_symbols.values()))
-	for i,b in enumerate(reference_seq):
-		if i == args.window_size:
-			break
-		if b in args.input_symbols:
-			if args.channels_last:
-				tensor[:, i, ref_offset+args.input_symbols[b]] = 1.0
-			else:
-				tensor[ref_offset+args.input_symbols[b], :, i] = 1.0
-		elif b in defines.ambiguity_codes:
-			if args.channels_last:
-				tensor[:, i, ref_offset:ref_offset+4] = np.tile(defines.ambiguity_codes[b], (args.read_limit, 1))
-			else:
-				tensor[ref_offset:ref_offset+4, :, i] = np.transpose(np.tile(defines.ambiguity_codes[b], (args.read_limit, 1)))		
+	reference_tensor = encode_dna(reference_seq, args.input_symbols, args.window_size, uppercase=False, strict=False)
+	ref_end = ref_offset + reference_tensor.shape[1]
+	if args.channels_last:
+		tensor[:, :, ref_offset:ref_end] = reference_tensor
+	else:
+		tensor[ref_offset:ref_end, :, :] = reference_tensor.T[:, np.newaxis, :]
 
 
 def reads_to_2bit_tensor(args, sequences, qualities=None, reference_seq=None):
@@ -3224,11 +5847,11 @@ def scores_from_heng_li_filters(args, positions, mean_coverage=60):
 	stats = Counter()
 	
 	bed_dict = bed_file_to_dict(args.bed_file)
-	vcf_nist = vcf.Reader(open(args.train_vcf, 'r'))
-	vcf_ram = vcf.Reader(open(args.negative_vcf, 'r'))
+	vcf_nist = VariantReader(args.train_vcf)
+	vcf_ram = VariantReader(args.negative_vcf)
 	sam_file = pysam.AlignmentFile(args.bam_file, "rb")	
 	if args.ignore_vcf:
-		vcf_ignore = vcf.Reader(open(args.ignore_vcf, 'r'))
+		vcf_ignore = VariantReader(args.ignore_vcf)
 		
 	indel_data = {}
 	snp_data = {}
@@ -3390,10 +6013,10 @@ def scores_from_gatk_hard_filters(args, positions, distance_score=False):
 
 	stats = Counter()
 	bed_dict = bed_file_to_dict(args.bed_file)
-	vcf_nist = vcf.Reader(open(args.train_vcf, 'r'))
-	vcf_ram = vcf.Reader(open(args.negative_vcf, 'r'))
+	vcf_nist = VariantReader(args.train_vcf)
+	vcf_ram = VariantReader(args.negative_vcf)
 	if args.ignore_vcf:
-		vcf_ignore = vcf.Reader(open(args.ignore_vcf, 'r'))
+		vcf_ignore = VariantReader(args.ignore_vcf)
 
 	snp_data = {}
 	indel_data = {}
@@ -3514,18 +6137,18 @@ def scores_from_positions(args, positions, score_key='VQSLOD', override_vcf=None
 	stats = Counter()
 
 	bed_dict = bed_file_to_dict(args.bed_file)
-	vcf_truth = vcf.Reader(open(args.train_vcf, 'rb'))
+	vcf_truth = VariantReader(args.train_vcf)
 
 	if override_vcf:
-		vcf_ram = vcf.Reader(open(override_vcf, 'rb'))
-		vcf_negative = vcf.Reader(open(args.negative_vcf, 'rb'))
+		vcf_ram = VariantReader(override_vcf)
+		vcf_negative = VariantReader(args.negative_vcf)
 	else:
-		vcf_ram = vcf.Reader(open(args.negative_vcf, 'rb'))
+		vcf_ram = VariantReader(args.negative_vcf)
 
 	if args.ignore_vcf:
-		vcf_ignore = vcf.Reader(open(args.ignore_vcf, 'rb'))
+		vcf_ignore = VariantReader(args.ignore_vcf)
 	if args.include_vcf:
-		vcf_include = vcf.Reader(open(args.include_vcf, 'rb'))
+		vcf_include = VariantReader(args.include_vcf)
 
 	snp_data = {}
 	indel_data = {}
@@ -3640,21 +6263,21 @@ def scores_from_vcf(args, score_keys=['VQSLOD'], override_vcf=None):
 	allele_specific_score_keys = ['AS_RF']
 
 	bed_dict = bed_file_to_dict(args.bed_file)
-	vcf_nist = vcf.Reader(open(args.train_vcf, 'rb'))
-	#vcf_omni = vcf.Reader(open(defines.omni_vcf, 'r'))
-	#vcf_mills = vcf.Reader(open(defines.mills_vcf, 'r')) 
+	vcf_nist = VariantReader(args.train_vcf)
+	#vcf_omni = VariantReader(defines.omni_vcf)
+	#vcf_mills = VariantReader(defines.mills_vcf) 
 
 	if override_vcf:
-		vcf_reader = vcf.Reader(open(override_vcf, 'rb'))
+		vcf_reader = VariantReader(override_vcf)
 	else:
-		vcf_reader = vcf.Reader(open(args.negative_vcf, 'rb'))
+		vcf_reader = VariantReader(args.negative_vcf)
 	
 	if args.ignore_vcf:
-		vcf_ignore = vcf.Reader(open(args.ignore_vcf, 'r'))
+		vcf_ignore = VariantReader(args.ignore_vcf)
 	if args.include_vcf:
-		vcf_include = vcf.Reader(open(args.include_vcf, 'r'))
+		vcf_include = VariantReader(args.include_vcf)
 	if args.output_vcf:
-		vcf_writer = vcf.Writer(open(args.output_vcf, 'w'), vcf_reader)
+		vcf_writer = VariantWriter(args.output_vcf, vcf_reader)
 
 
 	snp_scores = {key:[] for key in score_keys}
@@ -3775,15 +6398,15 @@ def scores_from_gnomad_vcf(args, score_keys=['VQSLOD']):
 	gnomads = gnomads_to_dict(args)
 	bed_dict = bed_file_to_dict(args.bed_file)
 	
-	vcf_nist = vcf.Reader(open(args.train_vcf, 'r'))
-	vcf_omni = vcf.Reader(open(defines.omni_vcf, 'r'))
-	vcf_mills = vcf.Reader(open(defines.mills_vcf, 'r')) 
-	vcf_reader = vcf.Reader(open(args.negative_vcf, 'r'))
+	vcf_nist = VariantReader(args.train_vcf)
+	vcf_omni = VariantReader(defines.omni_vcf)
+	vcf_mills = VariantReader(defines.mills_vcf) 
+	vcf_reader = VariantReader(args.negative_vcf)
 	
 	if args.ignore_vcf:
-		vcf_ignore = vcf.Reader(open(args.ignore_vcf, 'r'))
+		vcf_ignore = VariantReader(args.ignore_vcf)
 	if args.include_vcf:
-		vcf_include = vcf.Reader(open(args.include_vcf, 'r'))
+		vcf_include = VariantReader(args.include_vcf)
 	
 	snp_scores = {key:[] for key in score_keys}
 	snp_truth = []
@@ -3897,16 +6520,16 @@ def scores_from_gnomad_like_vcf(args, score_keys=['VQSLOD']):
 
 	bed_dict = bed_file_to_dict(args.bed_file)
 	
-	vcf_nist = vcf.Reader(open(args.train_vcf, 'r'))
-	vcf_omni = vcf.Reader(open(defines.omni_vcf, 'r'))
-	vcf_mills = vcf.Reader(open(defines.mills_vcf, 'r')) 
-	vcf_reader = vcf.Reader(open(args.negative_vcf, 'r'))
-	vcf_gnomad = vcf.Reader(open(args.negative_vcf_2, 'r'))
+	vcf_nist = VariantReader(args.train_vcf)
+	vcf_omni = VariantReader(defines.omni_vcf)
+	vcf_mills = VariantReader(defines.mills_vcf) 
+	vcf_reader = VariantReader(args.negative_vcf)
+	vcf_gnomad = VariantReader(args.negative_vcf_2)
 	
 	if args.ignore_vcf:
-		vcf_ignore = vcf.Reader(open(args.ignore_vcf, 'r'))
+		vcf_ignore = VariantReader(args.ignore_vcf)
 	if args.include_vcf:
-		vcf_include = vcf.Reader(open(args.include_vcf, 'r'))
+		vcf_include = VariantReader(args.include_vcf)
 	
 	snp_scores = {key:[] for key in score_keys}
 	snp_truth = []
@@ -4019,8 +6642,8 @@ def gnomads_to_dict(args):
 	postfix = '.liftover.b38.vcf.gz' if '38' in args.reference_fasta else '.vcf.gz'
 	
 	for i in range(1,23):
-		gnomads[contig_prefix+str(i)] = vcf.Reader(open(prefix+str(i)+postfix, 'r'))
-	gnomads[contig_prefix+'X'] = vcf.Reader(open(prefix+'X'+postfix, 'r'))
+		gnomads[contig_prefix+str(i)] = VariantReader(prefix+str(i)+postfix)
+	gnomads[contig_prefix+'X'] = VariantReader(prefix+'X'+postfix)
 	
 	return gnomads
 
@@ -4128,17 +6751,17 @@ def gnomad_scores_from_positions(args, positions, score_key='VQSLOD'):
 	stats = Counter()
 	gnomads = gnomads_to_dict(args)
 	bed_dict = bed_file_to_dict(args.bed_file)
-	vcf_nist = vcf.Reader(open(args.train_vcf, 'r'))
-	vcf_omni = vcf.Reader(open(defines.omni_vcf, 'r'))
-	vcf_mills = vcf.Reader(open(defines.mills_vcf, 'r')) 	
-	vcf_negative = vcf.Reader(open(args.negative_vcf, 'r'))
+	vcf_nist = VariantReader(args.train_vcf)
+	vcf_omni = VariantReader(defines.omni_vcf)
+	vcf_mills = VariantReader(defines.mills_vcf) 	
+	vcf_negative = VariantReader(args.negative_vcf)
 	
 	contig_prefix = 'chr' if '38' in args.reference_fasta else ''
 
 	if args.ignore_vcf:
-		vcf_ignore = vcf.Reader(open(args.ignore_vcf, 'r'))
+		vcf_ignore = VariantReader(args.ignore_vcf)
 	if args.include_vcf:
-		include_vcf = vcf.Reader(open(args.include_vcf, 'r'))
+		include_vcf = VariantReader(args.include_vcf)
 
 	snp_data = {}
 	indel_data = {}
@@ -4233,16 +6856,15 @@ def inspect_read_tensors(args):
 		if label_key not in args.labels:
 			continue
 		label = args.labels[label_key] 
-		tensors[label] = [os.path.join(tp, t) for t in os.listdir(tp) if os.path.splitext(t)[1] in tensor_exts]
+		tensors[label] = examples_in_directory(tp)
 		tensor_counts[label] = 0
 
 	cur_example = 0
 
 	for label in tensors.keys():
 		tensor_path = tensors[label][tensor_counts[label]]
-		with h5py.File(tensor_path,'r') as hf:
-			tensor = np.array(hf.get('read_tensor'))
-			plots.read_tensor_to_image(args, tensor)
+		tensor = load_example_tensor(tensor_path, 'read_tensor')
+		plots.read_tensor_to_image(args, tensor)
 
 			
 		tensor_counts[label] += 1
@@ -4256,7 +6878,7 @@ def inspect_dataset(args):
 	purines = ['A', 'G']
 	pyrimidines = ['T', 'C']
 	data_paths = get_train_valid_test_paths(args)
-	vcf_ram = vcf.Reader(open(args.negative_vcf, 'r'))
+	vcf_ram = VariantReader(args.negative_vcf)
 
 	if defines.annotations_from_args(args):
 		norms = {a:[0,0,0,0] for a in args.annotations} # X, X^2, count, k for shifted variance calculation
@@ -4265,13 +6887,13 @@ def inspect_dataset(args):
 	for dp in data_paths:
 		for tp in dp:
 			cur_label = os.path.basename(tp)
-			cur_tensors = os.listdir(tp)
+			cur_tensors = examples_in_directory(tp)
 			stats[cur_label] += len(cur_tensors)
 			stats['total'] += len(cur_tensors)
 			for t in cur_tensors:
-				gpos = t.split('-')[-1]
-				chrom = gpos.split('_')[0]
-				pos = int(os.path.splitext(gpos.split('_')[1])[0])
+				gpos = position_string_from_example(t).split('_')
+				chrom = gpos[0]
+				pos = int(gpos[1])
 
 				variants = vcf_ram.fetch(chrom, pos-1, pos)
 				for v in variants:
@@ -4287,19 +6909,18 @@ def inspect_dataset(args):
 						stats[cur_label+' insertion'] += 1
 
 					if defines.annotations_from_args(args) and v.POS == pos and not maxed_out:
-						with h5py.File(os.path.join(tp,t),'r') as hf:
-							annotation_data = np.array(hf.get(args.annotation_set))
-							for i,a in enumerate(args.annotations):
-								if annotation_data[i] == 0:
-									stats[a+' is zero:'] += 1
-									continue
-								if norms[a][3] == 0:
-									norms[a][3] = annotation_data[i]
-								norms[a][0] += annotation_data[i]-norms[a][3]
-								norms[a][1] += (annotation_data[i]-norms[a][3])*(annotation_data[i]-norms[a][3])
-								norms[a][2] += 1
-								if norms[a][2] == args.max_normalize_sites:
-									maxed_out = True
+						annotation_data = load_example_tensor(t, args.annotation_set)
+						for i,a in enumerate(args.annotations):
+							if annotation_data[i] == 0:
+								stats[a+' is zero:'] += 1
+								continue
+							if norms[a][3] == 0:
+								norms[a][3] = annotation_data[i]
+							norms[a][0] += annotation_data[i]-norms[a][3]
+							norms[a][1] += (annotation_data[i]-norms[a][3])*(annotation_data[i]-norms[a][3])
+							norms[a][2] += 1
+							if norms[a][2] == args.max_normalize_sites:
+								maxed_out = True
 
 
 	for k in ['SNP', 'NOT_SNP']:
@@ -4340,9 +6961,9 @@ def dataset_summary_latex_table_line(stats):
 def write_tranches(args):
 	tranches = [0.9, 0.95, 0.99]
 	score_key = 'VQSLOD'
-	vcf_mills = vcf.Reader(open(defines.mills_vcf, 'r'))
-	vcf_hapmap = vcf.Reader(open(defines.hapmap_vcf, 'r'))	
-	vcf_negative = vcf.Reader(open(args.negative_vcf, 'r'))
+	vcf_mills = VariantReader(defines.mills_vcf)
+	vcf_hapmap = VariantReader(defines.hapmap_vcf)	
+	vcf_negative = VariantReader(args.negative_vcf)
 
 	scores = []
 
@@ -4356,8 +6977,8 @@ def write_tranches(args):
 
 	print('Iterate over hapmap.')
 
-	for variant in vcf_hapmap.fetch(args.chrom):
-		v_scored = variant_in_vcf(variant, vcf_negative)
+	for variant, negatives in merge_join_vcf(vcf_hapmap.fetch(args.chrom), vcf_negative):
+		v_scored = variant_in_records(variant, negatives)
 		if not v_scored:
 			continue
 		scores.append(v_scored.INFO[score_key])
@@ -4388,12 +7009,13 @@ def inspect_gnomad_low_ac(args):
 
 def combine_vcfs(args):
 	stats = Counter()
-	vcf_negative = vcf.Reader(open(args.negative_vcf, 'r'))
-	vcf_ram = vcf.Reader(open(args.negative_vcf_2, 'r'))
-	vcf_writer = vcf.Writer(open(args.output_vcf, 'w'), vcf_negative)
+	vcf_negative = VariantReader(args.negative_vcf)
+	vcf_ram = VariantReader(args.negative_vcf_2)
+	vcf_negative.add_filters_from(vcf_ram)
+	vcf_writer = VariantWriter(args.output_vcf, vcf_negative)
 
-	for variant in vcf_negative:
-		vqual = variant_in_vcf(variant, vcf_ram)
+	for variant, records in merge_join_vcf(vcf_negative, vcf_ram):
+		vqual = variant_in_records(variant, records)
 		if not vqual:
 			stats['Variant not in '+args.negative_vcf_2] += 1
 			continue
@@ -4429,10 +7051,12 @@ def split_data(datasets, valid_ratio=0.1, test_ratio=0.4):
 
 
 def simple_vcf_writer():
-	vcf_reader = vcf.Reader(open('path/to/vcf.gz', 'r'))
-	vcf_writer = vcf.Writer(open('path/to/out.vcf', 'w'), vcf_reader)
+	vcf_reader = VariantReader('path/to/vcf.gz')
+	if 'AF' not in vcf_reader.header.info:
+		vcf_reader.header.info.add('AF', 'A', 'Float', 'Allele Frequency')
+	vcf_writer = VariantWriter('path/to/out.vcf', vcf_reader)
 	for variant in vcf_reader:
-		variant.INFO['AF'] = 1.0
+		variant.INFO['AF'] = [1.0]*len(variant.ALT)
 		vcf_writer.write_record(variant)
 
 
@@ -4466,10 +7090,9 @@ def concat_and_shuffle_all(tuple1, tuple2):
 	return concat
 
 
-def sample_from_fasta(record_dict):
+def sample_from_fasta(reference):
 	c_idx = str(np.random.randint(1,20))
-	contig = record_dict[c_idx]
-	p_idx = np.random.randint(len(contig))
+	p_idx = np.random.randint(reference.contig_length(c_idx))
 	return c_idx, p_idx
 
 
@@ -4501,19 +7124,18 @@ def sample_from_bed_labels(labels, label_dict, contig_key_prefix=''):
 	return contig_key, mid_pos, label2[idx], label3[idx]
 
 
-def sample_from_vcf(record_dict, vcf_reader):
+def sample_from_vcf(reference, vcf_reader):
 	variant_window = 5000
 	c_idx = np.random.randint(1,20)
-	contig = record_dict[str(c_idx)]
-	p_idx = np.random.randint(len(contig)-variant_window)
+	p_idx = np.random.randint(reference.contig_length(str(c_idx))-variant_window)
 	return vcf_reader.fetch(str(c_idx), p_idx, p_idx + variant_window)
 
 
 def intersect_vcfs(vcf1, vcf2):
 	shared_variants = {}
 
-	vcf_reader = vcf.Reader(open(vcf1, 'r'))
-	vcf_ram =  vcf.Reader(open(vcf2, 'r'))
+	vcf_reader = VariantReader(vcf1)
+	vcf_ram =  VariantReader(vcf2)
 
 
 	for variant in vcf_reader:
@@ -4541,8 +7163,20 @@ def variant_in_vcf(variant, vcf_ram, contig_prefix=''):
 	end = variant.POS
 
 	variants = vcf_ram.fetch(contig_prefix+variant.CHROM, start, end)
-	
-	for v in variants:
+	return variant_in_records(variant, variants)
+
+
+def variant_in_records(variant, records):
+	''' Find the first record at the same position as the variant that shares one of its alternate alleles.
+
+	Arguments
+		variant: the variant we are looking for
+		records: iterable of records on the same contig as the variant
+
+	Returns
+		record if it is found otherwise None
+	'''	
+	for v in records:
 		same_allele = any([a1 == a2 for a1 in v.ALT for a2 in variant.ALT]) 
 		if v.POS == variant.POS and same_allele:
 			return v
@@ -4562,8 +7196,21 @@ def allele_in_vcf(allele, variant, vcf_ram):
 		variant if it is found otherwise None
 	'''	
 	variants = vcf_ram.fetch(variant.CHROM, variant.POS-1, variant.POS)
+	return allele_in_records(allele, variant, variants)
+
+
+def allele_in_records(allele, variant, records):
+	''' Find the first record at the same site as the variant which has the allele.
+
+	Arguments
+		allele: the allele from the provided variant that we are checking
+		variant: the variant whose allele we are looking for
+		records: iterable of records to search
 
-	for v in variants:
+	Returns
+		record if it is found otherwise None
+	'''	
+	for v in records:
 		if v.CHROM == variant.CHROM and v.POS == variant.POS and allele in v.ALT:
 			return v
 	
@@ -4603,7 +7250,7 @@ def interval_file_to_dict(interval_file, shift1=0, skip=['@']):
 			intervals[contig][1].append(upper)
 
 	for k in intervals.keys():
-		intervals[k] = (np.array(intervals[k][0]), np.array(intervals[k][1]))		
+		intervals[k] = merge_intervals(np.array(intervals[k][0]), np.array(intervals[k][1]))		
 
 	return intervals
 
@@ -4620,6 +7267,7 @@ def bed_file_to_dict(bed_file, shift1=1):
 			values are a tuple of arrays the first array 
 			in the tuple contains the start positions
 			the second array contains the end positions.
+			Intervals are sorted and merged, see merge_intervals().
 	'''
 	bed = {}
 	assert(shift1 == 0 or shift1 == 1)
@@ -4638,11 +7286,39 @@ def bed_file_to_dict(bed_file, shift1=1):
 			bed[contig][1].append(upper)
 
 	for k in bed.keys():
-		bed[k] = (np.array(bed[k][0]), np.array(bed[k][1]))		
+		bed[k] = merge_intervals(np.array(bed[k][0]), np.array(bed[k][1]))		
 
 	return bed
 
 
+def merge_intervals(lows, ups):
+	''' Sort intervals by start position and merge any that overlap or touch.
+
+	The merged intervals are disjoint with increasing starts and ends, 
+	so point queries can binary search the starts, see in_bed_file().
+
+	Arguments:
+		lows: array of interval start positions (inclusive)
+		ups: array of interval end positions (exclusive)
+
+	Returns:
+		(lows, ups): tuple of arrays of the merged interval starts and ends
+	'''
+	if len(lows) == 0:
+		return lows, ups
+
+	order = np.argsort(lows, kind='mergesort')
+	lows = lows[order]
+	max_ups = np.maximum.accumulate(ups[order])
+
+	new_interval = np.ones(len(lows), dtype=bool)
+	new_interval[1:] = lows[1:] > max_ups[:-1]
+	starts = np.flatnonzero(new_interval)
+	ends = np.append(starts[1:]-1, len(lows)-1)
+
+	return lows[starts], max_ups[ends]
+
+
 def bed_file_labels_to_dict(bed_file):
 	bed = {}
 
@@ -4662,7 +7338,8 @@ def bed_file_labels_to_dict(bed_file):
 			bed[contig][2].append(label)
 
 	for k in bed:
-		bed[k] = (np.array(bed[k][0]), np.array(bed[k][1]), bed[k][2])		
+		order = np.argsort(bed[k][0], kind='mergesort')
+		bed[k] = (np.array(bed[k][0])[order], np.array(bed[k][1])[order], [bed[k][2][i] for i in order])		
 
 	return bed
 
@@ -4676,22 +7353,131 @@ def bed_file_sum_bases(bed_dict):
 
 
 def in_bed_file(bed_dict, contig, pos):
-	# Exclusive
+	''' Check if a position is inside the intervals of a bed dict in O(log n) time.
+
+	Arguments:
+		bed_dict: dict of sorted, disjoint intervals e.g. from bed_file_to_dict()
+		contig: the contig of the position
+		pos: the position to check, interval ends are exclusive
+
+	Returns:
+		True if the position is inside an interval
+	'''
 	lows = bed_dict[contig][0]
 	ups = bed_dict[contig][1]
-	return np.any((lows <= pos) & (pos < ups))
+	i = np.searchsorted(lows, pos, side='right') - 1
+	return i >= 0 and pos < ups[i]
 
 
-def bed_file_label(bed_dict, contig, pos, label_i=2):
+def in_bed_file_batch(bed_dict, contig, positions):
+	''' Vectorized in_bed_file() for an array of positions on the same contig.
+
+	Arguments:
+		bed_dict: dict of sorted, disjoint intervals e.g. from bed_file_to_dict()
+		contig: the contig of the positions
+		positions: array of positions to check, interval ends are exclusive
+
+	Returns:
+		Boolean array, True where the position is inside an interval
+	'''
+	positions = np.asarray(positions)
+	lows = bed_dict[contig][0]
+	ups = bed_dict[contig][1]
+	if len(lows) == 0:
+		return np.zeros(positions.shape, dtype=bool)
+
+	i = np.searchsorted(lows, positions, side='right') - 1
+	return (i >= 0) & (positions < ups[np.maximum(i, 0)])
+
+
+def bed_window_mask(bed_dict, contig, start, end):
+	''' Vectorized in_bed_file() for every position of a window, with one sorted search.
+
+	The intervals overlapping the window are found with searchsorted and rasterized 
+	with a difference array: +1 where each clipped interval starts, -1 where it ends, then a cumulative sum.
+
+	Arguments:
+		bed_dict: dict of sorted, disjoint intervals e.g. from bed_file_to_dict()
+		contig: the contig of the window
+		start: first position of the window
+		end: position after the last one in the window
+
+	Returns:
+		Boolean array of length end-start, True where the position is inside an interval
+	'''
+	if contig not in bed_dict:
+		return np.zeros((end-start,), dtype=bool)
+	lows = bed_dict[contig][0]
+	ups = bed_dict[contig][1]
+	first, last = np.searchsorted(ups, start, side='right'), np.searchsorted(lows, end, side='left')
+	diff = np.zeros((end-start+1,), dtype=np.int32)
+	np.add.at(diff, np.maximum(lows[first:last], start)-start, 1)
+	np.add.at(diff, np.minimum(ups[first:last], end)-start, -1)
+	return np.cumsum(diff[:-1]) > 0
+
+
+class BedRasterizer(object):
+	'''Rasterize the intervals of several bed files over windows of the genome into a (window, tracks) matrix.
+
+	Each window costs one sorted search per track, see bed_window_mask().
+	With bitsets=True each track is instead rasterized once per contig into a packed bitset 
+	and windows are sliced out of it, which is cheaper for genome wide runs with many windows per contig.
+	Only the bitsets of the latest contig are kept, so walk windows in contig order.
+	'''
+	def __init__(self, bed_dicts, bitsets=False):
+		'''Arguments:
+			bed_dicts: list of dicts of sorted, disjoint intervals e.g. from bed_file_to_dict(), one per track
+			bitsets: If True rasterize whole contigs into packed bitsets
+		'''
+		self.bed_dicts = bed_dicts
+		self.bitsets = bitsets
+		self.contig = None
+		self.contig_bits = []
+
+	def contig_bitset(self, bed_dict, contig):
+		'''Packed bitset of the positions inside the intervals of contig, bit i is position i.'''
+		if contig not in bed_dict or len(bed_dict[contig][1]) == 0:
+			return np.zeros((0,), dtype=np.uint8)
+		return np.packbits(bed_window_mask(bed_dict, contig, 0, int(bed_dict[contig][1][-1])))
+
+	def window(self, contig, start, end):
+		'''Return a (end-start, tracks) float matrix, 1.0 where a position is inside an interval of a track.'''
+		raster = np.zeros((end-start, len(self.bed_dicts)))
+		if not self.bitsets:
+			for t, bed_dict in enumerate(self.bed_dicts):
+				raster[:, t] = bed_window_mask(bed_dict, contig, start, end)
+			return raster
+
+		if contig != self.contig:
+			self.contig = contig
+			self.contig_bits = [self.contig_bitset(bed_dict, contig) for bed_dict in self.bed_dicts]
+		lo = max(start, 0)
+		for t, bits in enumerate(self.contig_bits):
+			hi = min(end, len(bits)*8)
+			if hi <= lo:
+				continue
+			window_bits = np.unpackbits(bits[lo//8:(hi+7)//8])
+			raster[lo-start:hi-start, t] = window_bits[lo%8:lo%8+hi-lo]
+		return raster
+
 
-	if in_bed_file(bed_dict, contig, pos):
-		lows = bed_dict[contig][0]
-		ups = bed_dict[contig][1]
+def bed_file_label(bed_dict, contig, pos, label_i=2):
+	''' Get the label of the interval containing a position.
 
-		i = np.argmax((lows < pos) & (pos < ups))
-		label = bed_dict[contig][label_i][i]
+	Arguments:
+		bed_dict: dict of sorted, non-overlapping labelled intervals e.g. from bed_file_labels_to_dict()
+		contig: the contig of the position
+		pos: the position to label, interval ends are exclusive
+		label_i: index of the labels in the bed dict values
 
-		return label
+	Returns:
+		The label of the interval or None if the position is not in an interval
+	'''
+	lows = bed_dict[contig][0]
+	ups = bed_dict[contig][1]
+	i = np.searchsorted(lows, pos, side='right') - 1
+	if i >= 0 and pos < ups[i]:
+		return bed_dict[contig][label_i][i]
 
 
 def plain_name(full_name):
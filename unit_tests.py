@@ -16,22 +16,110 @@ from __future__ import absolute_import
 # Imports
 import os
 import sys
-import vcf
+import copy
+import functools
+import json
+import math
+import time
 import h5py
 import pysam
 import plots
 import pickle
 import models
+import shutil
 import defines
 import recipes
 import unittest
+import tempfile
 import arguments
 import numpy as np
 import training_data as td
 
-from Bio import Seq, SeqIO
 from collections import Counter
 
+try:
+	import vcf # PyVCF, only to check VariantReader against it
+except ImportError:
+	vcf = None
+
+
+def per_base_good_reads_to_tensor(args, good_reads, ref_start, insert_dict):
+	'''The per base loop td.good_reads_to_tensor() replaced, to check it makes the same read tensors.
+
+	Assumes read pairs have the same name. 
+	Only loads reads that might align inside the tensor.
+
+	Arguments:
+		args.read_limit: maximum number of reads to return
+		good_reads: list of reads to make arrays from
+		ref_start: the beginning of the window in reference coordinates
+		insert_dict: a dict mapping read indices to max insertions at that point.
+
+	Returns:
+		tensor: 3D read tensor.
+	'''
+	channel_map = defines.get_tensor_channel_map_from_args(args)
+	tensor = np.zeros( defines.tensor_shape_from_args(args) )
+
+	for j,read in enumerate(good_reads):
+
+		rseq, rqual = td.sequence_and_qualities_from_read(args, read, ref_start, insert_dict)
+		flag_start = -1
+		flag_end = 0
+
+		for i,b in enumerate(rseq):
+			
+			if i == args.window_size:
+				break
+			
+			if b == defines.skip_char:
+				continue
+			elif flag_start == -1:
+				flag_start = i
+			else:
+				flag_end = i
+
+			if b in args.input_symbols:
+				if b == defines.indel_char:
+					if args.channels_last:
+						tensor[j, i, args.input_symbols[b]] = 1.0
+					else:
+						tensor[args.input_symbols[b], j, i] = 1.0
+				else:
+					hot_array = td.quality_from_mode(args, rqual[i], b, args.input_symbols)
+					if args.channels_last:
+						tensor[j, i, :4] = hot_array
+					else:
+						tensor[:4, j, i] = hot_array
+
+			elif b in defines.ambiguity_codes:
+				if args.channels_last:
+					tensor[j, i, :4] = defines.ambiguity_codes[b]
+				else:
+					tensor[:4, j, i] = defines.ambiguity_codes[b]
+			
+			else:
+				raise ValueError('Error! Unknown symbol in seq block:', b)
+				
+
+		flags = td.flag_to_array(read.flag)
+		for i in range(defines.read_flags):
+			flag_str = 'flag_bit_'+ str(i)
+
+			if flags[i] and flag_str in channel_map:
+				if args.channels_last:
+					tensor[j, flag_start:flag_end, channel_map[flag_str]] = 1.0
+				else:
+					tensor[channel_map[flag_str], j,  flag_start:flag_end] = 1.0
+		
+		if 'mapping_quality' in channel_map:
+			if args.channels_last:
+				tensor[j, flag_start:flag_end, channel_map['mapping_quality']] = float(read.mapping_quality)/defines.mapping_quality_max
+			else:
+				tensor[channel_map['mapping_quality'], j, flag_start:flag_end] = float(read.mapping_quality)/defines.mapping_quality_max
+
+	return tensor
+
 
 def run_tests():
 	suite = unittest.TestLoader().loadTestsFromTestCase(TestRecipes)
@@ -45,9 +133,9 @@ def run_tests():
 class TestVariants(unittest.TestCase):
 
 	def setUp(self):
-		self.record_dict = SeqIO.to_dict(SeqIO.parse(args.reference_fasta, "fasta"))
-		self.vcf_ram = vcf.Reader(open(args.negative_vcf, 'r'))
-		self.vcf_train = vcf.Reader(open(args.train_vcf, 'r'))
+		self.reference = td.IndexedReference(args.reference_fasta)
+		self.vcf_ram = td.VariantReader(args.negative_vcf)
+		self.vcf_train = td.VariantReader(args.train_vcf)
 		self.bed_dict = td.bed_file_to_dict(args.bed_file)	
 
 	def test_vcf_and_bed_lookup(self):
@@ -60,6 +148,558 @@ class TestVariants(unittest.TestCase):
 		self.assertTrue(td.variant_in_vcf(v1, self.vcf_train))
 		self.assertTrue(td.variant_in_vcf(v2, self.vcf_ram))
 
+	def test_samples_per_interval(self):
+		intervals = [('1', 0, 100), ('1', 100, 200), ('2', 0, 50)]
+		self.assertEqual(td.samples_per_interval(10, intervals), [4, 4, 2])
+		self.assertEqual(td.samples_per_interval(3, intervals), [1, 1, 1])
+		self.assertEqual(sum(td.samples_per_interval(1000003, intervals*100)), 1000003)
+		self.assertEqual(td.samples_per_interval(10, []), [])
+
+	def test_bed_interval_index(self):
+		for contig in self.bed_dict:
+			lows, ups = self.bed_dict[contig]
+			self.assertTrue(np.all(lows[1:] > ups[:-1]))
+			positions = np.random.randint(lows[0]-10, ups[-1]+10, size=1000)
+			brute_force = [np.any((lows <= p) & (p < ups)) for p in positions]
+			self.assertEqual(brute_force, [td.in_bed_file(self.bed_dict, contig, p) for p in positions])
+			self.assertEqual(brute_force, td.in_bed_file_batch(self.bed_dict, contig, positions).tolist())
+
+	def test_bed_rasterizer(self):
+		bed_dicts = [self.bed_dict, {contig: (self.bed_dict[contig][0][::2], self.bed_dict[contig][1][::2]) for contig in self.bed_dict}]
+		window_rasterizer = td.BedRasterizer(bed_dicts)
+		bitset_rasterizer = td.BedRasterizer(bed_dicts, bitsets=True)
+		for contig in sorted(self.bed_dict):
+			lows, ups = self.bed_dict[contig]
+			for start in sorted(np.random.randint(max(0, lows[0]-500), ups[-1]+500, size=200)):
+				window = window_rasterizer.window(contig, start, start+128)
+				self.assertTrue(np.array_equal(window, bitset_rasterizer.window(contig, start, start+128)))
+				for t, bed_dict in enumerate(bed_dicts):
+					self.assertEqual(window[:, t].tolist(), td.in_bed_file_batch(bed_dict, contig, np.arange(start, start+128)).tolist())
+		self.assertFalse(np.any(window_rasterizer.window('not_a_contig', 0, 64)))
+
+	def test_encode_dna(self):
+		t = td.encode_dna('ACgtR*', defines.inputs_indel, window_size=8)
+		self.assertEqual(t.shape, (8, len(defines.inputs_indel)))
+		self.assertEqual(t[:4].argmax(axis=1).tolist(), [0, 1, 2, 3])
+		self.assertEqual(t[4, :4].tolist(), defines.ambiguity_codes['R'])
+		self.assertEqual(t[5, defines.inputs_indel[defines.indel_char]], 1.0)
+		self.assertFalse(np.any(t[6:]))
+		self.assertRaises(ValueError, td.encode_dna, 'ACGTX')
+		self.assertFalse(np.any(td.encode_dna('acgt', uppercase=False, strict=False)))
+
+	def test_good_reads_to_tensor(self):
+		samfile = pysam.AlignmentFile(args.bam_file, 'rb')
+		channels_last = args.channels_last
+		for v, _ in zip(self.vcf_train, range(50)):
+			good_reads, insert_dict = td.get_good_reads(args, samfile, v)
+			_, ref_start, _ = td.get_variant_window(args, v)
+			for args.channels_last in [True, False]:
+				old = per_base_good_reads_to_tensor(args, good_reads, ref_start, insert_dict)
+				new = td.good_reads_to_tensor(args, good_reads, ref_start, insert_dict)
+				self.assertTrue(np.array_equal(old, new))
+		args.channels_last = channels_last
+
+	def test_site_tensors(self):
+		samfile = pysam.AlignmentFile(args.bam_file, 'rb')
+		tensor_map = args.tensor_map
+		for v, _ in zip(self.vcf_train, range(20)):
+			site = td.SiteTensors(args, v, samfile, self.reference, Counter())
+			args.tensor_map = 'read_tensor'
+			expected = td.make_reference_and_reads_tensor(args, v, samfile, site.reference_seq, site.ref_start, Counter())
+			self.assertIs(site.read_tensor('read_tensor'), site.read_tensor('read_tensor'))
+			if expected is None:
+				self.assertIsNone(site.read_tensor('reads_only'))
+				continue
+			self.assertTrue(np.array_equal(expected, site.read_tensor('read_tensor')))
+			args.tensor_map = 'reads_only'
+			self.assertTrue(np.array_equal(expected[:len(defines.get_tensor_channel_map_from_args(args))], site.read_tensor('reads_only')))
+		args.tensor_map = tensor_map
+
+	def test_read_window_cache(self):
+		samfile = pysam.AlignmentFile(args.bam_file, 'rb')
+		read_caches = [td.ReadWindowCache(args.bam_file), td.ReadWindowCache(args.bam_file)]
+		for v, _ in zip(self.vcf_train, range(200)):
+			for read_cache, half_width in zip(read_caches, [0, args.window_size//2]):
+				start, end = v.POS-1-half_width, v.POS+half_width
+				expected = [(r.query_name, r.flag) for r in samfile.fetch(v.CHROM, max(0, start), end)]
+				self.assertEqual(expected, [(r.query_name, r.flag) for r in read_cache.fetch(v.CHROM, start, end)])
+
+	def test_tensor_shards(self):
+		data_dir = tempfile.mkdtemp()
+		shard_args = copy.copy(args)
+		shard_args.tensor_storage = 'shards'
+		shard_args.tensors_per_shard = 3
+		writer = td.tensor_writer_from_args(shard_args)
+		tensors = {'1_%d' % (i+1) : np.random.rand(4, 5) for i in range(7)}
+		for gpos in tensors:
+			writer.write(os.path.join(data_dir, 'SNP', 'tensor-%s.hd5' % gpos), {'reference':tensors[gpos], 'read_tensor':None})
+		writer.close()
+
+		examples = td.examples_in_directory(os.path.join(data_dir, 'SNP'))
+		self.assertEqual(len(examples), len(tensors))
+		for example in examples:
+			loaded = td.load_example_tensors(example, ['reference', 'read_tensor'])
+			self.assertTrue(np.array_equal(loaded['reference'], tensors[td.position_string_from_example(example)]))
+			self.assertIsNone(loaded['read_tensor'])
+		shutil.rmtree(data_dir)
+
+	def test_derived_tensor_maps(self):
+		data_dir = tempfile.mkdtemp()
+		derived_args = copy.copy(args)
+		derived_args.tensor_types = ['reads_only', 'read_tensor', 'reads_reference']
+		self.assertEqual(td.stored_tensor_types(derived_args.tensor_types), ['read_tensor'])
+		channels = len(defines.get_tensor_channel_map_rt())
+		for tensor_storage in ['files', 'shards']:
+			for derived_args.channels_last in [True, False]:
+				derived_args.tensor_storage = tensor_storage
+				shape = (3, 4, channels) if derived_args.channels_last else (channels, 3, 4)
+				read_tensor = np.random.rand(*shape)
+				tensor_dir = os.path.join(data_dir, tensor_storage + str(derived_args.channels_last))
+				writer = td.tensor_writer_from_args(derived_args)
+				writer.write(os.path.join(tensor_dir, 'tensor-1_1.hd5'), {'read_tensor':read_tensor})
+				writer.close()
+
+				example = td.examples_in_directory(tensor_dir)[0]
+				loaded = td.load_example_tensors(example, ['read_tensor', 'reads_only', 'reads_reference'])
+				self.assertTrue(np.array_equal(loaded['read_tensor'], read_tensor))
+				for tm in ['reads_only', 'reads_reference']:
+					expected = td.tensor_channel_subset(read_tensor, defines.get_tensor_channel_map_rt(), 
+														defines.get_tensor_channel_map_by_name(tm), derived_args.channels_last)
+					self.assertEqual(expected.shape[-1 if derived_args.channels_last else 0], len(defines.get_tensor_channel_map_by_name(tm)))
+					self.assertTrue(np.array_equal(loaded[tm], expected))
+		shutil.rmtree(data_dir)
+
+	def test_crop_tensor(self):
+		data_dir = tempfile.mkdtemp()
+		crop_args = copy.copy(args)
+		crop_args.channels_last = False
+		crop_args.read_sort = 'reference_start'
+		read_tensor = np.random.rand(15, 10, 9)
+		reference = np.random.rand(9, 4)
+		writer = td.tensor_writer_from_args(crop_args)
+		writer.write(os.path.join(data_dir, 'tensor-1_1.hd5'), {'read_tensor':read_tensor, 'reference':reference})
+		writer.close()
+
+		example = td.examples_in_directory(data_dir)[0]
+		loaded = td.load_example_tensors(example, ['read_tensor', 'reference'], {'read_tensor':(15, 6, 5), 'reference':(5, 4)})
+		rows = [list(read_tensor[0, :, 2]).index(value) for value in loaded['read_tensor'][0, :, 0]]
+		self.assertEqual(rows, sorted(set(rows)))
+		self.assertTrue(np.array_equal(loaded['read_tensor'], read_tensor[:, rows, 2:7]))
+		self.assertTrue(np.array_equal(loaded['reference'], reference[2:7]))
+		self.assertRaises(ValueError, td.load_example_tensor, example, 'read_tensor', (15, 11, 9))
+		shutil.rmtree(data_dir)
+
+		data_dir = tempfile.mkdtemp()
+		crop_args.read_sort = 'base'
+		writer = td.tensor_writer_from_args(crop_args)
+		writer.write(os.path.join(data_dir, 'tensor-1_1.hd5'), {'read_tensor':read_tensor})
+		writer.close()
+		example = td.examples_in_directory(data_dir)[0]
+		self.assertTrue(np.array_equal(td.load_example_tensor(example, 'read_tensor', (15, 10, 5)), read_tensor[:, :, 2:7]))
+		self.assertRaises(ValueError, td.load_example_tensor, example, 'read_tensor', (15, 6, 5))
+		shutil.rmtree(data_dir)
+
+		reads = np.zeros((6, 10, 3))
+		reads[[0, 2, 4], :, 0] = [[1], [2], [3]]
+		reads[1, 0, 1] = 1 # A read outside of the cropped window
+		reads[:, :, 2] = 1 # Reference channel
+		cropped = td.crop_tensor(reads, (4, 4, 3), True, [0, 1], 'reference_start')
+		self.assertTrue(np.array_equal(cropped[:3], reads[[0, 2, 4], 3:7]))
+		self.assertFalse(np.any(cropped[3]))
+		for _ in range(5):
+			cropped = td.crop_tensor(reads, (2, 4, 3), True, [0, 1], 'reference_start')
+			self.assertLess(cropped[0, 0, 0], cropped[1, 0, 0])
+		self.assertTrue(np.array_equal(td.crop_tensor(reads.transpose(2, 0, 1), (3, 4, 4), False, [0, 1], 'reference_start')[:, :3], reads[[0, 2, 4], 3:7].transpose(2, 0, 1)))
+		self.assertRaises(ValueError, td.crop_tensor, reads, (4, 4, 3), True, [0, 1], 'base')
+
+	def test_async_tensor_writer(self):
+		data_dir = tempfile.mkdtemp()
+		for async_writer in ['thread', 'process']:
+			async_args = copy.copy(args)
+			async_args.tensor_storage = 'shards'
+			async_args.tensors_per_shard = 2
+			async_args.async_writer = async_writer
+			async_args.writer_queue_size = 2
+			writer = td.tensor_writer_from_args(async_args)
+			tensors = {'1_%d' % (i+1) : np.random.rand(4, 5) for i in range(5)}
+			for gpos in tensors:
+				writer.write(os.path.join(data_dir, async_writer, 'tensor-%s.hd5' % gpos), {'reference':tensors[gpos]})
+			writer.close()
+
+			examples = td.examples_in_directory(os.path.join(data_dir, async_writer))
+			self.assertEqual(len(examples), len(tensors))
+			for example in examples:
+				loaded = td.load_example_tensors(example, ['reference'])
+				self.assertTrue(np.array_equal(loaded['reference'], tensors[td.position_string_from_example(example)]))
+
+		writer = td.AsyncTensorWriter(td.TensorFileWriter(td.hd5_filters_from_args(args), {}), queue_size=2)
+		writer.write(os.path.join(data_dir, 'bad', 'tensor-1_1.hd5'), {'reference':object()})
+		self.assertRaises(ValueError, writer.close)
+		shutil.rmtree(data_dir)
+
+	def test_annotation_store(self):
+		store_args = copy.copy(args)
+		store_args.data_dir = tempfile.mkdtemp()
+		store_args.tensor_map = None
+		store_args.batch_size = 4 * len(args.labels)
+		writer = td.tensor_writer_from_args(store_args)
+		annotations = {}
+		for split in ['train', 'valid', 'test']:
+			for label_key in args.labels:
+				for i in range(3):
+					gpos = '%d_%d' % (args.labels[label_key]+1, i+1)
+					annotations[split, gpos] = np.random.rand(len(args.annotations))
+					tensor_path = os.path.join(store_args.data_dir, split, label_key, 'tensor-%s.hd5' % gpos)
+					writer.write(tensor_path, {args.annotation_set:annotations[split, gpos]})
+		writer.close()
+
+		td.write_annotation_store(store_args)
+		store = td.load_annotation_store(store_args, 'valid')
+		self.assertEqual(store['annotations'].shape, (3*len(args.labels), len(args.annotations)))
+		generate_train, _, _ = td.train_valid_test_generators_from_args(store_args, with_positions=True)
+		batch, labels, positions = next(generate_train)
+		self.assertEqual(batch[args.annotation_set].shape, (store_args.batch_size, len(args.annotations)))
+		self.assertTrue(np.all(labels.sum(axis=0) == 4))
+		for row, gpos in enumerate(positions):
+			self.assertTrue(np.allclose(batch[args.annotation_set][row], annotations['train', gpos]))
+			self.assertEqual(np.argmax(labels[row]), int(gpos.split('_')[0])-1)
+
+		writer = td.tensor_writer_from_args(store_args)
+		writer.write(os.path.join(store_args.data_dir, 'train', list(args.labels)[0], 'tensor-9_9.hd5'), {args.annotation_set:np.zeros((len(args.annotations),))})
+		writer.close()
+		self.assertIsNone(td.load_annotation_store(store_args, 'valid'))
+		shutil.rmtree(store_args.data_dir)
+
+	def test_prefetch_generator(self):
+		def counting_batches(start, stop):
+			batch = {'x': np.zeros((2, 3))}
+			for i in td.worker_share(list(range(start, stop))):
+				batch['x'][:] = i # Reused like the tensor generators reuse their batch arrays
+				yield (batch, np.full((2,), i))
+
+		prefetched = td.PrefetchGenerator(functools.partial(counting_batches, 0, 20), workers=1, queue_size=4)
+		for (batch, labels), (expected, expected_labels) in zip(prefetched, counting_batches(0, 20)):
+			self.assertTrue(np.array_equal(batch['x'], expected['x']))
+			self.assertTrue(np.array_equal(labels, expected_labels))
+
+		# Workers split the examples, so batches taken from them in turn count up instead of repeating
+		prefetched = td.PrefetchGenerator(functools.partial(counting_batches, 0, 10), workers=2, queue_size=4, use_process=True)
+		for i in range(10):
+			batch, labels = next(prefetched)
+			self.assertTrue(np.all(batch['x'] == i))
+		prefetched.close()
+
+		batch_args = copy.copy(args)
+		batch_args.data_dir = tempfile.mkdtemp()
+		batch_args.tensor_map = None
+		batch_args.batch_size = len(args.labels)
+		batch_args.prefetch_workers = 2
+		batch_args.prefetch_mode = 'thread'
+		writer = td.tensor_writer_from_args(batch_args)
+		for label_key in args.labels:
+			for i in range(4):
+				tensor_path = os.path.join(batch_args.data_dir, label_key, 'tensor-%d_%d.hd5' % (args.labels[label_key]+1, i+1))
+				writer.write(tensor_path, {args.annotation_set:np.full((len(args.annotations),), i)})
+		writer.close()
+		train_paths = [os.path.join(batch_args.data_dir, label_key) for label_key in args.labels]
+		prefetched = td.prefetch_generator(batch_args, td.tensor_generator_from_label_dirs_and_args, batch_args, train_paths, True)
+		seen = Counter()
+		for i in range(4):
+			batch, labels, positions = next(prefetched)
+			seen.update(positions)
+		self.assertEqual(len(seen), 4*len(args.labels))
+		self.assertTrue(all(count == 1 for count in seen.values()))
+		prefetched.close()
+
+		# A slow consumer lets the worker refill its batch arrays while earlier batches wait in the queue
+		prefetched = td.PrefetchGenerator(functools.partial(counting_batches, 0, 8), workers=1, queue_size=4, use_process=True)
+		time.sleep(2)
+		for i in range(8):
+			batch, labels = next(prefetched)
+			self.assertTrue(np.all(batch['x'] == i))
+			self.assertTrue(np.all(labels == i))
+		prefetched.close()
+
+		prefetched = td.PrefetchGenerator(functools.partial(counting_batches, 0, None))
+		self.assertRaises(ValueError, next, prefetched)
+
+	def test_label_balanced_batches(self):
+		batch_args = copy.copy(args)
+		batch_args.data_dir = tempfile.mkdtemp()
+		batch_args.batch_size = 2 * len(args.labels)
+		writer = td.tensor_writer_from_args(batch_args)
+		label_counts = {label_key: 3 + 2*i for i, label_key in enumerate(sorted(args.labels))}
+		for label_key in args.labels:
+			for i in range(label_counts[label_key]):
+				writer.write(os.path.join(batch_args.data_dir, label_key, 'tensor-%d_%d.hd5' % (args.labels[label_key], i+1)), {'reference':np.full((4,), i)})
+		writer.close()
+
+		train_paths = [os.path.join(batch_args.data_dir, label_key) for label_key in args.labels]
+		batches = td.LabelBalancedBatches(batch_args, train_paths, {'reference':'reference'}, with_positions=True, seed=7)
+		largest = max(label_counts, key=label_counts.get)
+		self.assertEqual(len(batches), -(-label_counts[largest] // 2))
+		for epoch in range(2):
+			seen = Counter()
+			for i in range(len(batches)):
+				batch, labels, positions = batches[i]
+				self.assertTrue(np.all(labels.sum(axis=0) == 2))
+				self.assertEqual(positions, batches[i][2])
+				seen.update(p for p, label in zip(positions, np.argmax(labels, axis=1)) if label == args.labels[largest])
+			self.assertEqual(len(seen), label_counts[largest])
+			self.assertTrue(max(seen.values()) == 1 or label_counts[largest] % 2 == 1)
+			batches.on_epoch_end()
+		self.assertEqual(td.LabelBalancedBatches(batch_args, train_paths, {'reference':'reference'}, seed=7)[0][1].tolist(), 
+						td.LabelBalancedBatches(batch_args, train_paths, {'reference':'reference'}, seed=7)[0][1].tolist())
+
+		# Slots of a missing label and corrupt examples are left out of the batches
+		with open(os.path.join(train_paths[0], 'tensor-9_9.hd5'), 'w') as f:
+			f.write('not an hd5 file')
+		batches = td.LabelBalancedBatches(batch_args, train_paths[:-1], {'reference':'reference'}, seed=7)
+		rows = 0
+		for i in range(len(batches)):
+			batch, labels = batches[i]
+			self.assertEqual(len(batch['reference']), len(labels))
+			self.assertLessEqual(len(labels), 2*(len(args.labels)-1))
+			self.assertTrue(np.all(labels.sum(axis=1) == 1))
+			self.assertEqual(labels[:, args.labels[os.path.basename(train_paths[-1])]].sum(), 0)
+			rows += len(labels)
+		self.assertLess(rows, 2*(len(args.labels)-1)*len(batches))
+		shutil.rmtree(batch_args.data_dir)
+
+	def test_epoch_cache(self):
+		cache_args = copy.copy(args)
+		cache_args.data_dir = tempfile.mkdtemp()
+		cache_args.epoch_cache_dir = tempfile.mkdtemp()
+		cache_args.tensor_map = None
+		writer = td.tensor_writer_from_args(cache_args)
+		annotations = {}
+		for label_key in args.labels:
+			for i in range(3):
+				gpos = '%d_%d' % (args.labels[label_key]+1, i+1)
+				annotations[gpos] = np.random.rand(len(args.annotations)).astype(np.float32)
+				writer.write(os.path.join(cache_args.data_dir, 'train', label_key, 'tensor-%s.hd5' % gpos), {args.annotation_set:annotations[gpos]})
+		writer.close()
+		train_paths = [os.path.join(cache_args.data_dir, 'train', label_key) for label_key in args.labels]
+
+		cache = td.epoch_cache_from_args(cache_args, 'train', train_paths)
+		self.assertEqual(len(cache['labels']), 3*len(args.labels))
+		for row, position in enumerate(cache['positions']):
+			self.assertTrue(np.array_equal(cache[args.annotation_set][row], annotations[position.decode('utf-8')]))
+		self.assertEqual(len(os.listdir(cache_args.epoch_cache_dir)), 1)
+
+		writer = td.tensor_writer_from_args(cache_args)
+		writer.write(os.path.join(train_paths[0], 'tensor-9_9.hd5'), {args.annotation_set:np.zeros((len(args.annotations),))})
+		writer.close()
+		cache = td.epoch_cache_from_args(cache_args, 'train', train_paths)
+		self.assertEqual(len(cache['labels']), 3*len(args.labels)+1)
+		self.assertEqual(len(os.listdir(cache_args.epoch_cache_dir)), 1)
+
+		# Index based batches slice the cache, keeping the label balance
+		cache_args.indexed_batches = True
+		cache_args.batch_size = 2*len(args.labels)
+		inputs = {name: cache[name] for name in td.epoch_cache_inputs(cache_args)}
+		batches = td.minibatches_from_args(cache_args, td.array_store_generator, cache_args, inputs, cache['labels'], cache['positions'], True)
+		self.assertIsInstance(batches, td.ArrayStoreBatches)
+		batch, labels, positions = batches[0]
+		self.assertTrue(np.all(labels.sum(axis=0) == 2))
+		for row, position in zip(batch[args.annotation_set], positions):
+			if position in annotations:
+				self.assertTrue(np.array_equal(row, annotations[position]))
+
+		# The cache of another dataset in the same directory is kept
+		other_args = copy.copy(cache_args)
+		other_args.data_dir = tempfile.mkdtemp()
+		other_paths = [os.path.join(other_args.data_dir, 'train', label_key) for label_key in args.labels]
+		shutil.copytree(os.path.join(cache_args.data_dir, 'train'), os.path.join(other_args.data_dir, 'train'))
+		td.epoch_cache_from_args(other_args, 'train', other_paths)
+		self.assertEqual(len(os.listdir(cache_args.epoch_cache_dir)), 2)
+		td.epoch_cache_from_args(cache_args, 'train', train_paths)
+		self.assertEqual(len(os.listdir(cache_args.epoch_cache_dir)), 2)
+		shutil.rmtree(other_args.data_dir)
+		shutil.rmtree(cache_args.data_dir)
+		shutil.rmtree(cache_args.epoch_cache_dir)
+
+	def test_batch_buffers(self):
+		buffers = td.BatchBuffers({'x': (2, 3), 'labels': (2, 4)}, count=3, dtype=np.float16)
+		handed_out = [buffers.next() for _ in range(3)]
+		for i, arrays in enumerate(handed_out):
+			self.assertEqual(arrays['x'].dtype, np.float16)
+			arrays['x'][:] = i
+		self.assertEqual(len(set(id(arrays['x']) for arrays in handed_out)), 3)
+		arrays = buffers.next()
+		self.assertIs(arrays['x'], handed_out[0]['x'])
+		self.assertFalse(np.any(arrays['x']))
+		self.assertTrue(np.all(handed_out[2]['x'] == 2))
+		self.assertRaises(ValueError, td.BatchBuffers, {'x': (2,)}, 1)
+
+		batch_args = copy.copy(args)
+		batch_args.data_dir = tempfile.mkdtemp()
+		batch_args.tensor_map = None
+		batch_args.batch_size = len(args.labels)
+		batch_args.batch_buffers = 4
+		writer = td.tensor_writer_from_args(batch_args)
+		for label_key in args.labels:
+			for i in range(4):
+				tensor_path = os.path.join(batch_args.data_dir, label_key, 'tensor-%d_%d.hd5' % (args.labels[label_key]+1, i+1))
+				writer.write(tensor_path, {args.annotation_set:np.full((len(args.annotations),), i+1)})
+		writer.close()
+		train_paths = [os.path.join(batch_args.data_dir, label_key) for label_key in args.labels]
+		generator = td.tensor_generator_from_label_dirs_and_args(batch_args, train_paths)
+		# A Keras queue of batch_queue_size() batches, plus the batch in training and the one being filled
+		batches = []
+		snapshots = []
+		for _ in range(td.batch_queue_size(batch_args)+2):
+			batches.append(next(generator))
+			snapshots.append(np.copy(batches[-1][0][args.annotation_set]))
+		for batch, snapshot in zip(batches, snapshots):
+			self.assertTrue(np.array_equal(batch[0][args.annotation_set], snapshot))
+		self.assertIs(next(generator)[0][args.annotation_set], batches[0][0][args.annotation_set])
+		self.assertEqual(batches[0][0][args.annotation_set].dtype, np.float32)
+		shutil.rmtree(batch_args.data_dir)
+
+	def test_write_manifest(self):
+		manifest_args = copy.copy(args)
+		manifest_args.data_dir = tempfile.mkdtemp()
+		manifest_args.manifest_checkpoint = 3
+		writer = td.tensor_writer_from_args(manifest_args)
+		tensor_paths = [os.path.join(manifest_args.data_dir, 'SNP', 'tensor-1_%d.hd5' % (i+1)) for i in range(8)]
+
+		stats = Counter()
+		manifest = td.WriteManifest(manifest_args, writer)
+		for i in manifest.resume(range(len(tensor_paths)), stats):
+			manifest.add(tensor_paths[i], '1', i+1, 'A', ['reference'])
+			writer.write(tensor_paths[i], {'reference':np.zeros((4,))})
+			stats['count'] += 1
+			if i == 6:
+				break # Die without closing, examples after the checkpoint before item 6 are not kept
+
+		stats = Counter()
+		manifest = td.WriteManifest(manifest_args, writer)
+		self.assertEqual(manifest.keys, set(('1', i+1, 'A') for i in range(6)))
+		self.assertFalse(os.path.exists(tensor_paths[6]))
+		self.assertEqual(list(manifest.resume(range(len(tensor_paths)), stats)), [6, 7])
+		self.assertEqual(stats['count'], 6)
+		shutil.rmtree(manifest_args.data_dir)
+
+	def test_plan_downsampling(self):
+		plan_args = copy.copy(args)
+		plan_args.target_counts = ['SNP=3', 'NOT_INDEL=5']
+		self.assertEqual(td.target_counts_from_args(plan_args), {'SNP':3, 'NOT_INDEL':5})
+		plan_args.target_counts = ['BAD=1']
+		self.assertRaises(ValueError, td.target_counts_from_args, plan_args)
+
+		plan_args.target_counts = ['10']
+		counts = td.count_candidate_labels(plan_args)
+		rates = td.plan_downsampling(plan_args)
+		for label in rates:
+			self.assertAlmostEqual(rates[label], min(1.0, 10.0 / max(1, counts[label])))
+			self.assertEqual(rates[label], getattr(plan_args, td.downsample_arguments[label]))
+
+	def test_dataset_statistics(self):
+		a_set = args.annotation_set
+		annotations = np.random.rand(50, len(defines.annotations[a_set]))
+		annotations[annotations < 0.2] = 0
+		whole, halves = td.DatasetStatistics(), [td.DatasetStatistics(), td.DatasetStatistics()]
+		for i, (v, _) in enumerate(zip(self.vcf_train, range(50))):
+			whole.add('SNP' if v.is_snp else 'INDEL', v, v.ALT[0], {a_set:annotations[i]}, i % 7)
+			halves[i % 2].add('SNP' if v.is_snp else 'INDEL', v, v.ALT[0], {a_set:annotations[i]}, i % 7)
+
+		merged = td.DatasetStatistics(json.loads(json.dumps(halves[0].state())))
+		merged.merge(halves[1])
+		self.assertEqual(merged.counts, whole.counts)
+		self.assertEqual(merged.read_depths, whole.read_depths)
+		self.assertEqual(whole.counts['total'], 50)
+		means_and_stds = merged.means_and_stds(a_set)
+		self.assertTrue(np.allclose(means_and_stds, whole.means_and_stds(a_set)))
+		for j in range(annotations.shape[1]):
+			present = annotations[:, j][annotations[:, j] != 0]
+			self.assertAlmostEqual(means_and_stds[j, 0], present.mean())
+			self.assertAlmostEqual(means_and_stds[j, 1], present.std())
+
+		other_args = copy.copy(args)
+		other_args.negative_vcf = os.path.join(os.path.dirname(args.negative_vcf), 'other_calls.vcf.gz')
+		self.assertNotEqual(td.statistics_path_from_args(args), td.statistics_path_from_args(other_args))
+		self.assertEqual(td.statistics_path_from_args(args), td.statistics_path_from_args(copy.copy(args)))
+
+	def test_cohort_labels(self):
+		cohort_args = copy.copy(args)
+		handle, cohort_args.cohort_file = tempfile.mkstemp()
+		with os.fdopen(handle, 'w') as f:
+			f.write('# sample\tbam\n%s\t%s\n%s\t%s\t%s\t%s\n' % (args.sample_name, args.bam_file, args.sample_name, args.bam_file, args.train_vcf, args.bed_file))
+		cohort = td.cohort_from_args(cohort_args, open_bams=False)
+		self.assertEqual([sample.name for sample in cohort], [args.sample_name]*2)
+		self.assertIs(cohort[0].bed_dict, cohort[1].bed_dict)
+
+		variants = [v for v, _ in zip(td.VariantReader(args.negative_vcf), range(200))]
+		expected = [(v.POS, str(a), l) for v, a, l in td.truth_labels_from_sorted_vcfs(variants, self.vcf_train, self.bed_dict, Counter()) 
+					if v.genotype(args.sample_name).is_variant and v.ALT.index(a)+1 in v.genotype(args.sample_name).sample.allele_indices]
+		labels = [(sample, (v.POS, str(a), l)) for v, sample, a, l in td.cohort_truth_labels_from_sorted_vcfs(variants, cohort, Counter())]
+		for sample in cohort:
+			self.assertEqual([label for s, label in labels if s is sample], expected)
+		os.remove(cohort_args.cohort_file)
+
+		# At a multiallelic site each sample is labeled for the alleles in its own genotype
+		data_dir = tempfile.mkdtemp()
+		vcf_path = os.path.join(data_dir, 'multiallelic.vcf.gz')
+		header = pysam.VariantHeader()
+		header.contigs.add('1', length=100000)
+		header.formats.add('GT', 1, 'String', 'Genotype')
+		for name in ['het_first', 'het_second', 'het_both']:
+			header.add_sample(name)
+		with pysam.VariantFile(vcf_path, 'wz', header=header) as vcf_out:
+			record = vcf_out.new_record(contig='1', start=99, stop=100, alleles=['A', 'C', 'G'])
+			for name, gt in zip(['het_first', 'het_second', 'het_both'], [(0, 1), (0, 2), (1, 2)]):
+				record.samples[name]['GT'] = gt
+			vcf_out.write(record)
+		pysam.tabix_index(vcf_path, preset='vcf', force=True)
+		bed_path = os.path.join(data_dir, 'confident.bed')
+		with open(bed_path, 'w') as f:
+			f.write('1\t0\t1000\n')
+		with open(cohort_args.cohort_file, 'w') as f:
+			for name in ['het_first', 'het_second', 'het_both']:
+				f.write('%s\t%s\t%s\t%s\n' % (name, args.bam_file, vcf_path, bed_path))
+		cohort = td.cohort_from_args(cohort_args, open_bams=False)
+		labels = [(sample.name, a) for v, sample, a, l in td.cohort_truth_labels_from_sorted_vcfs(td.VariantReader(vcf_path), cohort, Counter(), label_sites=False)]
+		self.assertEqual(labels, [('het_first', 'C'), ('het_second', 'G'), ('het_both', 'C'), ('het_both', 'G')])
+		os.remove(cohort_args.cohort_file)
+		shutil.rmtree(data_dir)
+
+	@unittest.skipIf(vcf is None, 'PyVCF is not installed')
+	def test_variant_reader_matches_pyvcf(self):
+		for vcf_file in [args.train_vcf, args.negative_vcf]:
+			pyvcf_reader = vcf.Reader(open(vcf_file, 'r'))
+			for v, p, _ in zip(td.VariantReader(vcf_file), pyvcf_reader, range(2000)):
+				self.assertEqual((v.CHROM, v.POS, v.REF, v.QUAL, v.FILTER), (p.CHROM, p.POS, p.REF, p.QUAL, p.FILTER))
+				self.assertEqual(v.ALT, [None if a is None else str(a) for a in p.ALT])
+				self.assertEqual((v.is_snp, v.is_indel, v.is_deletion), (p.is_snp, p.is_indel, p.is_deletion))
+				self.assertEqual(str(v), str(p))
+				self.assertEqual(sorted(v.INFO.keys()), sorted(p.INFO.keys()))
+				for k in p.INFO:
+					value = v.INFO[k]
+					self.assertEqual(list(value) if isinstance(value, tuple) else value, p.INFO[k])
+				self.assertEqual(len(v.samples), len(p.samples))
+				self.assertEqual([c.sample.name for c in v.get_hets()], [c.sample for c in p.get_hets()])
+				self.assertEqual([c.sample.name for c in v.get_hom_alts()], [c.sample for c in p.get_hom_alts()])
+				for call in p.samples:
+					self.assertEqual(v.genotype(call.sample).is_variant, call.is_variant)
+					for field in p.FORMAT.split(':'):
+						self.assertEqual(getattr(v.genotype(call.sample).data, field), getattr(call.data, field))
+
+	def test_annotation_matrix(self):
+		stats = Counter()
+		variants = [v for v, _ in zip(self.vcf_ram, range(200))]
+		annotations = args.annotations + ['QUAL']
+		matrix = td.get_annotation_matrix(args, variants, stats, override_annotations=annotations)
+		self.assertEqual(matrix.shape, (len(variants), len(annotations)))
+		for v, row in zip(variants, matrix):
+			self.assertTrue(np.array_equal(row, td.get_annotation_data(args, v, stats, 0, annotations), equal_nan=True))
+			for a, value in zip(annotations, row):
+				if a in v.INFO and a != 'AF' and not isinstance(v.INFO[a], tuple) and not math.isnan(v.INFO[a]):
+					self.assertEqual(value, v.INFO[a])
+			if v.QUAL is not None:
+				self.assertEqual(row[-1], v.QUAL)
+		self.assertIs(td.annotation_extractor(annotations, variants[0], args.sample_name), td.annotation_extractor(annotations, variants[-1], args.sample_name))
+
 	def test_vcf_and_reference(self):
 		self.check_vcf_and_reference(self.vcf_ram)
 		self.check_vcf_and_reference(self.vcf_train)		
@@ -80,9 +720,8 @@ class TestVariants(unittest.TestCase):
 	def check_vcf_and_reference(self, my_vcf, max_samples=1000):
 		count = 0
 		for v in my_vcf:
-			contig = self.record_dict[v.CHROM]	
 			self.assertTrue(td.variant_in_vcf(v, my_vcf))
-			self.assertEquals(v.REF[0], contig[v.POS-1])
+			self.assertEquals(v.REF[0], self.reference.fetch(v.CHROM, v.POS-1, v.POS))
 			count += 1
 			if count > max_samples:
 				break